@@ -29,23 +29,56 @@
 
 
 import os
-import PySpin
+# MOTTEMP_CAMERA=sim runs against the simulated camera in SimSpin.py
+if os.environ.get('MOTTEMP_CAMERA') == 'sim':
+    import SimSpin as PySpin
+else:
+    import PySpin
 import matplotlib.pyplot as plt
 import sys
 import keyboard
 import time
 import numpy as np
+import math
 import threading
-from ctypes import *
+import logging
+from PyQt6 import QtCore
+import Trace
+import LiveMetrics
+
+log = logging.getLogger(__name__)
 
 global continue_recording
 continue_recording = True
 
 class CamThread(threading.Thread):
-    def __init__(self, camWidget):
+    """
+    Free-running acquisition thread for the live view.
+
+    The thread never draws. Each frame is copied into one of three
+    preallocated buffers (triple buffering), so the GUI can always take the
+    newest complete frame without allocating and without racing the
+    acquisition. Frames that arrive before the GUI collects the previous
+    one are overwritten; LiveView counts them as skipped. With a
+    LiveMetrics.MetricsRing, every complete frame's cloud metrics are
+    recorded in it, whether or not the frame is shown.
+    """
+    def __init__(self, camWidget, session=None, metrics=None):
         threading.Thread.__init__(self, daemon=True)
         self.camWidget = camWidget
+        # Long-lived CameraSession from the main window; None opens and
+        # releases the camera for this thread only
+        self.session = session
+        self.metrics = metrics
         self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._buffers = None
+        self._ready = None
+        self._reading = None
+        self.sequence = 0
+        self.framesIncomplete = 0
+        self.framesMissed = 0
+        self._lastFrameId = None
     
     def stop(self):
         self._stop_event.set()
@@ -53,7 +86,35 @@ class CamThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def publish(self, image_data:np.ndarray, frame_id=None):
+        """Copy a frame into a free buffer and make it the newest one."""
+        with self._lock:
+            if self._buffers is None or self._buffers[0].shape != image_data.shape:
+                self._buffers = [np.empty_like(image_data) for _ in range(3)]
+                self._ready = None
+                self._reading = None
+            target = next(i for i in range(3) if i != self._ready and i != self._reading)
+        np.copyto(self._buffers[target], image_data)
+        with self._lock:
+            self._ready = target
+            self.sequence += 1
+            if frame_id is not None:
+                if self._lastFrameId is not None and frame_id > self._lastFrameId + 1:
+                    self.framesMissed += frame_id - self._lastFrameId - 1
+                self._lastFrameId = frame_id
+
+    def takeLatest(self):
+        """(frame, sequence number) of the newest frame not yet taken, or (None, sequence)."""
+        with self._lock:
+            if self._ready is None:
+                return (None, self.sequence)
+            self._reading, self._ready = self._ready, None
+            return (self._buffers[self._reading], self.sequence)
+
     def run(self):
+        if self.session is not None:
+            self.runSession()
+            return
         system = PySpin.System.GetInstance()
         cam_list = system.GetCameras()
         num_cameras = cam_list.GetSize()
@@ -66,26 +127,30 @@ class CamThread(threading.Thread):
                 for i, cam in enumerate(cam_list):
                     self.run_single_camera(cam)
                     break
+                del cam
             finally:
-                cam.EndAcquisition()
-                cam.DeInit()
                 cam_list.Clear()
                 system.ReleaseInstance()
 
-    def get_id(self):
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
-
-    def raise_exception(self):
-        thread_id = self.get_id()
-        res = pythonapi.PyThreadState_SetAsyncExc(thread_id, py_object(SystemExit))
-        if res > 1:
-            pythonapi.PyThreadState_SetAsyncExc(thread_id, 0)
-            print('Exception raise failure')
-    
+    def runSession(self) -> bool:
+        """Stream through the shared CameraSession, leaving the camera initialised afterwards."""
+        session = self.session
+        with session.lock:
+            if not session.open():
+                print("ERROR: No Camera Detected")
+                return False
+            if not session.configureFreeRun():
+                return False
+            try:
+                session.cam.BeginAcquisition()
+                try:
+                    return self.streamFrames(session.cam)
+                finally:
+                    session.cam.EndAcquisition()
+            except PySpin.SpinnakerException as ex:
+                print('Error: %s' % ex)
+                return False
+
     def handle_close(evt):
         """
         This function will close the GUI when close event happens.
@@ -111,8 +176,6 @@ class CamThread(threading.Thread):
         :return: True if successful, False otherwise.
         :rtype: bool
         """
-        global continue_recording
-
         sNodemap = cam.GetTLStreamNodeMap()
 
         # Change bufferhandling mode to NewestOnly
@@ -180,70 +243,69 @@ class CamThread(threading.Thread):
                 device_serial_number = node_device_serial_number.GetValue()
                 print('Device serial number retrieved as %s...' % device_serial_number)
 
-            # Retrieve and display images
-            while(continue_recording):
-                if self.stopped():
-                    self.handle_close()
-                try:
-
-                    #  Retrieve next received image
-                    #
-                    #  *** NOTES ***
-                    #  Capturing an image houses images on the camera buffer. Trying
-                    #  to capture an image that does not exist will hang the camera.
-                    #
-                    #  *** LATER ***
-                    #  Once an image from the buffer is saved and/or no longer
-                    #  needed, the image must be released in order to keep the
-                    #  buffer from filling up.
-                    
-                    image_result = cam.GetNextImage(1000)
-
-                    #  Ensure image completion
-                    if image_result.IsIncomplete():
-                        print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
-
-                    else:                    
-
-                        # Getting the image data as a numpy array
-                        image_data:np.ndarray = image_result.GetNDArray()
-                        y_len = len(image_data)
-                        x_len = len(image_data[0])
-
-                        # Draws an image on the current figure
-                        self.camWidget.axes.imshow(image_data, cmap='gray')
-
-                        # Interval in plt.pause(interval) determines how fast the images are displayed in a GUI
-                        # Interval is in seconds.
-                        # plt.pause(0.001)
+            # Retrieve images and hand them to the live view
+            try:
+                return self.streamFrames(cam)
+            finally:
+                #  End acquisition
+                #
+                #  *** NOTES ***
+                #  Ending acquisition appropriately helps ensure that devices clean up
+                #  properly and do not need to be power-cycled to maintain integrity.
+                cam.EndAcquisition()
 
-                        # Clear current reference of a figure. This will improve display speed significantly
-                        self.camWidget.draw()     
-                        self.camWidget.axes.cla()      
+        except PySpin.SpinnakerException as ex:
+            print('Error: %s' % ex)
+            return False
 
-                    #  Release image
-                    #
-                    #  *** NOTES ***
-                    #  Images retrieved directly from the camera (i.e. non-converted
-                    #  images) need to be released in order to keep from filling the
-                    #  buffer.
-                    image_result.Release()
+        return True
 
-                except PySpin.SpinnakerException as ex:
-                    print('Error: %s' % ex)
-                    return False
 
-            #  End acquisition
-            #
-            #  *** NOTES ***
-            #  Ending acquisition appropriately helps ensure that devices clean up
-            #  properly and do not need to be power-cycled to maintain integrity.
-            cam.EndAcquisition()
+    def streamFrames(self, cam) -> bool:
+        """Publish frames from a camera that is already acquiring until the thread is stopped."""
+        while not self.stopped():
+            try:
 
-        except PySpin.SpinnakerException as ex:
-            print('Error: %s' % ex)
-            return False
+                #  Retrieve next received image
+                #
+                #  *** NOTES ***
+                #  Capturing an image houses images on the camera buffer. Trying
+                #  to capture an image that does not exist will hang the camera.
+                #
+                #  *** LATER ***
+                #  Once an image from the buffer is saved and/or no longer
+                #  needed, the image must be released in order to keep the
+                #  buffer from filling up.
+                
+                with Trace.span('GetNextImage', 'acquire'):
+                    image_result = cam.GetNextImage(1000)
 
+                #  Ensure image completion
+                if image_result.IsIncomplete():
+                    log.warning('Image incomplete with image status %d ...', image_result.GetImageStatus())
+                    self.framesIncomplete += 1
+
+                else:                    
+
+                    # Copy the image data into the newest-frame buffer; drawing
+                    # happens on the GUI thread (see LiveView)
+                    image_data = image_result.GetNDArray()
+                    self.publish(image_data, image_result.GetFrameID())
+                    if self.metrics is not None:
+                        with Trace.span('metrics', 'acquire'):
+                            self.metrics.record(image_data, image_result.GetFrameID())
+
+                #  Release image
+                #
+                #  *** NOTES ***
+                #  Images retrieved directly from the camera (i.e. non-converted
+                #  images) need to be released in order to keep from filling the
+                #  buffer.
+                image_result.Release()
+
+            except PySpin.SpinnakerException as ex:
+                print('Error: %s' % ex)
+                return False
         return True
 
 
@@ -280,6 +342,233 @@ class CamThread(threading.Thread):
 
         return result
 
+class LiveView(QtCore.QObject):
+    """
+    GUI-thread side of the live view.
+
+    A timer running at the target frame rate takes the newest frame from a
+    CamThread, pushes it into one persistent image artist and blits only that
+    axes. Frames the display had no time for are skipped rather than queued,
+    so the picture is never behind the camera. Large frames are decimated to
+    the on-screen size of the axes before they are handed to matplotlib.
+    Acquisition FPS, display FPS, skipped and dropped frames are passed to
+    readout (e.g. the status bar) once a second.
+    """
+    def __init__(self, canvas, ax, readout=None, targetFps=30, parent=None):
+        super(LiveView, self).__init__(parent)
+        self.canvas = canvas
+        self.ax = ax
+        self.readout = readout
+        self.targetFps = targetFps
+        self.camThread = None
+        self.image = None
+        self._lut = np.zeros((65536, 4), dtype=np.uint8)
+        self._lut[:, 3] = 255
+        self._lutRange = None
+        self._rgba = None
+        self._background = None
+        self._drawCid = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
+        self._timer.timeout.connect(self._tick)
+
+    def start(self, camThread):
+        self.camThread = camThread
+        self.framesShown = 0
+        self.framesSkipped = 0
+        self._lastSequence = 0
+        self._rateStart = time.perf_counter()
+        self._rateSequence = 0
+        self._rateShown = 0
+        self.acquisitionFps = 0.
+        self.displayFps = 0.
+        self.ax.cla()
+        self.ax.title.set_text("Camera View")
+        self.image = None
+        if self._drawCid is None:
+            self._drawCid = self.canvas.mpl_connect('draw_event', self._onDraw)
+        self._timer.start(max(1, int(1000 / self.targetFps)))
+
+    def stop(self):
+        self._timer.stop()
+        if self.camThread is not None:
+            self.camThread.stop()
+            self.camThread = None
+        if self._drawCid is not None:
+            self.canvas.mpl_disconnect(self._drawCid)
+            self._drawCid = None
+        self._background = None
+
+    def isRunning(self) -> bool:
+        return self._timer.isActive()
+
+    def _onDraw(self, event):
+        # Full redraws (start, resize, tab switch) invalidate the saved background
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._blitArtists()
+
+    def _decimation(self, shape) -> int:
+        bbox = self.ax.bbox
+        if bbox.width <= 0 or bbox.height <= 0:
+            return 1
+        return max(1, math.ceil(max(shape[0] / bbox.height, shape[1] / bbox.width)))
+
+    def _toRGBA(self, display:np.ndarray) -> np.ndarray:
+        # Auto-contrast through a 16-bit -> RGBA lookup table; handing
+        # matplotlib ready-made RGBA skips its per-frame normalise/colormap pass
+        lo = int(display.min())
+        hi = max(lo + 1, int(display.max()))
+        if self._lutRange != (lo, hi):
+            levels = np.clip((np.arange(65536, dtype=np.float32) - lo) * (255. / (hi - lo)), 0, 255).astype(np.uint8)
+            self._lut[:, 0] = levels
+            self._lut[:, 1] = levels
+            self._lut[:, 2] = levels
+            self._lutRange = (lo, hi)
+        if self._rgba is None or self._rgba.shape[:2] != display.shape:
+            self._rgba = np.empty(display.shape + (4,), dtype=np.uint8)
+        np.take(self._lut, display, axis=0, out=self._rgba)
+        return self._rgba
+
+    def _tick(self):
+        if self.camThread is None:
+            return
+        frame, sequence = self.camThread.takeLatest()
+        self._updateRates(sequence)
+        if frame is None:
+            return
+        self.framesSkipped += max(0, sequence - self._lastSequence - 1)
+        self._lastSequence = sequence
+        step = self._decimation(frame.shape)
+        rgba = self._toRGBA(frame[::step, ::step])
+        if self.image is None or self.image.get_array().shape != rgba.shape:
+            # New artist only when the frame geometry changes
+            if self.image is not None:
+                self.image.remove()
+            self.image = self.ax.imshow(rgba, interpolation='none', extent=(0, frame.shape[1], frame.shape[0], 0), animated=True)
+            self.canvas.draw()
+        else:
+            self.image.set_data(rgba)
+        self.framesShown += 1
+        if self._background is not None:
+            with Trace.span('blit', 'gui'):
+                self.canvas.restore_region(self._background)
+                self._blitArtists()
+                self.canvas.blit(self.ax.bbox)
+
+    def _blitArtists(self):
+        if self.image is not None:
+            self.ax.draw_artist(self.image)
+
+    def _updateRates(self, sequence):
+        now = time.perf_counter()
+        elapsed = now - self._rateStart
+        if elapsed >= 1.:
+            self.acquisitionFps = (sequence - self._rateSequence) / elapsed
+            self.displayFps = (self.framesShown - self._rateShown) / elapsed
+            self._rateStart = now
+            self._rateSequence = sequence
+            self._rateShown = self.framesShown
+            if self.readout is not None:
+                self.readout(self.readoutText())
+
+    def readoutText(self) -> str:
+        dropped = self.camThread.framesMissed + self.camThread.framesIncomplete if self.camThread is not None else 0
+        return f"Live view: acquisition {self.acquisitionFps:.1f} fps | display {self.displayFps:.1f} fps | skipped {self.framesSkipped} | dropped {dropped}"
+
+class StripChart(QtCore.QObject):
+    """
+    Scrolling plot of the last `window` seconds of a MetricsRing.
+
+    Like LiveView it runs on a GUI-thread timer, here at a throttled rate,
+    and only blits its lines onto a saved background. Time is plotted
+    relative to now, so the background is only redrawn when a trace leaves
+    its y range or the range has become far too wide for it. Traces are
+    thinned to about one point per pixel before they are drawn.
+    """
+    # (axes, ring fields, labels) of the traces
+    TRACES = (
+        (0, ('centreX', 'centreY'), ('x', 'y')),
+        (1, ('widthX', 'widthY'), ('x', 'y')),
+        (2, ('amplitude',), ('peak',)),
+    )
+
+    def __init__(self, canvas, ring, window=60., fps=5, parent=None):
+        super(StripChart, self).__init__(parent)
+        self.canvas = canvas
+        self.ring = ring
+        self.window = window
+        columns = {name: i for i, name in enumerate(LiveMetrics.FIELDS)}
+        self._lines = []
+        for ax, fields, labels in self.TRACES:
+            for field, label in zip(fields, labels):
+                line, = canvas.axes[ax].plot([], [], label=label, animated=True)
+                self._lines.append((canvas.axes[ax], columns[field], line))
+            canvas.axes[ax].set_xlim(-window, 0)
+            if len(fields) > 1:
+                canvas.axes[ax].legend(loc='upper left')
+        self._lastTotal = -1
+        self._background = None
+        self._drawCid = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._tick)
+        self._interval = max(1, int(1000 / fps))
+
+    def start(self):
+        if self._drawCid is None:
+            self._drawCid = self.canvas.mpl_connect('draw_event', self._onDraw)
+        self._lastTotal = -1
+        self._timer.start(self._interval)
+
+    def stop(self):
+        self._timer.stop()
+        if self._drawCid is not None:
+            self.canvas.mpl_disconnect(self._drawCid)
+            self._drawCid = None
+        self._background = None
+
+    def isRunning(self) -> bool:
+        return self._timer.isActive()
+
+    def _onDraw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._blitArtists()
+
+    def _blitArtists(self):
+        for ax, _, line in self._lines:
+            ax.draw_artist(line)
+
+    def _tick(self):
+        # Nothing new, or nowhere to show it
+        if self.ring.total == self._lastTotal or not self.canvas.isVisible():
+            return
+        self._lastTotal = self.ring.total
+        now = time.time()
+        rows = self.ring.since(now - self.window)
+        rows = rows[::max(1, len(rows) // max(1, int(self.canvas.figure.bbox.width)))]
+        t = rows[:, 0] - now
+        for ax, column, line in self._lines:
+            line.set_data(t, rows[:, column])
+        rescale = False
+        for ax in dict.fromkeys(ax for ax, _, _ in self._lines):
+            values = np.concatenate([rows[:, column] for a, column, _ in self._lines if a is ax])
+            values = values[np.isfinite(values)]
+            if not len(values):
+                continue
+            lo, hi = float(values.min()), float(values.max())
+            low, high = ax.get_ylim()
+            if lo < low or hi > high or (hi - lo) < (high - low) / 4:
+                margin = max((hi - lo) * 0.25, 1.)
+                ax.set_ylim(lo - margin, hi + margin)
+                rescale = True
+        if rescale or self._background is None:
+            # A full draw, which saves the new background through _onDraw
+            self.canvas.draw()
+            return
+        with Trace.span('stripChart', 'gui'):
+            self.canvas.restore_region(self._background)
+            self._blitArtists()
+            self.canvas.blit(self.canvas.figure.bbox)
+
 
 if __name__ == '__main__':
     sys.exit(1)
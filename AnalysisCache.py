@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+import MotTemp
+import RunStack
+
+INDEX_FILE = "index.json"
+
+class AnalysisCache:
+    """
+    On-disk cache of per-image and per-run analysis results.
+
+    Entries are pickled into one file each under cacheDir, named by a hash of
+    their key. Keys are built from the identity of the frame files (size and
+    mtime) together with the analysis settings and version
+    (MotTemp.analysisSettings), so editing or re-acquiring a run, or
+    changing the analysis, never returns stale results. The total size is
+    bounded by maxBytes; the least recently used entries are evicted first.
+
+    Access times and new entries are only kept in memory until flush(),
+    which the analysis calls once per run, so a recall does not rewrite
+    the index for every image. Entry files that never made it into the
+    index (the process died before flushing) are picked up again on load.
+
+    Only one process may write a cache directory. A readOnly cache, as
+    used by BatchProcess workers, reads existing entries but keeps new ones
+    and access times in memory (pending, accessed) for the writing process
+    to merge().
+    """
+    def __init__(self, cacheDir, maxBytes=256*1024*1024, readOnly=False):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.readOnly = readOnly
+        self.pending = {}
+        self.accessed = set()
+        self._lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+        try:
+            with open(os.path.join(cacheDir, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        # Drop index entries whose file has gone missing, and index the
+        # entry files that are missing from it, so eviction still sees them
+        self.index = {k: v for k, v in self.index.items() if os.path.exists(self._path(k))}
+        for name in os.listdir(cacheDir):
+            key = name[:-len(".pkl")]
+            if name.endswith(".pkl") and key not in self.index:
+                st = os.stat(os.path.join(cacheDir, name))
+                self.index[key] = {'size': st.st_size, 'lastAccess': st.st_mtime}
+        self._dirty = False
+
+    @staticmethod
+    def fileIdentity(source) -> tuple:
+        """(path, size, mtime) of a TIFF path or of the stack file behind a (runDir, slot) source."""
+        if isinstance(source, tuple):
+            runDir, slot = source
+            path = os.path.join(runDir, RunStack.FRAMES_FILE)
+        else:
+            path, slot = source, None
+        st = os.stat(path)
+        return (os.path.abspath(path), slot, st.st_size, st.st_mtime_ns)
+
+    def imageKey(self, source, sigmaFactor, tof, calibration=None) -> str:
+        key = ('image', self.fileIdentity(source), sigmaFactor, float(tof) if tof is not None else None, MotTemp.analysisSettings())
+        # Results from calibrated frames also depend on the master frame file
+        if calibration is not None:
+            key += (self.fileIdentity(calibration),)
+        return self._hash(key)
+
+    def runKey(self, sources, sigmaFactor, timeSplit, calibration=None) -> str:
+        key = ('run', [self.fileIdentity(s) for s in sources], sigmaFactor, [float(t) for t in timeSplit], MotTemp.analysisSettings())
+        if calibration is not None:
+            key += (self.fileIdentity(calibration),)
+        return self._hash(key)
+
+    def get(self, key):
+        with self._lock:
+            if key in self.pending:
+                return self.pending[key]
+            if key not in self.index:
+                return None
+            try:
+                with open(self._path(key), 'rb') as f:
+                    value = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                if not self.readOnly:
+                    self._remove(key)
+                return None
+            if self.readOnly:
+                self.accessed.add(key)
+                return value
+            self.index[key]['lastAccess'] = time.time()
+            self._dirty = True
+            return value
+
+    def put(self, key, value):
+        if self.readOnly:
+            with self._lock:
+                self.pending[key] = value
+            return
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            tmp = self._path(key) + ".tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+            self.index[key] = {'size': len(data), 'lastAccess': time.time()}
+            self._evict()
+            self._dirty = True
+
+    def flush(self):
+        """Write the index if entries were added or read since the last flush."""
+        with self._lock:
+            if self._dirty and not self.readOnly:
+                self._writeIndex()
+
+    def merge(self, pending:dict, accessed):
+        """Store the entries and access times collected by a readOnly cache, then flush."""
+        for key, value in pending.items():
+            self.put(key, value)
+        with self._lock:
+            now = time.time()
+            for key in accessed:
+                if key in self.index:
+                    self.index[key]['lastAccess'] = now
+                    self._dirty = True
+        self.flush()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.index):
+                self._remove(key)
+            self._writeIndex()
+
+    def totalBytes(self) -> int:
+        return sum(e['size'] for e in self.index.values())
+
+    def _evict(self):
+        total = self.totalBytes()
+        for key in sorted(self.index, key=lambda k: self.index[k]['lastAccess']):
+            if total <= self.maxBytes:
+                break
+            total -= self.index[key]['size']
+            self._remove(key)
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _writeIndex(self):
+        tmp = os.path.join(self.cacheDir, f"{INDEX_FILE}.{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.cacheDir, INDEX_FILE))
+        self._dirty = False
+
+    def _path(self, key) -> str:
+        return os.path.join(self.cacheDir, f"{key}.pkl")
+
+    @staticmethod
+    def _hash(key) -> str:
+        return hashlib.sha1(repr(key).encode()).hexdigest()
@@ -0,0 +1,145 @@
+# Headless batch reprocessing of runs under the Data/ tree.
+#
+# Walks Data/YYYY/MM/DD/RunN for a range of dates (and optionally run
+# numbers), analyses the runs in parallel across cores and writes one CSV
+# row per run (one per camera for multi-camera runs) with g, v_y, the x/y
+# temperatures and the fit parameters.
+# Nothing here imports Qt or PySpin, so it runs on any analysis machine:
+#
+#   python BatchProcess.py --start 2024-06-01 --end 2024-06-30 --sigma 2 -o june.csv
+
+import argparse
+import csv
+import datetime
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import MotTemp
+import RunStack
+import AnalysisCache
+import Calibration
+
+FIELDS = [
+    'date', 'run', 'camera', 'numImages', 'sigmaFactor',
+    'g', 'v_y', 'xTemp', 'yTemp',
+    'x_a', 'x_b', 'x_c',
+    'y_a', 'y_b', 'y_c',
+    'xSigma_slope', 'xSigma_intercept',
+    'ySigma_s0', 'ySigma_sv',
+    'error',
+]
+
+def findRuns(dataDir, start:datetime.date, end:datetime.date, runs=None) -> list:
+    """(date, run number, run directory) for every RunN between start and end inclusive."""
+    found = []
+    day = start
+    while day <= end:
+        dayDir = os.path.join(dataDir, day.strftime("%Y"), day.strftime("%m"), day.strftime("%d"))
+        if os.path.isdir(dayDir):
+            for name in os.listdir(dayDir):
+                if not name.startswith("Run") or not name[3:].isdigit():
+                    continue
+                num = int(name[3:])
+                if runs is not None and num not in runs:
+                    continue
+                found.append((day, num, os.path.join(dayDir, name) + "/"))
+        day += datetime.timedelta(days=1)
+    found.sort(key=lambda r: (r[0], r[1]))
+    return found
+
+def summaryRow(fit:dict) -> dict:
+    xc = fit['xCentreFit'][0]
+    yc = fit['yCentreFit'][0]
+    xs = fit['xSigmaFit'][0]
+    ys = fit['ySigmaFit'][0]
+    return {
+        'numImages': len(fit['axis']),
+        'g': fit['gravity'],
+        'v_y': fit['v_y'],
+        'xTemp': fit['xTemp'],
+        'yTemp': fit['yTemp'],
+        'x_a': xc['a'], 'x_b': xc['b'], 'x_c': xc['c'],
+        'y_a': yc['a'], 'y_b': yc['b'], 'y_c': yc['c'],
+        'xSigma_slope': xs['slope'], 'xSigma_intercept': xs['intercept'],
+        'ySigma_s0': ys['s0'], 'ySigma_sv': ys['sv'],
+    }
+
+def processRun(runDir, sigmaFactor, cacheDir=None, calibrationDir=None) -> tuple[dict,tuple]:
+    """
+    Analyse one run in a worker process. Returns its summary row and the
+    (pending, accessed) updates of its read-only cache, which only the
+    parent process writes (see AnalysisCache.merge).
+    """
+    timeSplit = []
+    cache = None
+    try:
+        # A run with an unreadable index is reported like any other failure
+        timeSplit = RunStack.runTimeSplit(runDir)
+        if len(timeSplit) < 3:
+            return {'numImages': len(timeSplit), 'error': 'fewer than 3 TOF images'}, None
+        cache = AnalysisCache.AnalysisCache(cacheDir, readOnly=True) if cacheDir is not None else None
+        calibrations = Calibration.CalibrationStore(calibrationDir) if calibrationDir is not None else None
+        row = summaryRow(MotTemp.analyseRun(runDir, timeSplit, sigmaFactor, cache=cache, calibrations=calibrations))
+    except Exception as ex:
+        row = {'numImages': len(timeSplit), 'error': str(ex)}
+    return row, (cache.pending, cache.accessed) if cache is not None else None
+
+def parseRuns(text):
+    """'3', '1-5' or '1,4,7-9' into a set of run numbers."""
+    runs = set()
+    for part in text.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            runs.update(range(int(lo), int(hi)+1))
+        else:
+            runs.add(int(part))
+    return runs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess MOT temperature runs without the GUI.")
+    parser.add_argument('--data', default=os.path.join(os.getcwd(), "Data"), help="root of the Data/YYYY/MM/DD/RunN tree")
+    parser.add_argument('--start', required=True, type=datetime.date.fromisoformat, help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help="last date, YYYY-MM-DD (default: --start)")
+    parser.add_argument('--runs', type=parseRuns, help="run numbers, e.g. 1-5 or 2,4,6")
+    parser.add_argument('--sigma', type=int, default=1, help="ROI sigma factor")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of runs analysed at once")
+    parser.add_argument('--cache', help="analysis cache directory to reuse (default: no cache)")
+    parser.add_argument('--calibration', help="master dark directory (default: Data/.calibration if it exists)")
+    parser.add_argument('--no-calibration', action='store_true', help="analyse the raw frames")
+    parser.add_argument('-o', '--output', default="summary.csv", help="CSV file to write")
+    args = parser.parse_args(argv)
+
+    # Multi-camera runs are analysed camera by camera
+    runs = [(day, num, camera, cameraDir) for day, num, runDir in findRuns(args.data, args.start, args.end or args.start, args.runs)
+            for camera, cameraDir in MotTemp.cameraDirs(runDir).items()]
+    if not runs:
+        print("No runs found.")
+        return 1
+    calibrationDir = args.calibration or os.path.join(args.data, ".calibration")
+    if args.no_calibration or not os.path.isdir(calibrationDir):
+        calibrationDir = None
+    print(f"Processing {len(runs)} runs on {args.workers} workers...")
+
+    cache = AnalysisCache.AnalysisCache(args.cache) if args.cache is not None else None
+    rows = [None]*len(runs)
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(processRun, runDir, args.sigma, args.cache, calibrationDir): i for i, (_, _, _, runDir) in enumerate(runs)}
+        for done, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            day, num, camera, _ = runs[i]
+            row, updates = future.result()
+            if updates is not None:
+                cache.merge(*updates)
+            rows[i] = {'date': day.isoformat(), 'run': num, 'camera': camera, 'sigmaFactor': args.sigma, **row}
+            status = rows[i].get('error') or f"g = {rows[i]['g']:.3f} m/s^2"
+            print(f"[{done+1}/{len(runs)}] {day} Run{num}{' camera ' + camera if camera else ''}: {status}")
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Summary written to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
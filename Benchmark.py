@@ -0,0 +1,205 @@
+# Benchmarks for the analysis and acquisition hot paths.
+#
+# Builds synthetic Mono16 TOF runs with the simulated camera (SimSpin) and
+# times each stage for every combination of image size and TOF count:
+#
+#   profile     MotTemp.profileImage over the run (decode, peak, std, ROI)
+#   fitBatched  GaussFit fits of every x and y ROI profile
+#   fitLmfit    lmfit fits of the same profiles
+#   physics     MotTemp.fitRun (centre and sigma fits, temperatures)
+#   analyseRun  MotTemp.analyseRun end to end, one worker, no cache
+#   framePath   CamTrigger.analyseFrame, the per-frame acquisition path
+#   calibrate   Calibration.MasterFrame.apply, dark subtraction and hot pixels
+#
+# Each stage is timed (best of --repeat) and then run once more under
+# tracemalloc for its peak memory. Results go to a JSON file; given a
+# baseline file, stages that got slower or bigger than --threshold are
+# reported and the exit status is 1:
+#
+#   python Benchmark.py --sizes 512 1024 --tofs 5 50 -o bench.json
+#   python Benchmark.py --baseline bench.json
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# CamTrigger is only exercised on frames in memory, so no camera is needed
+os.environ.setdefault('MOTTEMP_CAMERA', 'sim')
+
+import MotTemp
+import RunStack
+import SimSpin
+import Calibration
+
+SIZES = [512, 1024, 2048]
+TOF_COUNTS = [5, 50, 200]
+SIGMA_FACTOR = 2
+
+class _Headless:
+    """Just enough of MainWindow for CamTrigger.analyseFrame."""
+    class _Scheduler:
+        def post(self, canvas, update, key=None):
+            pass
+        def showMessage(self, message):
+            pass
+        def setText(self, widget, text):
+            pass
+
+    def __init__(self):
+        self.renderScheduler = self._Scheduler()
+        self.tempLabel = None
+
+def makeRun(runDir, size, numImages, seed=0) -> list:
+    """Write a synthetic run of numImages size x size frames as a RunStack and return its TOFs."""
+    timeSplit = [float(t) for t in np.linspace(1, 10, numImages)]
+    stack = RunStack.RunStack.create(runDir, timeSplit, (size, size), 1000)
+    for i, frame in enumerate(SimSpin.renderFrames(timeSplit, size, size, seed)):
+        stack.write(i, frame)
+        stack.markWritten(i)
+    stack.flush()
+    return timeSplit
+
+def measure(work, repeat) -> tuple:
+    """(best wall time in seconds, tracemalloc peak in bytes) of work()."""
+    best = float('inf')
+    # The fit reports MotTemp prints would dominate the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            work()
+            best = min(best, time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            work()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return (best, peak)
+
+def benchmarkRun(runDir, size, numImages, repeat, stages) -> list:
+    import Trigger
+    from Pipeline import Frame
+
+    timeSplit = makeRun(runDir, size, numImages)
+    sources = RunStack.frameSources(runDir, timeSplit)
+    profiled = [MotTemp.profileImage(s, SIGMA_FACTOR) for s in sources]
+    profiles = [r.roi_x for r in profiled] + [r.roi_y for r in profiled]
+    positions = [r.x_pos for r in profiled] + [r.y_pos for r in profiled]
+    fitted = MotTemp.processImages(sources, SIGMA_FACTOR)
+    stack = RunStack.RunStack(runDir)
+    trigger = Trigger.CamTrigger(numImages, runDir, 1000, timeSplit, SIGMA_FACTOR, _Headless())
+    # A master with a realistic sprinkling of hot pixels (0.01 %)
+    dark = np.full((size, size), 100, dtype=np.float32)
+    hotPixels = np.zeros((size, size), dtype=bool)
+    hotPixels.flat[np.random.default_rng(0).choice(size * size, max(1, size * size // 10000), replace=False)] = True
+    master = Calibration.MasterFrame(dark, hotPixels)
+
+    work = {
+        'profile': lambda: [MotTemp.profileImage(s, SIGMA_FACTOR) for s in sources],
+        'fitBatched': lambda: MotTemp.fitProfilesBatched(profiles, positions),
+        'fitLmfit': lambda: [MotTemp.fitProfile(p, x) for p, x in zip(profiles, positions)],
+        'physics': lambda: MotTemp.fitRun(timeSplit, fitted),
+        'analyseRun': lambda: MotTemp.analyseRun(runDir, timeSplit, SIGMA_FACTOR),
+        'framePath': lambda: [trigger.analyseFrame(Frame(i, timeSplit[i], stack.frame(i))) for i in range(numImages)],
+        'calibrate': lambda: [master.apply(stack.frame(i)) for i in range(numImages)],
+    }
+    results = []
+    for stage in stages:
+        seconds, peak = measure(work[stage], repeat)
+        results.append({
+            'size': size,
+            'tofs': numImages,
+            'stage': stage,
+            'seconds': seconds,
+            'perFrameMs': seconds / numImages * 1000,
+            'peakBytes': peak,
+        })
+        print(f"{size:>5}^2 x {numImages:>3} TOFs  {stage:<11} {seconds*1000:10.1f} ms  {seconds/numImages*1000:8.2f} ms/frame  {peak/2**20:8.1f} MiB peak")
+    return results
+
+def _key(case) -> tuple:
+    return (case['size'], case['tofs'], case['stage'])
+
+def compare(results:list, baseline:list, threshold:float) -> list:
+    """Human-readable lines for every stage slower or bigger than baseline by more than threshold."""
+    reference = {_key(c): c for c in baseline}
+    regressions = []
+    for case in results:
+        old = reference.get(_key(case))
+        if old is None:
+            continue
+        for field, unit, scale in (('seconds', 'ms', 1000), ('peakBytes', 'MiB', 1/2**20)):
+            if old[field] > 0 and case[field] > old[field] * (1 + threshold):
+                regressions.append(f"{case['size']}^2 x {case['tofs']} {case['stage']}: {field} {old[field]*scale:.1f} -> {case[field]*scale:.1f} {unit} (+{(case[field]/old[field]-1)*100:.0f}%)")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MOT temperature analysis on synthetic runs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="square frame sizes in pixels")
+    parser.add_argument('--tofs', type=int, nargs='+', default=TOF_COUNTS, help="TOF counts per run")
+    parser.add_argument('--stages', nargs='+', default=None, help="stages to run (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed repetitions per stage; the best is kept")
+    parser.add_argument('--skip-lmfit', action='store_true', help="leave out the slow lmfit stage")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative slow-down or growth reported as a regression")
+    parser.add_argument('--save-baseline', action='store_true', help="also write the results to the --baseline file")
+    parser.add_argument('--workdir', help="where to build the synthetic runs (default: a temporary directory)")
+    parser.add_argument('-o', '--output', default="benchmark.json", help="JSON file to write")
+    args = parser.parse_args(argv)
+
+    stages = args.stages or ['profile', 'fitBatched', 'fitLmfit', 'physics', 'analyseRun', 'framePath', 'calibrate']
+    if args.skip_lmfit:
+        stages = [s for s in stages if s != 'fitLmfit']
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mottemp-bench-")
+    results = []
+    try:
+        for size in args.sizes:
+            for numImages in args.tofs:
+                runDir = os.path.join(workdir, f"{size}x{numImages}") + "/"
+                results += benchmarkRun(runDir, size, numImages, max(1, args.repeat), stages)
+                shutil.rmtree(runDir, ignore_errors=True)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'cpus': os.cpu_count(),
+        'cases': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    status = 0
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['cases'], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            status = 1
+        else:
+            print(f"No regressions against {args.baseline}.")
+    if args.baseline and args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# Dark-frame and hot-pixel calibration.
+#
+# A master dark is the mean of a stack of frames taken with the camera
+# covered (or the MOT off) at one exposure. Pixels whose dark level stands
+# far above their immediate neighbours are flagged as hot. Masters are stored per
+# camera, exposure and frame size under Data/.calibration/ and loaded once
+# per session; applying one subtracts the dark in float32 and replaces every
+# hot pixel by its nearest good neighbour along the row.
+
+import os
+import logging
+import threading
+import cv2
+import numpy as np
+import RunStack
+
+log = logging.getLogger(__name__)
+
+# Frames averaged into a master dark
+DARK_FRAMES = 32
+
+# A pixel is hot when its dark level is this many robust standard deviations
+# above the median of its 3x3 neighbourhood
+HOT_PIXEL_SIGMA = 8.
+
+# Row offsets searched, nearest first, for a good pixel to replace a hot one
+_NEIGHBOURS = (-1, 1, -2, 2, -3, 3)
+
+class MasterFrame:
+    """Master dark and hot-pixel mask for one camera, exposure and frame size."""
+    def __init__(self, dark:np.ndarray, hotPixels:np.ndarray, path=None):
+        self.dark = np.ascontiguousarray(dark, dtype=np.float32)
+        self.hotPixels = hotPixels
+        self.path = path
+        self._hot, self._good = _replacements(hotPixels)
+
+    @property
+    def shape(self) -> tuple:
+        return self.dark.shape
+
+    def apply(self, image:np.ndarray, out:np.ndarray=None) -> np.ndarray:
+        """Dark-subtracted float32 frame (written into out if given) with its hot pixels patched in place."""
+        if image.shape != self.dark.shape:
+            raise ValueError(f"frame is {image.shape}, calibration is {self.dark.shape}")
+        out = np.subtract(image, self.dark, out=out, dtype=np.float32)
+        flat = out.reshape(-1)
+        flat[self._hot] = flat[self._good]
+        return out
+
+def _replacements(hotPixels:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    """Flat indices of the hot pixels and of the good pixel that replaces each one."""
+    height, width = hotPixels.shape
+    ys, xs = np.nonzero(hotPixels)
+    good = np.full(len(ys), -1, dtype=np.intp)
+    for dx in _NEIGHBOURS:
+        nx = xs + dx
+        todo = np.flatnonzero((good < 0) & (nx >= 0) & (nx < width))
+        todo = todo[~hotPixels[ys[todo], nx[todo]]]
+        good[todo] = ys[todo] * width + nx[todo]
+    # A pixel in a run of hot pixels too long to bridge is left as it is
+    keep = good >= 0
+    return ((ys * width + xs)[keep], good[keep])
+
+def buildMaster(frames) -> MasterFrame:
+    """Average an iterable of dark frames and flag the hot pixels."""
+    total = None
+    count = 0
+    for frame in frames:
+        if total is None:
+            total = np.zeros(frame.shape, dtype=np.float64)
+        total += frame
+        count += 1
+    if count == 0:
+        raise ValueError("no dark frames")
+    dark = (total / count).astype(np.float32)
+    # Comparing each pixel with its neighbours rather than with the whole
+    # sensor keeps smooth structure in a background frame from being flagged
+    excess = dark - cv2.medianBlur(dark, 3)
+    spread = 1.4826 * float(np.median(np.abs(excess)))
+    # Averaging leaves almost no spread on a clean sensor; never flag pixels
+    # less than a count above their neighbours
+    hotPixels = excess > HOT_PIXEL_SIGMA * max(spread, 1. / HOT_PIXEL_SIGMA)
+    return MasterFrame(dark, hotPixels)
+
+_loaded = {}
+_loadLock = threading.Lock()
+
+def load(path) -> MasterFrame:
+    """Master stored at path, read from disk once per process (and again only if the file changes)."""
+    mtime = os.stat(path).st_mtime_ns
+    with _loadLock:
+        cached = _loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with np.load(path) as data:
+        master = MasterFrame(data['dark'], data['hotPixels'], path)
+    with _loadLock:
+        _loaded[path] = (mtime, master)
+    return master
+
+class CalibrationStore:
+    """
+    Master frames on disk, one .npz file per camera, exposure and frame size.
+
+    Recall finds the master for a run from the file name recorded in its
+    frame stack index, or else from its exposure and frame size.
+    """
+    def __init__(self, calibrationDir):
+        self.calibrationDir = calibrationDir
+        os.makedirs(calibrationDir, exist_ok=True)
+
+    @staticmethod
+    def fileName(serial, exposureTime, shape) -> str:
+        return f"dark_{serial or 'camera'}_{float(exposureTime):g}us_{shape[1]}x{shape[0]}.npz"
+
+    def save(self, master:MasterFrame, serial, exposureTime) -> MasterFrame:
+        path = os.path.join(self.calibrationDir, self.fileName(serial, exposureTime, master.shape))
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, dark=master.dark, hotPixels=master.hotPixels)
+        os.replace(tmp, path)
+        master.path = path
+        return load(path)
+
+    def find(self, serial, exposureTime, shape) -> MasterFrame:
+        """Master for a camera, exposure and (height, width), or None if there is none yet."""
+        path = os.path.join(self.calibrationDir, self.fileName(serial, exposureTime, shape))
+        if os.path.exists(path):
+            return load(path)
+        suffix = self.fileName('', exposureTime, shape)[len('dark_camera'):]
+        others = [name for name in sorted(os.listdir(self.calibrationDir)) if name.startswith('dark_') and name.endswith(suffix)]
+        if serial:
+            # Another camera's dark pattern and hot pixels would subtract the
+            # wrong offsets and patch the wrong pixels
+            if others:
+                log.warning('No master dark for camera %s at %s us, not calibrating (%s is for another camera)', serial, exposureTime, others[0])
+            return None
+        # A run recorded before serials were kept is better off with a master
+        # of the same size and exposure than with none
+        return load(os.path.join(self.calibrationDir, others[0])) if others else None
+
+    def forRun(self, runDir) -> MasterFrame:
+        """Master matching a recorded run, or None (always for TIFF-only runs, which keep no exposure)."""
+        if not RunStack.RunStack.exists(runDir):
+            return None
+        index = RunStack.openStack(runDir).index
+        name = index.get('calibration')
+        if name is not None and os.path.exists(os.path.join(self.calibrationDir, name)):
+            return load(os.path.join(self.calibrationDir, name))
+        return self.find(index.get('camera', ''), index['exposureTime'], index['shape'][1:])
+
+def captureDarks(session, exposureTime, numFrames=DARK_FRAMES) -> MasterFrame:
+    """Free-run an open CameraSession at exposureTime and average numFrames complete frames."""
+    cam = session.cam
+    def frames():
+        taken = 0
+        while taken < numFrames:
+            image_result = cam.GetNextImage(10000)
+            try:
+                if not image_result.IsIncomplete():
+                    taken += 1
+                    yield image_result.GetNDArray()
+            finally:
+                image_result.Release()
+    with session.lock:
+        if not session.configureFreeRun(exposureTime):
+            return None
+        cam.BeginAcquisition()
+        try:
+            return buildMaster(frames())
+        finally:
+            cam.EndAcquisition()
+
+class DarkCapture(threading.Thread):
+    """Take and store a master dark at one exposure on every camera of a CameraRig."""
+    def __init__(self, rig, store, exposureTime, window, numFrames=DARK_FRAMES):
+        threading.Thread.__init__(self, daemon=True)
+        self.rig = rig
+        self.store = store
+        self.exposureTime = exposureTime
+        self.window = window
+        self.numFrames = numFrames
+
+    def run(self):
+        # Imported here so headless users of this module (recall, batch
+        # reprocessing) never load PySpin
+        from CameraSession import PySpin
+        sessions = self.rig.open()
+        if not sessions:
+            self.window.renderScheduler.showMessage("Error: Cannot find the camera!")
+            return
+        for session in sessions:
+            self.window.renderScheduler.showMessage(f"Taking {self.numFrames} dark frames on camera {session.serialNumber} at {self.exposureTime} us...")
+            try:
+                master = captureDarks(session, self.exposureTime, self.numFrames)
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                continue
+            if master is None:
+                continue
+            master = self.store.save(master, session.serialNumber, self.exposureTime)
+            log.info('Master dark for camera %s at %s us: mean %.1f counts, %d hot pixels, saved to %s', session.serialNumber, self.exposureTime, master.dark.mean(), int(master.hotPixels.sum()), master.path)
+        self.window.renderScheduler.showMessage("Dark frames saved.")
@@ -0,0 +1,301 @@
+import os
+import threading
+import logging
+# MOTTEMP_CAMERA=sim runs against the simulated camera in SimSpin.py
+if os.environ.get('MOTTEMP_CAMERA') == 'sim':
+    import SimSpin as PySpin
+else:
+    import PySpin
+
+log = logging.getLogger(__name__)
+
+class CameraSession:
+    """
+    Long-lived connection to one camera (the first by default), shared by every run.
+
+    The system instance, camera list and initialised camera are kept from
+    the first run until close(), and node handles and enumeration entries
+    are looked up once and cached. Settings are remembered as they are
+    applied, so a run only writes the nodes whose value actually changes
+    (typically just the exposure) instead of walking the whole trigger
+    configuration again.
+
+    A session created by a CameraRig uses the rig's system instance and
+    camera list instead of getting its own.
+    """
+    def __init__(self, index=0, rig=None):
+        self.index = index
+        self.rig = rig
+        self.lock = threading.RLock()
+        self.system = None
+        self.camList = None
+        self.cam = None
+        self.nodemap = None
+        self.nodemapTLDevice = None
+        self.streamNodemap = None
+        self.serialNumber = ''
+        self._nodes = {}
+        self._entries = {}
+        self._applied = {}
+
+    def isOpen(self) -> bool:
+        return self.cam is not None
+
+    def open(self) -> bool:
+        """Connect to and initialise the camera unless that has already been done."""
+        with self.lock:
+            if self.cam is not None:
+                return True
+            if self.rig is not None:
+                camList = self.rig.cameraList()
+            else:
+                self.system = PySpin.System.GetInstance()
+                version = self.system.GetLibraryVersion()
+                log.info('Library version: %d.%d.%d.%d', version.major, version.minor, version.type, version.build)
+                self.camList = camList = self.system.GetCameras()
+            if camList.GetSize() <= self.index:
+                log.error('Not enough cameras!')
+                self._release()
+                return False
+            try:
+                self.cam = camList.GetByIndex(self.index)
+                self.nodemapTLDevice = self.cam.GetTLDeviceNodeMap()
+                self.cam.Init()
+                self.nodemap = self.cam.GetNodeMap()
+                self.streamNodemap = self.cam.GetTLStreamNodeMap()
+                node = PySpin.CStringPtr(self.nodemapTLDevice.GetNode('DeviceSerialNumber'))
+                if PySpin.IsReadable(node):
+                    self.serialNumber = node.GetValue()
+                log.info('Camera %s initialised', self.serialNumber)
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                self.cam = None
+                self._release()
+                return False
+            return True
+
+    def close(self, timeout=5.):
+        """Put the camera back in free-running mode and release it and the system."""
+        # A run still holding the camera gets a few seconds to notice it was stopped
+        if not self.lock.acquire(timeout=timeout):
+            log.warning('Camera still in use, not releasing it')
+            return
+        try:
+            if self.cam is not None:
+                try:
+                    if self.cam.IsStreaming():
+                        self.cam.EndAcquisition()
+                    self.setEnum('TriggerMode', 'Off')
+                    self.cam.DeInit()
+                except PySpin.SpinnakerException as ex:
+                    log.error('Error: %s', ex)
+                del self.cam
+                self.cam = None
+            self._release()
+        finally:
+            self.lock.release()
+
+    def _release(self):
+        self._nodes.clear()
+        self._entries.clear()
+        self._applied.clear()
+        self.nodemap = self.nodemapTLDevice = self.streamNodemap = None
+        if self.camList is not None:
+            self.camList.Clear()
+            self.camList = None
+        if self.system is not None:
+            self.system.ReleaseInstance()
+            self.system = None
+
+    def node(self, name, stream=False):
+        """Enumeration node from the device (or stream) nodemap, resolved once."""
+        key = ('stream' if stream else 'device', name)
+        if key not in self._nodes:
+            nodemap = self.streamNodemap if stream else self.nodemap
+            self._nodes[key] = PySpin.CEnumerationPtr(nodemap.GetNode(name))
+        return self._nodes[key]
+
+    def entry(self, name, symbol, stream=False) -> int:
+        """Integer value of an enumeration entry, resolved once."""
+        key = ('stream' if stream else 'device', name, symbol)
+        if key not in self._entries:
+            node = self.node(name, stream)
+            if not PySpin.IsReadable(node):
+                raise PySpin.SpinnakerException(f'{name} is not readable')
+            entry = node.GetEntryByName(symbol)
+            if not PySpin.IsReadable(entry):
+                raise PySpin.SpinnakerException(f'{name} has no readable entry {symbol}')
+            self._entries[key] = entry.GetValue()
+        return self._entries[key]
+
+    def setEnum(self, name, symbol, stream=False) -> bool:
+        """Select an enumeration entry; returns True if the node had to be written."""
+        key = ('stream' if stream else 'device', name)
+        if self._applied.get(key) == symbol:
+            return False
+        node = self.node(name, stream)
+        if not PySpin.IsWritable(node):
+            raise PySpin.SpinnakerException(f'{name} is not writable')
+        node.SetIntValue(self.entry(name, symbol, stream))
+        self._applied[key] = symbol
+        log.debug('%s set to %s', name, symbol)
+        return True
+
+    def setInteger(self, name, value, stream=False) -> int:
+        """Write an integer node, clamped to its range, unless it already holds that value; returns the value set."""
+        key = ('stream' if stream else 'device', name)
+        if self._applied.get(key) == value:
+            return value
+        if key not in self._nodes:
+            nodemap = self.streamNodemap if stream else self.nodemap
+            self._nodes[key] = PySpin.CIntegerPtr(nodemap.GetNode(name))
+        node = self._nodes[key]
+        if not PySpin.IsWritable(node):
+            raise PySpin.SpinnakerException(f'{name} is not writable')
+        value = max(node.GetMin(), min(node.GetMax(), int(value)))
+        node.SetValue(value)
+        self._applied[key] = value
+        log.debug('%s set to %d', name, value)
+        return value
+
+    def lostFrames(self) -> int:
+        """Frames the stream has counted as lost in transport, or None if it does not report them."""
+        node = PySpin.CIntegerPtr(self.streamNodemap.GetNode('StreamLostFrameCount'))
+        if not PySpin.IsReadable(node):
+            return None
+        return node.GetValue()
+
+    def setExposure(self, exposureTime) -> bool:
+        if self._applied.get('ExposureTime') == float(exposureTime):
+            return False
+        if self.cam.ExposureTime.GetAccessMode() != PySpin.RW:
+            raise PySpin.SpinnakerException('Unable to set exposure time')
+        self.cam.ExposureTime.SetValue(float(exposureTime))
+        self._applied['ExposureTime'] = float(exposureTime)
+        log.info('Shutter time set to %s us...', exposureTime)
+        return True
+
+    def _setImageFormat(self, exposureTime):
+        if 'PixelFormat' not in self._applied:
+            if self.cam.PixelFormat.GetAccessMode() != PySpin.RW:
+                raise PySpin.SpinnakerException('Pixel format not available')
+            self.cam.PixelFormat.SetValue(PySpin.PixelFormat_Mono16)
+            self._applied['PixelFormat'] = 'Mono16'
+        if 'ExposureAuto' not in self._applied:
+            if self.cam.ExposureAuto.GetAccessMode() != PySpin.RW:
+                raise PySpin.SpinnakerException('Unable to disable automatic exposure')
+            self.cam.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
+            self._applied['ExposureAuto'] = 'Off'
+        if exposureTime is not None:
+            self.setExposure(exposureTime)
+
+    def configureTrigger(self, exposureTime, source, burst=0) -> int:
+        """
+        Set up Mono16, fixed exposure and triggered frame start from source
+        ('Software' or 'Line3'), writing only what differs from the last run.
+
+        With burst > 0 the camera is armed once for a burst-frame sequence:
+        MultiFrame acquisition of exactly that many frames and one stream
+        buffer per frame, handed out oldest first, so the whole sequence
+        fits in the driver even if it is read out late. Returns the number
+        of stream buffers reserved for the burst, 0 for a continuous
+        acquisition, or -1 if the camera could not be configured.
+        """
+        with self.lock:
+            try:
+                self._setImageFormat(exposureTime)
+                self.setEnum('StreamBufferHandlingMode', 'OldestFirst', stream=True)
+                key = ('trigger', 'source')
+                if self._applied.get(key) != source:
+                    # The trigger source can only be changed with trigger mode off
+                    self.setEnum('TriggerMode', 'Off')
+                    self.setEnum('TriggerSelector', 'FrameStart')
+                    self.setEnum('TriggerSource', source)
+                    self._applied[key] = source
+                self.setEnum('TriggerMode', 'On')
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                return -1
+            if burst > 0:
+                try:
+                    self.setEnum('AcquisitionMode', 'MultiFrame')
+                    self.setInteger('AcquisitionFrameCount', burst)
+                    self.setEnum('StreamBufferCountMode', 'Manual', stream=True)
+                    return self.setInteger('StreamBufferCountManual', burst, stream=True)
+                except PySpin.SpinnakerException as ex:
+                    log.warning('Burst mode unavailable, acquiring continuously: %s', ex)
+            try:
+                self.setEnum('AcquisitionMode', 'Continuous')
+                self.setEnum('StreamBufferCountMode', 'Auto', stream=True)
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                return -1
+            return 0
+
+    def configureFreeRun(self, exposureTime=None) -> bool:
+        """Set up continuous, untriggered acquisition that always delivers the newest frame."""
+        with self.lock:
+            try:
+                self._setImageFormat(exposureTime)
+                self.setEnum('AcquisitionMode', 'Continuous')
+                self.setEnum('StreamBufferCountMode', 'Auto', stream=True)
+                self.setEnum('StreamBufferHandlingMode', 'NewestOnly', stream=True)
+                self.setEnum('TriggerMode', 'Off')
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                return False
+            return True
+
+class CameraRig:
+    """
+    Every connected camera, each in its own CameraSession.
+
+    The cameras share one system instance and camera list, which the rig
+    gets on first use and releases in close(). Each session keeps its own
+    lock, so one camera can be acquiring while another is being set up.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.system = None
+        self.camList = None
+        self.sessions = []
+
+    def cameraList(self):
+        with self.lock:
+            if self.camList is None:
+                self.system = PySpin.System.GetInstance()
+                version = self.system.GetLibraryVersion()
+                log.info('Library version: %d.%d.%d.%d', version.major, version.minor, version.type, version.build)
+                self.camList = self.system.GetCameras()
+                log.info('%d cameras detected', self.camList.GetSize())
+            return self.camList
+
+    def session(self, index=0) -> CameraSession:
+        """Session for the camera at index in the camera list, created on first use."""
+        with self.lock:
+            while len(self.sessions) <= index:
+                self.sessions.append(CameraSession(len(self.sessions), self))
+            return self.sessions[index]
+
+    def open(self) -> list:
+        """Open every connected camera; returns the sessions that could be opened."""
+        with self.lock:
+            count = self.cameraList().GetSize()
+            if count == 0:
+                log.error('Not enough cameras!')
+            return [s for s in (self.session(i) for i in range(count)) if s.open()]
+
+    def close(self, timeout=5.):
+        """Close every session, then release the camera list and the system."""
+        with self.lock:
+            for session in self.sessions:
+                session.close(timeout)
+            if any(s.isOpen() for s in self.sessions):
+                return
+            self.sessions = []
+            if self.camList is not None:
+                self.camList.Clear()
+                self.camList = None
+            if self.system is not None:
+                self.system.ReleaseInstance()
+                self.system = None
@@ -0,0 +1,218 @@
+# Batched closed-form Gaussian fitting.
+#
+# Fits amp * exp(-((x-cen)/wid)**2) + off (the model used by MotTemp and
+# Trigger) to a whole stack of 1-D profiles in one vectorised call:
+# moment / half-maximum initialisation followed by a batched, damped
+# Gauss-Newton (Levenberg-Marquardt) iteration over all profiles at once.
+# Profiles that do not converge are handed back to a fallback fitter
+# (normally lmfit), so callers always get a result.
+#
+# Run as a script to see how far the fast path is from lmfit on a run:
+#
+#   python GaussFit.py Data/2024/06/24/Run3/ --sigma 2
+
+import argparse
+import sys
+import numpy as np
+
+PARAMS = ('amp', 'cen', 'wid', 'off')
+
+def _pad(profiles:list, positions:list) -> tuple:
+    """Stack ragged profiles into (N, L) arrays plus a validity mask."""
+    n = len(profiles)
+    length = max((len(p) for p in profiles), default=0)
+    y = np.zeros((n, length), dtype=np.float64)
+    x = np.zeros((n, length), dtype=np.float64)
+    mask = np.zeros((n, length), dtype=np.float64)
+    for i in range(n):
+        k = len(profiles[i])
+        y[i, :k] = profiles[i]
+        x[i, :k] = positions[i]
+        mask[i, :k] = 1.
+        if 0 < k < length:
+            # Padding repeats the last position so it never dominates the scaling
+            x[i, k:] = x[i, k-1]
+    return (x, y, mask)
+
+def _model(p:np.ndarray, x:np.ndarray) -> tuple:
+    amp, cen, wid, off = (p[:, i:i+1] for i in range(4))
+    u = (x - cen) / wid
+    e = np.exp(-u**2)
+    f = amp * e + off
+    jac = np.empty(x.shape + (4,))
+    jac[..., 0] = e
+    jac[..., 1] = amp * e * 2 * u / wid
+    jac[..., 2] = amp * e * 2 * u**2 / wid
+    jac[..., 3] = 1.
+    return (f, jac)
+
+def initialGuess(x:np.ndarray, y:np.ndarray, mask:np.ndarray) -> np.ndarray:
+    """Moment and half-maximum starting values for every profile, shape (N, 4)."""
+    big = np.where(mask > 0, y, np.inf)
+    off = big.min(axis=1)
+    off[~np.isfinite(off)] = 0.
+    peak = np.argmax(np.where(mask > 0, y, -np.inf), axis=1)
+    rows = np.arange(len(y))
+    amp = y[rows, peak] - off
+    signal = np.clip(y - off[:, None], 0, None) * mask
+    total = signal.sum(axis=1)
+    total[total == 0] = 1.
+    cen = (signal * x).sum(axis=1) / total
+    # Width from the number of samples above half maximum; for the
+    # exp(-(x/wid)^2) model FWHM = 2 * sqrt(ln 2) * wid
+    step = np.abs(x[:, 1] - x[:, 0]) if x.shape[1] > 1 else np.ones(len(x))
+    above = ((signal >= 0.5 * amp[:, None]) & (mask > 0)).sum(axis=1)
+    wid = np.maximum(above, 1) * step / (2 * np.sqrt(np.log(2)))
+    wid[wid == 0] = 1.
+    return np.stack([amp, cen, wid, off], axis=1)
+
+def fitGaussians(profiles:list, positions:list, maxIter:int=100, tol:float=1e-10) -> tuple:
+    """
+    Fit the Gaussian model to every profile at once.
+
+    Returns (params, converged): params is (N, 4) in PARAMS order, converged
+    a boolean array marking profiles whose fit reached tol within maxIter.
+    """
+    n = len(profiles)
+    if n == 0:
+        return (np.zeros((0, 4)), np.zeros(0, dtype=bool))
+    x, y, mask = _pad(profiles, positions)
+
+    # Work in normalised units so amplitudes of ~1e4 and widths of ~1e-3 m
+    # give a well-conditioned normal matrix
+    counts = np.maximum(mask.sum(axis=1), 1)
+    xm = (x * mask).sum(axis=1) / counts
+    xs = np.sqrt((((x - xm[:, None]) * mask)**2).sum(axis=1) / counts)
+    xs[xs == 0] = 1.
+    ys = np.abs(y * mask).max(axis=1)
+    ys[ys == 0] = 1.
+    xn = (x - xm[:, None]) / xs[:, None]
+    yn = y / ys[:, None]
+
+    p = initialGuess(xn, yn, mask)
+    f, jac = _model(p, xn)
+    r = (f - yn) * mask
+    cost = (r**2).sum(axis=1)
+    lam = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    # Fits whose damping ran away without an accepted step; they stop iterating
+    # but are left unconverged so the caller can refit them
+    stalled = np.zeros(n, dtype=bool)
+    eye = np.eye(4)
+
+    for _ in range(maxIter):
+        active = ~(converged | stalled)
+        if not active.any():
+            break
+        jm = jac * mask[..., None]
+        jtj = np.einsum('nli,nlj->nij', jm, jm)
+        grad = np.einsum('nli,nl->ni', jm, r)
+        damped = jtj + (lam[:, None, None] * np.diagonal(jtj, axis1=1, axis2=2)[:, :, None] + 1e-12) * eye
+        try:
+            delta = np.linalg.solve(damped, -grad[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('nij,nj->ni', np.linalg.pinv(damped), -grad)
+        delta[~active] = 0.
+
+        trial = p + delta
+        ftrial, jtrial = _model(trial, xn)
+        rtrial = (ftrial - yn) * mask
+        costTrial = (rtrial**2).sum(axis=1)
+        better = active & np.isfinite(costTrial) & (costTrial <= cost)
+
+        relChange = np.abs(cost - costTrial) / np.maximum(cost, 1e-300)
+        stepSmall = np.abs(delta).max(axis=1) <= tol * (np.abs(p).max(axis=1) + tol)
+        converged |= better & ((relChange < tol) | stepSmall)
+        stalled |= active & ~better & (lam > 1e10)
+
+        p[better] = trial[better]
+        r[better] = rtrial[better]
+        jac[better] = jtrial[better]
+        cost[better] = costTrial[better]
+        lam = np.where(better, np.maximum(lam / 3, 1e-12), np.where(active, lam * 4, lam))
+
+    converged &= np.isfinite(p).all(axis=1) & (p[:, 2] != 0)
+    out = np.empty_like(p)
+    out[:, 0] = p[:, 0] * ys
+    out[:, 1] = p[:, 1] * xs + xm
+    out[:, 2] = np.abs(p[:, 2]) * xs
+    out[:, 3] = p[:, 3] * ys
+    return (out, converged)
+
+def fitProfiles(profiles:list, positions:list, fallback=None) -> tuple:
+    """
+    Batched fit returning one best-values dict per profile, like lmfit's out.best_values.
+
+    Profiles the fast path could not fit are passed to fallback(i) when one
+    is given; its width is made positive like the fast path's. Returns
+    (bestValues, fallbackCount).
+    """
+    params, converged = fitGaussians(profiles, positions)
+    results = []
+    fallbacks = 0
+    for i in range(len(profiles)):
+        if not converged[i] and fallback is not None:
+            values = dict(fallback(i))
+            values['wid'] = abs(values['wid'])
+            results.append(values)
+            fallbacks += 1
+        else:
+            results.append(dict(zip(PARAMS, (float(v) for v in params[i]))))
+    return (results, fallbacks)
+
+def compareWithLmfit(profiles:list, positions:list, lmfitFit) -> dict:
+    """
+    Fit the profiles with both engines and report the differences.
+
+    lmfitFit(profile, position) must return lmfit best values. The result
+    holds, for each parameter, the largest absolute and relative difference,
+    the number of profiles the fast path left to the fallback, and the number
+    where lmfit stopped in a clearly worse minimum than the fast path.
+    """
+    params, converged = fitGaussians(profiles, positions)
+    report = {'profiles': len(profiles), 'fallbacks': int((~converged).sum())}
+    slow = [lmfitFit(profiles[i], positions[i]) for i in range(len(profiles))]
+    lmfitWorse = 0
+    for i in range(len(profiles)):
+        x = np.asarray(positions[i], dtype=np.float64)
+        y = np.asarray(profiles[i], dtype=np.float64)
+        fast = _model(params[i:i+1], x[None, :])[0][0]
+        s = slow[i]
+        lm = s['amp'] * np.exp(-((x - s['cen']) / s['wid'])**2) + s['off']
+        if np.sum((lm - y)**2) > 1.01 * np.sum((fast - y)**2):
+            lmfitWorse += 1
+    report['lmfitWorse'] = lmfitWorse
+    for k, name in enumerate(PARAMS):
+        a = params[:, k]
+        b = np.array([s[name] for s in slow])
+        if name == 'wid':
+            # The model is even in wid; lmfit may land on either sign
+            b = np.abs(b)
+        diff = np.abs(a - b)
+        scale = np.maximum(np.abs(b), 1e-300)
+        report[name] = {'maxAbs': float(diff.max(initial=0.)), 'maxRel': float((diff / scale).max(initial=0.))}
+    return report
+
+def main(argv=None):
+    import MotTemp
+    import RunStack
+
+    parser = argparse.ArgumentParser(description="Compare the batched Gaussian fitter with lmfit on a run.")
+    parser.add_argument('run', help="RunN directory")
+    parser.add_argument('--sigma', type=int, default=1, help="ROI sigma factor")
+    args = parser.parse_args(argv)
+
+    runDir = args.run if args.run.endswith('/') else args.run + '/'
+    timeSplit = RunStack.runTimeSplit(runDir)
+    results = [MotTemp.profileImage(s, args.sigma) for s in RunStack.frameSources(runDir, timeSplit)]
+    for axis in ('x', 'y'):
+        profiles = [getattr(r, f'roi_{axis}') for r in results]
+        positions = [MotTemp.toMetres(getattr(r, f'{axis}_pos')) for r in results]
+        report = compareWithLmfit(profiles, positions, MotTemp.fitProfileLmfit)
+        print(f"{axis}-axis: {report['profiles']} profiles, {report['fallbacks']} need the lmfit fallback, lmfit worse on {report['lmfitWorse']}")
+        for name in PARAMS:
+            print(f"  {name}: max |diff| {report[name]['maxAbs']:.3e}, max rel diff {report[name]['maxRel']:.3e}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
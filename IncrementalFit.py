@@ -0,0 +1,109 @@
+import math
+import threading
+import numpy as np
+from MotTemp import TEMPERATURE_FACTOR
+
+class PolyAccumulator:
+    """
+    Least-squares polynomial fit updated one point at a time.
+
+    Only the normal equations (X^T X, X^T y, y^T y) are kept, so adding a
+    point costs O(degree^2) regardless of how many points came before, and
+    the coefficients and their covariance are available at any time.
+    Abscissae are scaled by xScale internally to keep the sums well
+    conditioned; the returned coefficients are in the caller's units.
+    """
+    def __init__(self, degree, xScale=1.):
+        self.degree = degree
+        self.xScale = xScale
+        self.n = 0
+        self._xtx = np.zeros((degree+1, degree+1))
+        self._xty = np.zeros(degree+1)
+        self._yty = 0.
+
+    def add(self, x, y):
+        row = (x * self.xScale) ** np.arange(self.degree, -1, -1)
+        self._xtx += np.outer(row, row)
+        self._xty += row * y
+        self._yty += y * y
+        self.n += 1
+
+    def solve(self):
+        """(coefficients highest power first, covariance), or None until there are enough points."""
+        p = self.degree + 1
+        if self.n < p:
+            return None
+        try:
+            inv = np.linalg.inv(self._xtx)
+        except np.linalg.LinAlgError:
+            return None
+        coef = inv @ self._xty
+        if self.n > p:
+            ssr = max(0., self._yty - coef @ self._xty)
+            cov = inv * (ssr / (self.n - p))
+        else:
+            cov = np.full((p, p), np.nan)
+        # Undo the abscissa scaling: c_k multiplies (x*s)^k
+        unscale = self.xScale ** np.arange(self.degree, -1, -1)
+        return (coef * unscale, cov * np.outer(unscale, unscale))
+
+class TemperatureEstimate:
+    """
+    Running g and x/y temperature estimates from per-frame Gaussian fits.
+
+    Mirrors MotTemp.fitRun: a quadratic in TOF for the centres, a straight
+    line for the x width and sqrt(s0^2 + sv^2 t^2) for the y width (fitted as
+    a line in t^2 against width^2). Values are in metres and seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # TOFs are a few ms; scale to ms so the power sums stay well conditioned
+        self.xCentre = PolyAccumulator(2, 1000.)
+        self.yCentre = PolyAccumulator(2, 1000.)
+        self.xSigma = PolyAccumulator(1, 1000.)
+        self.ySigmaSq = PolyAccumulator(1, 1000.**2)
+
+    def add(self, tof, xcen, xwid, ycen, ywid):
+        with self._lock:
+            self.xCentre.add(tof, xcen)
+            self.yCentre.add(tof, ycen)
+            self.xSigma.add(tof, abs(xwid))
+            self.ySigmaSq.add(tof**2, ywid**2)
+
+    def result(self) -> dict:
+        with self._lock:
+            out = {'n': self.xSigma.n}
+            fit = self.yCentre.solve()
+            if fit is not None:
+                out['g'] = float(2 * fit[0][0])
+                out['gErr'] = 2 * math.sqrt(fit[1][0][0]) if fit[1][0][0] >= 0 else math.nan
+            fit = self.xSigma.solve()
+            if fit is not None:
+                slope, slopeVar = fit[0][0], fit[1][0][0]
+                out['xTemp'] = float(TEMPERATURE_FACTOR * slope**2)
+                out['xTempErr'] = float(2 * TEMPERATURE_FACTOR * abs(slope) * math.sqrt(slopeVar)) if slopeVar >= 0 else math.nan
+            fit = self.ySigmaSq.solve()
+            # A non-positive sv^2 has no physical temperature; leave T_y out
+            # until enough frames pull the fit back above zero
+            if fit is not None and fit[0][0] > 0:
+                svSq, svSqVar = fit[0][0], fit[1][0][0]
+                out['yTemp'] = float(TEMPERATURE_FACTOR * svSq)
+                out['yTempErr'] = TEMPERATURE_FACTOR * math.sqrt(svSqVar) if svSqVar >= 0 else math.nan
+            return out
+
+    def text(self) -> str:
+        r = self.result()
+        parts = [f"{r['n']} frames"]
+        if 'xTemp' in r:
+            parts.append(f"T_x = {_withError(r['xTemp']*1e6, r['xTempErr']*1e6, 1)} µK")
+        if 'yTemp' in r:
+            parts.append(f"T_y = {_withError(r['yTemp']*1e6, r['yTempErr']*1e6, 1)} µK")
+        if 'g' in r:
+            parts.append(f"g = {_withError(r['g'], r['gErr'], 2)} m/s^2")
+        return " | ".join(parts)
+
+def _withError(value, error, digits) -> str:
+    # No uncertainty until there are more points than fit parameters
+    if math.isfinite(error):
+        return f"{value:.{digits}f} ± {error:.{digits}f}"
+    return f"{value:.{digits}f}"
@@ -0,0 +1,231 @@
+# Central scheduler for the long-running work started from the GUI.
+#
+# Every acquisition, live view, dark capture and recall analysis is a Job
+# submitted here instead of a bare thread. Jobs run in one of two lanes,
+# each running one job at a time in its own thread:
+#
+#   camera    acquisition runs, dark frames and the live view, which all
+#             need the cameras to themselves
+#   analysis  recalls and other re-analysis of recorded runs
+#
+# Acquisition never waits on analysis: its lane is separate, and analysis
+# jobs are held back, both before they start and at every checkpoint while
+# they run, as long as an acquisition is queued or running. A second press
+# of Run while the cameras are busy is turned away; analysis jobs queue up
+# to MAX_QUEUED deep. Cancelling is cooperative: a queued job is simply
+# dropped, a running one is told through its cancel hook (e.g. a thread's
+# stop()) or sees Cancelled raised at its next checkpoint().
+
+import heapq
+import itertools
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Job priorities, most urgent first
+ACQUISITION = 0
+LIVE_VIEW = 1
+ANALYSIS = 2
+
+CAMERA = 'camera'
+ANALYSIS_LANE = 'analysis'
+
+# Analysis jobs allowed to wait in the queue at once
+MAX_QUEUED = 4
+
+class Cancelled(Exception):
+    """Raised by Job.checkpoint() once the job has been cancelled."""
+
+class Job:
+    """
+    One unit of work: work(job) run on a thread of its own.
+
+    Long work calls job.checkpoint() between steps so it can be paused for
+    acquisition and cancelled. Work that cannot poll (a camera loop waiting
+    on frames) is given a cancel hook instead, called once when the job is
+    cancelled while running.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+
+    def __init__(self, name, work, priority, lane, cancel=None):
+        self.name = name
+        self.work = work
+        self.priority = priority
+        self.lane = lane
+        self.state = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.scheduler = None
+        self._cancelHook = cancel
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def checkpoint(self):
+        """Raise Cancelled if the job was cancelled, after waiting out any acquisition that holds its lane."""
+        if self.cancelled:
+            raise Cancelled(self.name)
+        if self.scheduler is not None:
+            self.scheduler._waitWhileHeld(self)
+        if self.cancelled:
+            raise Cancelled(self.name)
+
+    def wait(self, timeout=None) -> bool:
+        """Block until the job has finished, failed or been cancelled; False on timeout."""
+        return self._finished.wait(timeout)
+
+    def __repr__(self):
+        return f"<Job {self.name!r} {self.state}>"
+
+class JobScheduler:
+    """
+    Runs Jobs by priority in the camera and analysis lanes.
+
+    report(message), e.g. RenderScheduler.showMessage, is told about jobs
+    that are turned away, queued, cancelled or failed.
+    """
+    def __init__(self, report=None):
+        self.report = report
+        self._cond = threading.Condition()
+        self._queued = []
+        self._running = {}
+        self._threads = []
+        self._sequence = itertools.count()
+
+    def submit(self, name, work, priority=ANALYSIS, cancel=None, reject=False) -> Job:
+        """
+        Queue work(job) and start it as soon as its lane allows.
+
+        With reject, the job is turned away (None is returned) while a job of
+        the same or higher priority is queued or running in its lane; jobs of
+        lower priority only delay it until they stop.
+        """
+        lane = ANALYSIS_LANE if priority >= ANALYSIS else CAMERA
+        job = Job(name, work, priority, lane, cancel)
+        job.scheduler = self
+        with self._cond:
+            ahead = [j for j in self._jobs(lane) if j.priority <= priority]
+            if reject and ahead:
+                self._report(f"{name} not started: {ahead[0].name} is {ahead[0].state}.")
+                return None
+            if lane == ANALYSIS_LANE and sum(1 for _, _, j in self._queued if j.lane == lane) >= MAX_QUEUED:
+                self._report(f"{name} not started: {MAX_QUEUED} analysis jobs are already waiting.")
+                return None
+            heapq.heappush(self._queued, (priority, next(self._sequence), job))
+            self._dispatch()
+            if job.state == Job.QUEUED:
+                self._report(f"{name} queued.")
+        return job
+
+    def cancel(self, job:Job):
+        """Drop a queued job, or ask a running one to stop."""
+        with self._cond:
+            if job.state == Job.QUEUED:
+                self._queued = [entry for entry in self._queued if entry[2] is not job]
+                heapq.heapify(self._queued)
+                job._cancelled.set()
+                job.state = Job.CANCELLED
+                job._finished.set()
+                self._report(f"{job.name} cancelled.")
+                self._dispatch()
+                return
+            if job.state != Job.RUNNING or job.cancelled:
+                return
+            job._cancelled.set()
+            # Wake the job if it is held at a checkpoint
+            self._cond.notify_all()
+        if job._cancelHook is not None:
+            job._cancelHook()
+
+    def cancelAll(self, lane=None):
+        """Cancel every queued and running job (in one lane if given)."""
+        with self._cond:
+            jobs = self._jobs(lane)
+        # Queued ones first, so nothing starts in the gap a stopped job leaves
+        for job in sorted(jobs, key=lambda j: j.state != Job.QUEUED):
+            self.cancel(job)
+
+    def running(self, lane) -> Job:
+        with self._cond:
+            return self._running.get(lane)
+
+    def jobs(self) -> list:
+        """Running jobs followed by the queued ones in the order they will start."""
+        with self._cond:
+            return list(self._running.values()) + [entry[2] for entry in sorted(self._queued)]
+
+    def shutdown(self, timeout=5.):
+        """Cancel everything and give the running jobs timeout seconds to stop."""
+        self.cancelAll()
+        for thread in list(self._threads):
+            thread.join(timeout)
+
+    def _jobs(self, lane=None) -> list:
+        running = [j for l, j in self._running.items() if lane is None or l == lane]
+        return running + [entry[2] for entry in sorted(self._queued) if lane is None or entry[2].lane == lane]
+
+    def _held(self, job:Job) -> bool:
+        """Whether an analysis job has to wait for an acquisition."""
+        return job.lane == ANALYSIS_LANE and any(j.priority == ACQUISITION for j in self._jobs(CAMERA))
+
+    def _waitWhileHeld(self, job:Job):
+        with self._cond:
+            if self._held(job):
+                self._report(f"{job.name} paused for acquisition.")
+                self._cond.wait_for(lambda: job.cancelled or not self._held(job))
+
+    def _dispatch(self):
+        """Start the most urgent queued job of every idle lane; called with the lock held."""
+        for lane in (CAMERA, ANALYSIS_LANE):
+            if lane in self._running:
+                continue
+            for entry in sorted(self._queued):
+                job = entry[2]
+                if job.lane != lane:
+                    continue
+                if self._held(job):
+                    break
+                self._queued.remove(entry)
+                heapq.heapify(self._queued)
+                job.state = Job.RUNNING
+                self._running[lane] = job
+                thread = threading.Thread(target=self._run, args=(job,), name=job.name, daemon=True)
+                self._threads.append(thread)
+                thread.start()
+                break
+        # Held analysis jobs may now be free to continue
+        self._cond.notify_all()
+
+    def _run(self, job:Job):
+        try:
+            job.result = job.work(job)
+            job.state = Job.CANCELLED if job.cancelled else Job.DONE
+        except Cancelled:
+            job.state = Job.CANCELLED
+        except Exception as ex:
+            job.state = Job.FAILED
+            job.error = ex
+            log.error('Error in %s: %s', job.name, ex)
+            self._report(f"Error: {job.name} failed: {ex}")
+        if job.state == Job.CANCELLED:
+            self._report(f"{job.name} cancelled.")
+        with self._cond:
+            self._running.pop(job.lane, None)
+            self._threads = [t for t in self._threads if t is not threading.current_thread()]
+            job._finished.set()
+            self._dispatch()
+
+    def _report(self, message):
+        if self.report is not None:
+            self.report(message)
@@ -0,0 +1,83 @@
+# Per-frame cloud metrics from the live view, for watching the MOT while
+# aligning it.
+#
+# Every live frame adds one row (time, frame ID, centre, width and peak
+# amplitude of the cloud) to a MetricsRing: a preallocated NumPy array used
+# as a ring buffer, so appending is O(1) and a session of any length holds
+# at most RING_CAPACITY rows. The strip chart (AcquireAndDisplay.StripChart)
+# reads it at its own pace; dump() writes the rows held to a CSV file.
+
+import threading
+import time
+import numpy as np
+import MotTemp
+
+FIELDS = ('time', 'frameId', 'centreX', 'centreY', 'widthX', 'widthY', 'amplitude')
+
+# Rows kept: ten minutes at 60 frames/s, about 2 MiB
+RING_CAPACITY = 36000
+
+def frameMetrics(image:np.ndarray) -> tuple[float,float,float,float,float]:
+    """Centre and width (pixels) and peak amplitude (counts) of the cloud in a frame."""
+    peakX, peakY, stdx, stdy = MotTemp.locateCloud(image)
+    return (peakX, peakY, stdx, stdy, float(image[peakY, peakX]))
+
+class MetricsRing:
+    """
+    Fixed-size ring buffer of per-frame metrics, one FIELDS row per frame.
+
+    append() is called from the acquisition thread and never allocates;
+    the read methods return copies in time order, so readers on other
+    threads never see a row half written.
+    """
+    def __init__(self, capacity=RING_CAPACITY):
+        self.data = np.full((capacity, len(FIELDS)), np.nan)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+        # Rows ever appended, so a reader can tell whether anything is new
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def append(self, frameId, centreX, centreY, widthX, widthY, amplitude, timestamp=None):
+        with self._lock:
+            self.data[self.head] = (time.time() if timestamp is None else timestamp, frameId, centreX, centreY, widthX, widthY, amplitude)
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.total += 1
+
+    def record(self, image:np.ndarray, frameId=-1):
+        """Append the metrics of a frame."""
+        self.append(frameId, *frameMetrics(image))
+
+    def latest(self, n=None) -> np.ndarray:
+        """The newest n rows (all rows held by default), oldest first."""
+        with self._lock:
+            n = self.count if n is None else min(n, self.count)
+            start = (self.head - n) % self.capacity
+            if start + n <= self.capacity:
+                return self.data[start:start + n].copy()
+            return np.concatenate((self.data[start:], self.data[:self.head]))
+
+    def since(self, timestamp) -> np.ndarray:
+        """Rows taken at or after timestamp (time.time() seconds), oldest first."""
+        with self._lock:
+            # Rows are in time order around the ring, so the newest ones are
+            # found without copying the whole buffer
+            n = 0
+            while n < self.count and self.data[(self.head - n - 1) % self.capacity, 0] >= timestamp:
+                n = min(self.count, max(2*n, 64))
+            n = min(n, self.count)
+        rows = self.latest(n)
+        return rows[np.searchsorted(rows[:, 0], timestamp):]
+
+    def clear(self):
+        with self._lock:
+            self.head = 0
+            self.count = 0
+
+    def dump(self, path) -> int:
+        """Write the rows held to a CSV file; returns how many were written."""
+        rows = self.latest()
+        np.savetxt(path, rows, delimiter=',', header=','.join(FIELDS), comments='', fmt=['%.6f', '%d'] + ['%.3f']*(len(FIELDS) - 2))
+        return len(rows)
@@ -1,10 +1,49 @@
+import os
+import logging
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import math
+from typing import NamedTuple
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from lmfit.models import QuadraticModel, LinearModel
 import lmfit as lm
-from PyQt6.QtGui import QTextDocument
+import RunStack
+import GaussFit
+import Calibration
+import Trace
+
+log = logging.getLogger(__name__)
+
+PIXELS_PER_MM = 17.62
+
+# Fit the per-image profiles with the batched GaussFit engine (lmfit is only
+# used for profiles it cannot fit); False fits every profile with lmfit.
+USE_BATCHED_FIT = True
+
+# Find the cloud on a subsampled copy of the frame and measure it at full
+# resolution only in a window around it (see locateCloud); False always
+# searches the whole frame.
+USE_COARSE_LOCATOR = True
+# Largest side of the subsampled level the coarse search runs on
+COARSE_SIZE = 256
+# The coarse peak must stand this many noise levels above the background of
+# its projection, and no other peak may reach this fraction of its height
+COARSE_MIN_SNR = 8.
+COARSE_MAX_SECONDARY = 0.5
+# Half-width of the full-resolution window, in coarse cloud sigmas
+WINDOW_SIGMAS = 4.
+
+# Bumped whenever a change to the analysis changes its results (2: coarse
+# cloud locator), so the AnalysisCache never returns older results
+ANALYSIS_VERSION = 2
+
+# 0.5 * m / k_B, turns an expansion velocity in m/s into a temperature in K
+TEMPERATURE_FACTOR = 0.5 * ((1.44 * math.pow(10,-25))/(1.38 * math.pow(10,-23)))
+
+def analysisSettings() -> tuple:
+    """Analysis version and the settings its results depend on, part of every AnalysisCache key."""
+    return (ANALYSIS_VERSION, USE_COARSE_LOCATOR, COARSE_SIZE, COARSE_MIN_SNR, COARSE_MAX_SECONDARY, WINDOW_SIGMAS, USE_BATCHED_FIT)
 
 def Gaussian(x, amp, cen, wid, off):
     """1-d Gaussian: gaussian(x, amp, cen, wid, off)"""
@@ -13,83 +52,195 @@ def Gaussian(x, amp, cen, wid, off):
 def Hyperbolic(x, s0, sv):
     return np.sqrt(s0**2 + (sv**2 * x**2))
 
-def main(baseDir, numImages, window, timeSplit, sigmaFactor):
-    fileArr = []
+def main(baseDir, numImages, window, timeSplit, sigmaFactor, numWorkers=1, cache=None, calibrations=None, catalog=None, job=None):
+    """
+    Analyse a recorded run (every camera of it) and show the result. Run as
+    a JobScheduler job, the analysis stops at the next image once job is
+    cancelled and waits between images while an acquisition runs.
+    """
+    def checkpoint(done, total):
+        if job is not None:
+            job.checkpoint()
+
+    def progress(done, total):
+        checkpoint(done, total)
+        window.renderScheduler.showMessage(f"Processed image {done} of {total}...")
+
+    window.renderScheduler.showMessage(f"Processing {numImages} images...")
+    start = Trace.now()
+    dirs = cameraDirs(baseDir)
+    if len(dirs) > 1:
+        # Cameras are analysed side by side, sharing the worker processes
+        workers = max(1, numWorkers // len(dirs))
+        with ThreadPoolExecutor(len(dirs)) as executor:
+            futures = {name: executor.submit(analyseRun, path, timeSplit[:numImages], sigmaFactor, workers, cache, checkpoint, calibrations) for name, path in dirs.items()}
+            fits = {name: future.result() for name, future in futures.items()}
+        if catalog is not None:
+            for name, fit in fits.items():
+                catalog.recordAnalysis(dirs[name], sigmaFactor, fit)
+        combined = combineRuns(fits)
+        window.renderScheduler.post(window.analysisWidget, lambda: showCombined(window, combined), key='run')
+    else:
+        fit = analyseRun(baseDir, timeSplit[:numImages], sigmaFactor, numWorkers, cache, progress, calibrations)
+        if catalog is not None:
+            catalog.recordAnalysis(baseDir, sigmaFactor, fit)
+        window.renderScheduler.post(window.analysisWidget, lambda: showRun(window, fit), key='run')
+    window.renderScheduler.setText(window.timingText, Trace.summaryText(start))
+    window.renderScheduler.showMessage("Processing finished.")
+
+def mainFromFrames(baseDir, window, timeSplit, sigmaFactor, results:list, cache=None, show=True, calibration=None) -> dict:
+    """
+    Post-run step for frames that were already profiled and fitted during
+    acquisition (see analyseFrame): only the physics fits are left, so
+    nothing is read back from disk. show=False leaves plotting the returned
+    fit to the caller; calibration is the path of the master frame the
+    frames were corrected with.
+    """
+    window.renderScheduler.showMessage(f"Fitting {len(results)} images...")
+    fit = fitRun(timeSplit, results)
+    if cache is not None:
+        # Recalling this run later should not have to profile it again
+        sources = RunStack.frameSources(baseDir, timeSplit)
+        for source, tof, result in zip(sources, timeSplit, results):
+            cache.put(cache.imageKey(source, sigmaFactor, tof, calibration), result)
+        cache.flush()
+    if show:
+        window.renderScheduler.post(window.analysisWidget, lambda: showRun(window, fit), key='run')
+        window.renderScheduler.showMessage("Processing finished.")
+    return fit
+
+def cameraDirs(baseDir) -> dict:
+    """{camera serial: directory} of a run; a multi-camera run keeps each camera's frames in a Cam<serial>/ subdirectory."""
+    names = sorted(d for d in os.listdir(baseDir) if d.startswith('Cam') and os.path.isdir(f"{baseDir}{d}")) if os.path.isdir(baseDir) else []
+    if not names:
+        return {'': baseDir}
+    return {name[3:]: f"{baseDir}{name}/" for name in names}
+
+def combineRuns(fits:dict) -> dict:
+    """
+    Combine the fitRun results of cameras imaging the same cloud along
+    different axes. Every camera has gravity along its y axis, so g and the
+    vertical temperature are averaged over the cameras; each camera's x axis
+    is a different horizontal direction, so its temperature is kept per
+    camera. The overall temperature is the mean over all of those axes.
+    """
+    gravity = float(np.mean([f['gravity'] for f in fits.values()]))
+    yTemp = float(np.mean([f['yTemp'] for f in fits.values()]))
+    xTemps = {name: f['xTemp'] for name, f in fits.items()}
+    temp = float(np.mean([yTemp] + list(xTemps.values())))
+    runningString = f"Combined Results ({len(fits)} cameras):\ng: {gravity}m/s^2\nY-Axis Temperature: {yTemp}K\n"
+    for name, xTemp in xTemps.items():
+        runningString += f"X-Axis Temperature (camera {name}): {xTemp}K\n"
+    runningString += f"Mean Temperature: {temp}K\n\n"
+    for name, f in fits.items():
+        runningString += f"Camera {name}\n{f['text']}\n\n"
+    return {'cameras': fits, 'gravity': gravity, 'yTemp': yTemp, 'xTemps': xTemps, 'temperature': temp, 'text': runningString}
+
+def repeatValues(result:dict) -> dict:
+    """g and the temperatures of one repetition, from a fitRun or combineRuns result."""
+    if 'cameras' in result:
+        xTemp = float(np.mean(list(result['xTemps'].values())))
+        return {'gravity': result['gravity'], 'xTemp': xTemp, 'yTemp': result['yTemp'], 'temperature': result['temperature']}
+    return {'gravity': result['gravity'], 'xTemp': result['xTemp'], 'yTemp': result['yTemp'], 'temperature': (result['xTemp'] + result['yTemp']) / 2}
+
+def summariseRepeats(results:list) -> dict:
+    """
+    Mean and standard deviation of g and the temperatures over repeated
+    runs of the same TOF sequence; results is a list of (run directory,
+    fitRun or combineRuns result). The spread is the sample standard
+    deviation, and 0 for a single run.
+    """
+    values = [repeatValues(result) for _, result in results]
+    names = (('gravity', 'g', 'm/s^2'), ('xTemp', 'X-Axis Temperature', 'K'), ('yTemp', 'Y-Axis Temperature', 'K'), ('temperature', 'Mean Temperature', 'K'))
+    summary = {'runs': [path for path, _ in results], 'values': values}
+    runningString = f"Repeated Runs ({len(results)}):\n"
+    for key, label, unit in names:
+        column = np.array([v[key] for v in values])
+        mean = float(column.mean())
+        std = float(column.std(ddof=1)) if len(column) > 1 else 0.
+        summary[key] = (mean, std)
+        runningString += f"{label}: {mean} ± {std}{unit}\n"
+    runningString += "\n"
+    for (path, _), v in zip(results, values):
+        runningString += f"{os.path.basename(os.path.normpath(path))}: g {v['gravity']:.4g}m/s^2, X {v['xTemp']:.4g}K, Y {v['yTemp']:.4g}K, mean {v['temperature']:.4g}K\n"
+    summary['text'] = runningString
+    return summary
+
+def analyseRun(baseDir, timeSplit, sigmaFactor, numWorkers=1, cache=None, progress=None, calibrations=None) -> dict:
+    """
+    Profile, fit and physics-fit one run without touching the GUI; see
+    fitRun for the result. Frames are corrected with the master frame from
+    calibrations (a Calibration.CalibrationStore) that matches the run.
+    """
+    # Frames come from the run's memory-mapped stack when it has one and
+    # from the per-TOF TIFF files otherwise
+    fileArr = RunStack.frameSources(baseDir, timeSplit)
     #backArr = []
-    for e in range(numImages):
-        fileArr.append(f"{baseDir}CloudDetection_TOF-{timeSplit[e]}ms.tiff")
-        #backArr.append("../MotTemp/Pics5/2024-06-24_CloudDetection_TOF_background_01.tiff")
-    plt_x = [None]*len(fileArr)
-    plt_y = [None]*len(fileArr)
-    x_pos = [None]*len(fileArr)
-    y_pos = [None]*len(fileArr)
-    for i in range(0, len(fileArr)):
-        window.statusbar.showMessage(f"Processing image {i+1} of {numImages}...")
-        plt_x[i], plt_y[i], x_pos[i], y_pos[i] = findStdDev(fileArr[i], sigmaFactor)
-    
-    window.statusbar.showMessage("Fitting data...")
-
-    amp, centre, sigma = [], [], []
-    yamp, ycentre, ysigma = [], [], []
-
-    p_amp = lm.Parameter(name='amp', value=8000.)
-    p_cen = lm.Parameter(name='cen', value=0.058)
-    p_wid = lm.Parameter(name='wid', value=0.005)
-    p_off = lm.Parameter(name='off', value=0.)
-    params = lm.Parameters()
-    params.add_many(p_amp, p_cen, p_wid, p_off)
-    
-    for i in range(0, len(plt_x)):
-        mod = lm.Model(Gaussian)
-        peak = plt_x[i].index(max(plt_x[i]))
-        p_amp = lm.Parameter(name='amp', value=plt_x[i][peak])
-        p_cen = lm.Parameter(name='cen', value=(x_pos[i][peak]/17.62)/1000)
-        params = lm.Parameters()
-        params.add_many(p_amp, p_cen, p_wid, p_off)
-        out = mod.fit(np.array(plt_x[i]), params, x=np.array([(x/17.62)/1000 for x in x_pos[i]]))
-        vals = out.best_values
-        amp.append(vals['amp'])
-        centre.append(vals['cen'])
-        sigma.append(vals['wid'])
-        mod = lm.Model(Gaussian)
-        peak = plt_y[i].index(max(plt_y[i]))
-        p_amp = lm.Parameter(name='amp', value=plt_y[i][peak])
-        p_cen = lm.Parameter(name='cen', value=(y_pos[i][peak]/17.62)/1000)
-        params = lm.Parameters()
-        params.add_many(p_amp, p_cen, p_wid, p_off)
-        out = mod.fit(np.array(plt_y[i]), params, x=np.array([(x/17.62)/1000 for x in y_pos[i]]))
-        vals = out.best_values
-        yamp.append(vals['amp'])
-        ycentre.append(vals['cen'])
-        ysigma.append(vals['wid'])
-    
-    axis_pts_ms = [x/1000 for x in timeSplit]
+    #backArr.append("../MotTemp/Pics5/2024-06-24_CloudDetection_TOF_background_01.tiff")
+
+    master = calibrations.forRun(baseDir) if calibrations is not None else None
+    calibration = master.path if master is not None else None
+    runKey = cache.runKey(fileArr, sigmaFactor, timeSplit, calibration) if cache is not None else None
+    fit = cache.get(runKey) if cache is not None else None
+    if fit is not None:
+        cache.flush()
+        return fit
+
+    results = processImages(fileArr, sigmaFactor, numWorkers, progress, cache, timeSplit, calibration)
+    fit = fitRun(timeSplit, results)
+    if cache is not None:
+        cache.put(runKey, fit)
+        cache.flush()
+    return fit
+
+def fitRun(timeSplit, results:list) -> dict:
+    """
+    Physics fits of a TOF series: quadratic centre motion (g, v_y) and the
+    sigma expansion (temperatures) from the per-image Gaussian fits.
+
+    Returns a plain dict of the per-image values, best-fit curves and the
+    summary text so it can be cached, tabulated or plotted later.
+    """
+    fit = {
+        'axis': [x/1000 for x in timeSplit],
+        'amp': [r.xvals['amp'] for r in results],
+        'centre': [r.xvals['cen'] for r in results],
+        'sigma': [r.xvals['wid'] for r in results],
+        'yamp': [r.yvals['amp'] for r in results],
+        'ycentre': [r.yvals['cen'] for r in results],
+        'ysigma': [r.yvals['wid'] for r in results],
+    }
+    axis_pts_ms = fit['axis']
+    centre, ycentre, sigma, ysigma = fit['centre'], fit['ycentre'], fit['sigma'], fit['ysigma']
     runningString = ""
 
     mod = QuadraticModel()
     pars = mod.guess(np.array(centre), x=np.array(axis_pts_ms))
-    out = mod.fit(np.array(centre), pars, x=np.array(axis_pts_ms))
+    with Trace.span('fitXCentre', 'fit'):
+        out = mod.fit(np.array(centre), pars, x=np.array(axis_pts_ms))
     runningString += f"X-axis Centre Results:\na: {out.best_values['a']}\nb: {out.best_values['b']}\nc: {out.best_values['c']}\n\n"
-    window.analysisWidget.axes[1][0].plot(axis_pts_ms, out.best_fit)
-    window.analysisWidget.axes[1][0].scatter(axis_pts_ms, centre, c='tab:orange')
+    fit['xCentreFit'] = (out.best_values, out.best_fit)
     print(out.fit_report(min_correl=0.25))
 
     mod = QuadraticModel()
     pars = mod.guess(np.array(ycentre), x=np.array(axis_pts_ms))
-    out = mod.fit(np.array(ycentre), pars, x=np.array(axis_pts_ms))
+    with Trace.span('fitYCentre', 'fit'):
+        out = mod.fit(np.array(ycentre), pars, x=np.array(axis_pts_ms))
     gravity = out.best_values['a'] * 2
     runningString += f"Y-axis Centre Results:\ng: {gravity}m/s^2\nv_y: {out.best_values['b']}m/s\ny_i: {out.best_values['c']}m\n\n"
-    window.analysisWidget.axes[1][1].plot(axis_pts_ms, out.best_fit)
-    window.analysisWidget.axes[1][1].scatter(axis_pts_ms, ycentre, c='tab:orange')
+    fit['yCentreFit'] = (out.best_values, out.best_fit)
+    fit['gravity'] = gravity
+    fit['v_y'] = out.best_values['b']
     print(out.fit_report(min_correl=0.25))
 
     mod = LinearModel()
     pars = mod.guess(np.array(sigma), x=np.array(axis_pts_ms))
-    out = mod.fit(np.array(sigma), pars, x=np.array(axis_pts_ms))
-    temp = 0.5 * ((1.44 * math.pow(10,-25))/(1.38 * math.pow(10,-23))) * math.pow(out.best_values['slope'], 2)
+    with Trace.span('fitXSigma', 'fit'):
+        out = mod.fit(np.array(sigma), pars, x=np.array(axis_pts_ms))
+    temp = TEMPERATURE_FACTOR * math.pow(out.best_values['slope'], 2)
     runningString += f"X-Axis Sigma Results:\nm: {out.best_values['slope']}m/s\nb: {out.best_values['intercept']}m\n Temperature: {temp}K\n\n"
-    window.analysisWidget.axes[2][0].plot(axis_pts_ms, out.best_fit)
-    window.analysisWidget.axes[2][0].scatter(axis_pts_ms, sigma, c='tab:orange')
+    fit['xSigmaFit'] = (out.best_values, out.best_fit)
+    fit['xTemp'] = temp
     print(out.fit_report(min_correl=0.25))
 
     mod = lm.Model(Hyperbolic)
@@ -97,19 +248,38 @@ def main(baseDir, numImages, window, timeSplit, sigmaFactor):
     p_sv = lm.Parameter(name='sv', value=out.best_values['slope'])
     params = lm.Parameters()
     params.add_many(p_s0, p_sv)
-    out = mod.fit(np.array(ysigma), params, x=np.array(axis_pts_ms))
-    temp = 0.5 * ((1.44 * math.pow(10,-25))/(1.38 * math.pow(10,-23))) * math.pow(out.best_values['sv'], 2)
+    with Trace.span('fitYSigma', 'fit'):
+        out = mod.fit(np.array(ysigma), params, x=np.array(axis_pts_ms))
+    temp = TEMPERATURE_FACTOR * math.pow(out.best_values['sv'], 2)
     runningString += f"Y-Axis Sigma Results:\ns0: {out.best_values['s0']}\nsv: {out.best_values['sv']}\nTemperature: {temp}K"
-    window.analysisWidget.axes[2][1].plot(axis_pts_ms, out.best_fit)
-    window.analysisWidget.axes[2][1].scatter(axis_pts_ms, ysigma, c='tab:orange')
+    fit['ySigmaFit'] = (out.best_values, out.best_fit)
+    fit['yTemp'] = temp
     print(out.fit_report(min_correl=0.25))
 
+    fit['text'] = runningString
+    return fit
+
+def showRun(window, fit:dict):
+    """Plot a fitRun result; must run on the GUI thread (see RenderScheduler)."""
+    # Imported here so headless users of this module never load Qt
+    from PyQt6.QtGui import QTextDocument
+
+    axis_pts_ms = fit['axis']
+    window.analysisWidget.axes[1][0].plot(axis_pts_ms, fit['xCentreFit'][1])
+    window.analysisWidget.axes[1][0].scatter(axis_pts_ms, fit['centre'], c='tab:orange')
+    window.analysisWidget.axes[1][1].plot(axis_pts_ms, fit['yCentreFit'][1])
+    window.analysisWidget.axes[1][1].scatter(axis_pts_ms, fit['ycentre'], c='tab:orange')
+    window.analysisWidget.axes[2][0].plot(axis_pts_ms, fit['xSigmaFit'][1])
+    window.analysisWidget.axes[2][0].scatter(axis_pts_ms, fit['sigma'], c='tab:orange')
+    window.analysisWidget.axes[2][1].plot(axis_pts_ms, fit['ySigmaFit'][1])
+    window.analysisWidget.axes[2][1].scatter(axis_pts_ms, fit['ysigma'], c='tab:orange')
+
     text = QTextDocument()
-    text.setPlainText(runningString)
+    text.setPlainText(fit['text'])
     window.fitText.setDocument(text)
 
-    window.analysisWidget.axes[0][0].scatter(axis_pts_ms, amp, c='tab:orange')
-    window.analysisWidget.axes[0][1].scatter(axis_pts_ms, yamp, c='tab:orange')
+    window.analysisWidget.axes[0][0].scatter(axis_pts_ms, fit['amp'], c='tab:orange')
+    window.analysisWidget.axes[0][1].scatter(axis_pts_ms, fit['yamp'], c='tab:orange')
 
     window.analysisWidget.axes[0][0].title.set_text("X-Axis Amplitude")
     window.analysisWidget.axes[0][1].title.set_text("Y-Axis Amplitude")
@@ -122,88 +292,98 @@ def main(baseDir, numImages, window, timeSplit, sigmaFactor):
     window.analysisWidget.axes[0][0].set_ylabel("Pixel Intensity")
     window.analysisWidget.axes[1][0].set_ylabel("Position (m)")
     window.analysisWidget.axes[2][0].set_ylabel("Position (m)")
-    window.analysisWidget.draw()
-    window.statusbar.showMessage("Processing finished.")
-
-def getIntegratedBins(image:np.ndarray) -> tuple[list,list]:
-    binx = []
-    biny = []
-    for i in range(0,len(image)):
-        intensity = 0
-        for j in range(0, len(image[0])):
-            intensity += image[i][j]
-        biny.append(intensity)
-
-    for j in range(0, len(image[0])):
-        intensity = 0
-        for i in range(0, len(image)):
-            intensity += image[i][j]
-        binx.append(intensity)
 
+def showCombined(window, combined:dict):
+    """Plot every camera's fit of a combineRuns result and show the combined summary."""
+    from PyQt6.QtGui import QTextDocument
+
+    for fit in combined['cameras'].values():
+        showRun(window, fit)
+    text = QTextDocument()
+    text.setPlainText(combined['text'])
+    window.fitText.setDocument(text)
+
+def showRepeats(window, result:dict, summary:dict):
+    """Add one repetition's fit to the plots, which keep every repetition so far, and show the summariseRepeats text."""
+    from PyQt6.QtGui import QTextDocument
+
+    if 'cameras' in result:
+        showCombined(window, result)
+    else:
+        showRun(window, result)
+    text = QTextDocument()
+    text.setPlainText(summary['text'])
+    window.fitText.setDocument(text)
+
+class CloudProfile(NamedTuple):
+    peakX: int
+    peakY: int
+    stdx: int
+    stdy: int
+    x1d: np.ndarray
+    y1d: np.ndarray
+    roi_x: np.ndarray
+    roi_y: np.ndarray
+    x_pos: np.ndarray
+    y_pos: np.ndarray
+
+def _accumulator(arr:np.ndarray):
+    # Integer frames are summed in int64 so Mono16 data cannot wrap around;
+    # float frames keep float64 (sums of integer-valued pixels are exact).
+    return np.float64 if np.asarray(arr).dtype.kind == 'f' else np.int64
+
+def getIntegratedBins(image:np.ndarray) -> tuple[np.ndarray,np.ndarray]:
+    acc = _accumulator(image)
+    binx = image.sum(axis=0, dtype=acc)
+    biny = image.sum(axis=1, dtype=acc)
     return (binx, biny)
 
-def get1DArray(image:np.ndarray, peakX:int, peakY:int) -> tuple[list,list]:
-    x1d = []
-    y1d = []
-    for j in range(0, len(image[peakY])):
-        x1d.append(image[peakY][j])
-    for i in range(0, len(image)):
-        y1d.append(image[i][peakX])
-    return (x1d, y1d)
-
-def get1DSum(x1d:list, y1d:list) -> tuple[int, int]:
-    xsum = 0
-    ysum = 0
-    for e in x1d:
-        xsum += e
-    for e in y1d:
-        ysum += e
+def getPeak(binx:np.ndarray, biny:np.ndarray) -> tuple[int,int]:
+    return (int(np.argmax(binx)), int(np.argmax(biny)))
+
+def get1DArray(image:np.ndarray, peakX:int, peakY:int) -> tuple[np.ndarray,np.ndarray]:
+    return (image[peakY, :], image[:, peakX])
+
+def get1DSum(x1d:np.ndarray, y1d:np.ndarray) -> tuple[int, int]:
+    xsum = np.sum(x1d, dtype=_accumulator(x1d))
+    ysum = np.sum(y1d, dtype=_accumulator(y1d))
     return (xsum, ysum)
 
-def getProbability(x1d:list, y1d:list, xsum:int, ysum:int) -> tuple[list,list]:
-    px = []
-    py = []
-    for e in x1d:
-        px.append(e/xsum)
-    for e in y1d:
-        py.append(e/ysum)
+def getProbability(x1d:np.ndarray, y1d:np.ndarray, xsum:int, ysum:int) -> tuple[np.ndarray,np.ndarray]:
+    px = np.asarray(x1d, dtype=np.float64) / xsum
+    py = np.asarray(y1d, dtype=np.float64) / ysum
     return (px, py)
 
-def getMu(px:list, py:list) -> tuple[float, float]:
-    mux = 0.
-    muy = 0.
-    for i in range(len(px)):
-        mux += px[i] * i
-    for i in range(len(py)):
-        muy += py[i] * i
+def getMu(px:np.ndarray, py:np.ndarray) -> tuple[float, float]:
+    mux = float(np.dot(px, np.arange(len(px), dtype=np.float64)))
+    muy = float(np.dot(py, np.arange(len(py), dtype=np.float64)))
     return (mux, muy)
 
 def getVariance(px, py, mux, muy) -> tuple[float]:
-    varx = 0.
-    vary = 0.
-    for i in range(len(px)):
-        varx += px[i] * (i - mux)**2
-    for i in range(len(py)):
-        vary += py[i] * (i - muy)**2
+    varx = float(np.dot(px, (np.arange(len(px), dtype=np.float64) - mux)**2))
+    vary = float(np.dot(py, (np.arange(len(py), dtype=np.float64) - muy)**2))
     return (varx, vary)
 
-def getROI(image:np.ndarray, stdx:int, stdy:int, peakX:int, peakY:int, sigmaFactor:int) -> tuple[list, list]:
-    roi_x = []
-    roi_y = []
-    for j in range(max(0, math.floor(peakX - (stdx*sigmaFactor))), min(len(image[peakY]), math.floor(peakX + (stdx*sigmaFactor)))):
-        roi_x.append(image[peakY][j])
-    for i in range(max(0, math.floor(peakY - (stdy*sigmaFactor))), min(len(image), math.floor(peakY + (stdy*sigmaFactor))+1)):
-        roi_y.append(image[i][peakX])
-    return (roi_x, roi_y)
-
-def getStdDev(image:np.ndarray) -> tuple[float,float]:
-    binx, biny = getIntegratedBins(image)
-    peakX = binx.index(max(binx))
-    peakY = biny.index(max(biny))
+def getROIBounds(shape:tuple, stdx:int, stdy:int, peakX:int, peakY:int, sigmaFactor:int) -> tuple[int,int,int,int]:
+    """Half-open [x0, x1) and [y0, y1) index ranges of the ROI around the peak."""
+    height, width = shape[0], shape[1]
+    x0 = max(0, math.floor(peakX - (stdx*sigmaFactor)))
+    x1 = min(width, math.floor(peakX + (stdx*sigmaFactor)))
+    y0 = max(0, math.floor(peakY - (stdy*sigmaFactor)))
+    y1 = min(height, math.floor(peakY + (stdy*sigmaFactor))+1)
+    return (x0, x1, y0, y1)
+
+def getROI(image:np.ndarray, stdx:int, stdy:int, peakX:int, peakY:int, sigmaFactor:int) -> tuple[np.ndarray, np.ndarray]:
+    x0, x1, y0, y1 = getROIBounds(image.shape, stdx, stdy, peakX, peakY, sigmaFactor)
+    return (image[peakY, x0:x1], image[y0:y1, peakX])
+
+def getStdDev(image:np.ndarray, peakX:int=None, peakY:int=None) -> tuple[float,float]:
+    if peakX is None or peakY is None:
+        peakX, peakY = getPeak(*getIntegratedBins(image))
     x1d, y1d = get1DArray(image, peakX, peakY)
     return getROIStdDev(x1d, y1d)
 
-def getROIStdDev(roi_x:list, roi_y:list) -> tuple[float,float]:
+def getROIStdDev(roi_x:np.ndarray, roi_y:np.ndarray) -> tuple[float,float]:
     xsum, ysum = get1DSum(roi_x, roi_y)
     px, py = getProbability(roi_x, roi_y, xsum, ysum)
     mux, muy = getMu(px, py)
@@ -211,21 +391,221 @@ def getROIStdDev(roi_x:list, roi_y:list) -> tuple[float,float]:
     stdx = math.sqrt(varx)
     stdy = math.sqrt(vary)
     return (stdx, stdy)
-    
-def findStdDev(file, sigmaFactor):
-    image = cv2.imread(file, flags=cv2.IMREAD_ANYDEPTH)
-    image = np.asarray(image, dtype=np.float64)
-    binx, biny = getIntegratedBins(image)
-    peakX = binx.index(max(binx))
-    peakY = biny.index(max(biny))
-    stdx, stdy = getStdDev(image)
+
+def _coarseAxis(proj:np.ndarray, step:int):
+    """
+    Centre and sigma (in full-resolution pixels) of the cloud in a coarse
+    projection, or None if its peak does not stand clear of the noise or
+    another peak comes close to it.
+    """
+    background = float(np.median(proj))
+    signal = proj - background
+    noise = 1.4826 * float(np.median(np.abs(signal)))
+    peak = int(np.argmax(signal))
+    height = float(signal[peak])
+    if height <= COARSE_MIN_SNR * max(noise, 1.):
+        return None
+    # Half width at half maximum, walked out from the peak on both sides
+    above = signal >= height / 2
+    lo = peak
+    while lo > 0 and above[lo - 1]:
+        lo -= 1
+    hi = peak
+    while hi < len(signal) - 1 and above[hi + 1]:
+        hi += 1
+    sigma = max((hi - lo + 1) / 2.355, 1.) * step
+    # Anything left after masking out the main lobe must be small
+    reach = int(math.ceil(3 * sigma / step))
+    rest = np.concatenate((signal[:max(0, peak - reach)], signal[peak + reach + 1:]))
+    if len(rest) and rest.max() > COARSE_MAX_SECONDARY * height:
+        return None
+    return (peak * step + step // 2, sigma)
+
+def _window(centre:int, sigma:float, step:int, size:int) -> tuple[int,int]:
+    half = int(math.ceil(WINDOW_SIGMAS * sigma)) + step
+    return (max(0, centre - half), min(size, centre + half + 1))
+
+def locateCloud(image:np.ndarray) -> tuple[int,int,float,float]:
+    """
+    Peak and standard deviations of the cloud in a frame.
+
+    The cloud is first found on a 3x3 median of every step-th pixel of
+    every step-th row, which brings the frame down to at most COARSE_SIZE
+    on a side. The integrated peak and the moments are then taken at full
+    resolution in a window of WINDOW_SIGMAS coarse sigmas around it, so the
+    cost follows the size of the cloud rather than of the sensor. Small frames, and
+    frames where the coarse search finds no clear single peak or the
+    refined peak lands on the edge of the window, are searched in full.
+    """
+    height, width = image.shape[:2]
+    step = -(-max(height, width) // COARSE_SIZE)
+    if USE_COARSE_LOCATOR and step >= 2:
+        coarse = np.ascontiguousarray(image[step//2::step, step//2::step])
+        if coarse.dtype not in (np.uint8, np.uint16, np.float32):
+            coarse = coarse.astype(np.float32)
+        # A 3x3 median keeps an uncorrected hot pixel from passing for a cloud
+        coarse = cv2.medianBlur(coarse, 3)
+        acc = _accumulator(coarse)
+        x = _coarseAxis(coarse.sum(axis=0, dtype=acc), step)
+        y = _coarseAxis(coarse.sum(axis=1, dtype=acc), step) if x is not None else None
+        if y is not None:
+            x0, x1 = _window(x[0], x[1], step, width)
+            y0, y1 = _window(y[0], y[1], step, height)
+            window = image[y0:y1, x0:x1]
+            peakX, peakY = getPeak(*getIntegratedBins(window))
+            if 0 < peakX < x1 - x0 - 1 and 0 < peakY < y1 - y0 - 1:
+                stdx, stdy = getROIStdDev(window[peakY, :], window[:, peakX])
+                return (x0 + peakX, y0 + peakY, stdx, stdy)
+    peakX, peakY = getPeak(*getIntegratedBins(image))
+    stdx, stdy = getStdDev(image, peakX, peakY)
+    return (peakX, peakY, stdx, stdy)
+
+def getCloudProfile(image:np.ndarray, sigmaFactor:int) -> CloudProfile:
+    """Peak, moments and ROI slices of a single frame (see locateCloud).
+
+    The returned arrays are views into ``image`` wherever possible.
+    """
+    with Trace.span('profile', 'analysis'):
+        peakX, peakY, stdx, stdy = locateCloud(image)
 
     stdx = math.floor(stdx)
     stdy = math.floor(stdy)
 
-    roi_x, roi_y = getROI(image, stdx, stdy, peakX, peakY, sigmaFactor)
+    x1d, y1d = get1DArray(image, peakX, peakY)
+    x0, x1, y0, y1 = getROIBounds(image.shape, stdx, stdy, peakX, peakY, sigmaFactor)
+    return CloudProfile(peakX, peakY, stdx, stdy, x1d, y1d, image[peakY, x0:x1], image[y0:y1, peakX], np.arange(x0, x1), np.arange(y0, y1))
+
+def findStdDev(file, sigmaFactor):
+    image = RunStack.readFrame(file)
+    profile = getCloudProfile(image, sigmaFactor)
+    # The ROI is copied out so the caller does not keep the whole frame alive
+    return (profile.roi_x.astype(np.float64), profile.roi_y.astype(np.float64), profile.x_pos, profile.y_pos)
+
+def toMetres(pos:np.ndarray) -> np.ndarray:
+    return (pos/PIXELS_PER_MM)/1000
+
+def fitProfile(profile:np.ndarray, pos:np.ndarray) -> dict:
+    """Gaussian fit of a 1-D ROI profile against its pixel positions converted to metres."""
+    return fitProfileLmfit(profile, toMetres(pos))
+
+def fitProfileLmfit(profile:np.ndarray, pos_m:np.ndarray) -> dict:
+    peak = int(np.argmax(profile))
+    p_amp = lm.Parameter(name='amp', value=profile[peak])
+    p_cen = lm.Parameter(name='cen', value=pos_m[peak])
+    p_wid = lm.Parameter(name='wid', value=0.005)
+    p_off = lm.Parameter(name='off', value=0.)
+    params = lm.Parameters()
+    params.add_many(p_amp, p_cen, p_wid, p_off)
+    with Trace.span('fitLmfit', 'fit'):
+        out = lm.Model(Gaussian).fit(np.array(profile), params, x=pos_m)
+    # The model is even in wid, so lmfit may settle on either sign; the
+    # sigma fits in fitRun need every image's width positive
+    return {**out.best_values, 'wid': abs(out.best_values['wid'])}
+
+def fitProfilesBatched(profiles:list, positions:list) -> list:
+    """Fit a stack of ROI profiles (pixel positions) with GaussFit, using lmfit only where it fails."""
+    pos_m = [toMetres(p) for p in positions]
+    with Trace.span('fitBatched', 'fit', profiles=len(profiles)):
+        values, fallbacks = GaussFit.fitProfiles(profiles, pos_m, lambda i: fitProfileLmfit(profiles[i], pos_m[i]))
+    if fallbacks:
+        log.debug('%d of %d profiles fell back to lmfit', fallbacks, len(profiles))
+    return values
+
+class ImageResult(NamedTuple):
+    peakX: int
+    peakY: int
+    stdx: int
+    stdy: int
+    roi_x: np.ndarray
+    roi_y: np.ndarray
+    x_pos: np.ndarray
+    y_pos: np.ndarray
+    xvals: dict
+    yvals: dict
+
+def toImageResult(profile:CloudProfile) -> ImageResult:
+    # The ROI is copied out so the result does not keep the whole frame alive
+    roi_x = profile.roi_x.astype(np.float64)
+    roi_y = profile.roi_y.astype(np.float64)
+    return ImageResult(profile.peakX, profile.peakY, profile.stdx, profile.stdy, roi_x, roi_y, profile.x_pos, profile.y_pos, None, None)
+
+def profileImage(file, sigmaFactor, calibration=None) -> ImageResult:
+    """Decode, calibrate (with the master frame at path calibration) and profile a single TOF image (a TIFF path or a RunStack slot), without fitting."""
+    image = RunStack.readFrame(file)
+    if calibration is not None:
+        image = Calibration.load(calibration).apply(image)
+    return toImageResult(getCloudProfile(image, sigmaFactor))
+
+def analyseFrame(image:np.ndarray, sigmaFactor) -> tuple[CloudProfile, ImageResult]:
+    """Profile and fit an in-memory frame, e.g. straight from the camera, as processImages would."""
+    profile = getCloudProfile(image, sigmaFactor)
+    result = toImageResult(profile)
+    xvals, yvals = fitProfilesBatched([result.roi_x, result.roi_y], [result.x_pos, result.y_pos])
+    return (profile, result._replace(xvals=xvals, yvals=yvals))
+
+def processImage(file, sigmaFactor, calibration=None) -> ImageResult:
+    """Decode, profile and lmfit-fit a single TOF image."""
+    result = profileImage(file, sigmaFactor, calibration)
+    return result._replace(xvals=fitProfile(result.roi_x, result.x_pos), yvals=fitProfile(result.roi_y, result.y_pos))
+
+def processImages(fileArr:list, sigmaFactor:int, numWorkers:int=1, progress=None, cache=None, timeSplit=None, calibration=None) -> list:
+    """Run processImage over a TOF series, in a process pool when numWorkers > 1.
+
+    Results are returned in the order of fileArr. progress(done, total) is
+    called from the calling thread after every finished image. Images found
+    in the AnalysisCache are not reprocessed. With USE_BATCHED_FIT the
+    workers only profile and all profiles are fitted in one GaussFit call.
+    Each worker loads the master frame at path calibration once.
+    """
+    results = [None]*len(fileArr)
+    keys = [None]*len(fileArr)
+    done = 0
+    if cache is not None:
+        for i in range(len(fileArr)):
+            keys[i] = cache.imageKey(fileArr[i], sigmaFactor, timeSplit[i] if timeSplit is not None else None, calibration)
+            results[i] = cache.get(keys[i])
+            if results[i] is not None:
+                done += 1
+                if progress is not None:
+                    progress(done, len(fileArr))
+    todo = [i for i in range(len(fileArr)) if results[i] is None]
+    work = profileImage if USE_BATCHED_FIT else processImage
+
+    def finished(i, result):
+        nonlocal done
+        results[i] = result
+        done += 1
+        if progress is not None:
+            progress(done, len(fileArr))
+
+    if numWorkers is None or numWorkers <= 1 or len(todo) <= 1:
+        for i in todo:
+            finished(i, work(fileArr[i], sigmaFactor, calibration))
+    else:
+        workers = min(numWorkers, len(todo))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Only two images per worker are in flight at a time, so a
+            # progress callback that pauses or cancels the analysis (see
+            # JobScheduler) takes effect within a couple of images
+            waiting = iter(todo)
+            running = {pool.submit(work, fileArr[i], sigmaFactor, calibration): i for i in itertools.islice(waiting, 2*workers)}
+            while running:
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    finished(running.pop(future), future.result())
+                    for i in itertools.islice(waiting, 1):
+                        running[pool.submit(work, fileArr[i], sigmaFactor, calibration)] = i
+
+    if USE_BATCHED_FIT and todo:
+        xvals = fitProfilesBatched([results[i].roi_x for i in todo], [results[i].x_pos for i in todo])
+        yvals = fitProfilesBatched([results[i].roi_y for i in todo], [results[i].y_pos for i in todo])
+        for k, i in enumerate(todo):
+            results[i] = results[i]._replace(xvals=xvals[k], yvals=yvals[k])
 
-    return (roi_x, roi_y, list(range(max(0, math.floor(peakX - (stdx*sigmaFactor))), min(len(image[0]), math.floor(peakX + (stdx*sigmaFactor))))), list(range(max(0, math.floor(peakY - (stdy*sigmaFactor))), min(len(image), math.floor(peakY + (stdy*sigmaFactor))+1))))
+    if cache is not None:
+        for i in todo:
+            cache.put(keys[i], results[i])
+    return results
 
 
 if __name__ == "__main__":
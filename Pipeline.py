@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+from typing import NamedTuple
+import numpy as np
+import Trace
+
+log = logging.getLogger(__name__)
+
+class Frame(NamedTuple):
+    index: int
+    tof: float
+    image: np.ndarray
+    # FramePool the image buffer belongs to, if any
+    pool: object = None
+
+    def release(self):
+        """Give a pooled image buffer back once this user of the frame is done with it."""
+        if self.pool is not None:
+            self.pool.release(self.image)
+
+class FramePool:
+    """
+    Fixed set of preallocated frame buffers shared by the pipeline stages.
+
+    acquire() hands out a free buffer and blocks while every buffer is in
+    use, so the frames in flight, and the memory they take, never exceed the
+    pool however long the run is. A buffer is handed out for a number of
+    users and goes back to the pool when the last of them releases it.
+    """
+    def __init__(self, shape, dtype, count):
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(count)]
+        self._index = {id(b): i for i, b in enumerate(self.buffers)}
+        self._users = [0]*count
+        self._free = list(range(count))
+        self._cond = threading.Condition()
+        self.waits = 0
+
+    @staticmethod
+    def countFor(budget, frameBytes, limit, minimum=2) -> int:
+        """Buffers of frameBytes that fit in budget bytes, between minimum and limit."""
+        return max(minimum, min(limit, int(budget // max(1, frameBytes))))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(b.nbytes for b in self.buffers)
+
+    def acquire(self, users=1, timeout=None) -> np.ndarray:
+        """A free buffer for users releases, or None if none came free within timeout seconds."""
+        with self._cond:
+            if not self._free:
+                self.waits += 1
+                if not self._cond.wait_for(lambda: self._free, timeout):
+                    return None
+            i = self._free.pop()
+            self._users[i] = users
+            return self.buffers[i]
+
+    def release(self, buffer):
+        i = self._index.get(id(buffer))
+        if i is None:
+            return
+        with self._cond:
+            self._users[i] -= 1
+            if self._users[i] == 0:
+                self._free.append(i)
+                self._cond.notify()
+
+    def __str__(self):
+        return f"frame pool: {len(self.buffers)} x {self.buffers[0].nbytes/2**20:.1f} MiB, waited {self.waits} times"
+
+class StageCounters:
+    """Queue depth, dropped items and time spent for one pipeline stage."""
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.busyTime = 0.
+        self.depth = 0
+        self.peakDepth = 0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed):
+        with self._lock:
+            self.processed += 1
+            self.busyTime += elapsed
+
+    def drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def setDepth(self, depth):
+        with self._lock:
+            self.depth = depth
+            self.peakDepth = max(self.peakDepth, depth)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'name': self.name,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'busyTime': self.busyTime,
+                'depth': self.depth,
+                'peakDepth': self.peakDepth,
+            }
+
+    def __str__(self):
+        s = self.snapshot()
+        mean = (s['busyTime'] / s['processed'] * 1000) if s['processed'] else 0.
+        return f"{s['name']}: {s['processed']} done, {s['dropped']} dropped, peak queue {s['peakDepth']}, {mean:.1f} ms/item"
+
+class PipelineStage(threading.Thread):
+    """
+    Consumer thread that drains a bounded queue and hands each item to a handler.
+
+    If the handler returns something other than None it is passed on to the
+    downstream stages. A stage created with dropWhenFull discards new items
+    instead of blocking the producer when its queue is full, which is what a
+    preview stage wants; stages that must see every frame (saving) block.
+    """
+    _STOP = object()
+
+    def __init__(self, name, handler, maxDepth=8, dropWhenFull=False, downstream=None):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=maxDepth)
+        self.dropWhenFull = dropWhenFull
+        self.downstream = downstream if downstream is not None else []
+        self.counters = StageCounters(name)
+        self.error = None
+
+    def put(self, item) -> bool:
+        if self.dropWhenFull:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.counters.drop()
+                return False
+        else:
+            self.queue.put(item)
+        self.counters.setDepth(self.queue.qsize())
+        return True
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            self.counters.setDepth(self.queue.qsize())
+            if item is PipelineStage._STOP:
+                break
+            start = time.perf_counter()
+            traceStart = Trace.now()
+            try:
+                out = self.handler(item)
+            except Exception as ex:
+                # Keep draining so the producer never blocks on a dead stage
+                log.error('Error in %s stage: %s', self.name, ex)
+                self.error = ex
+                self.counters.drop()
+                continue
+            self.counters.record(time.perf_counter() - start)
+            Trace.record(f'{self.name} stage', traceStart, category='pipeline')
+            if out is not None:
+                for stage in self.downstream:
+                    stage.put(out)
+
+    def close(self):
+        """Finish the queued items, then stop this stage and everything downstream of it."""
+        self.queue.put(PipelineStage._STOP)
+        self.join()
+        for stage in self.downstream:
+            stage.close()
@@ -0,0 +1,112 @@
+from PyQt6 import QtCore, QtGui
+import Trace
+
+class RenderScheduler(QtCore.QObject):
+    """
+    Coalesces plot and status updates from worker threads onto the GUI thread.
+
+    Workers call post() with a canvas and a callable that updates its artists,
+    showMessage() for the status bar and setText() for labels. All only emit a queued Qt signal,
+    so a worker never waits on matplotlib. On the GUI thread the pending
+    updates are applied at most once per display frame and each touched
+    canvas is redrawn once; canvases on a hidden tab are only marked dirty
+    and redrawn when their tab is shown.
+    """
+    _posted = QtCore.pyqtSignal(object, object, object)
+    _status = QtCore.pyqtSignal(str)
+    _text = QtCore.pyqtSignal(object, str)
+
+    def __init__(self, statusbar, tabWidget=None, parent=None):
+        super(RenderScheduler, self).__init__(parent)
+        self.statusbar = statusbar
+        self._pending = {}
+        self._dirty = set()
+        self._message = None
+        self._texts = {}
+        self.framesDrawn = 0
+        self.updatesCoalesced = 0
+
+        screen = QtGui.QGuiApplication.primaryScreen()
+        refreshRate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60.
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(max(1, int(1000 / refreshRate)))
+        self._timer.timeout.connect(self._tick)
+
+        self._posted.connect(self._onPosted, QtCore.Qt.ConnectionType.QueuedConnection)
+        self._status.connect(self._onStatus, QtCore.Qt.ConnectionType.QueuedConnection)
+        self._text.connect(self._onText, QtCore.Qt.ConnectionType.QueuedConnection)
+        if tabWidget is not None:
+            tabWidget.currentChanged.connect(self._flushDirty)
+
+    def post(self, canvas, update, key=None):
+        """
+        Queue update() to run on the GUI thread before the next redraw of canvas.
+
+        Updates posted with the same key replace each other, so only the most
+        recent one runs when a burst arrives faster than the display refreshes.
+        """
+        self._posted.emit(canvas, update, key)
+
+    def showMessage(self, message):
+        self._status.emit(message)
+
+    def setText(self, widget, text):
+        """Set a label's text on the GUI thread; only the latest text per label is applied."""
+        self._text.emit(widget, text)
+
+    def _onPosted(self, canvas, update, key):
+        updates = self._pending.setdefault(canvas, [])
+        if key is not None:
+            for i, (k, _) in enumerate(updates):
+                if k == key:
+                    updates[i] = (key, update)
+                    self.updatesCoalesced += 1
+                    break
+            else:
+                updates.append((key, update))
+        else:
+            updates.append((key, update))
+        self._schedule()
+
+    def _onStatus(self, message):
+        self._message = message
+        self._schedule()
+
+    def _onText(self, widget, text):
+        self._texts[widget] = text
+        self._schedule()
+
+    def _schedule(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _tick(self):
+        pending, self._pending = self._pending, {}
+        message, self._message = self._message, None
+        texts, self._texts = self._texts, {}
+        if message is not None:
+            self.statusbar.showMessage(message)
+        for widget, text in texts.items():
+            widget.setText(text)
+        for canvas, updates in pending.items():
+            for _, update in updates:
+                try:
+                    update()
+                except Exception as ex:
+                    print(f'Error while updating plot: {ex}')
+            self._draw(canvas)
+        if not self._pending and self._message is None and not self._texts:
+            self._timer.stop()
+
+    def _draw(self, canvas):
+        if canvas.isVisible():
+            with Trace.span('draw', 'gui', canvas=type(canvas).__name__):
+                canvas.draw()
+            self.framesDrawn += 1
+            self._dirty.discard(canvas)
+        else:
+            self._dirty.add(canvas)
+
+    def _flushDirty(self, *args):
+        for canvas in list(self._dirty):
+            self._draw(canvas)
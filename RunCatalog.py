@@ -0,0 +1,284 @@
+# SQLite catalog of the runs under the Data/ tree.
+#
+# Every RunN directory (every Cam<serial>/ directory of a multi-camera run)
+# has one row holding its date, run number, camera, exposure, TOF list,
+# frame files and the results of its last analysis. The catalog is brought
+# up to date from directory mtimes: a day directory is only listed again
+# when its mtime changes, and a run is only read again when its own
+# directory or stack index changes (or it was still being acquired), so
+# looking up a run, finding the next run number or querying results costs
+# the same however large the tree gets.
+#
+#   python RunCatalog.py --start 2024-06-01 --end 2024-06-30 --max-temp 50e-6
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import RunStack
+
+log = logging.getLogger(__name__)
+
+CATALOG_FILE = ".catalog.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    camera TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    exposure REAL,
+    timeSplit TEXT NOT NULL,
+    numImages INTEGER NOT NULL,
+    written INTEGER NOT NULL,
+    frames TEXT NOT NULL,
+    sigmaFactor INTEGER,
+    g REAL,
+    v_y REAL,
+    xTemp REAL,
+    yTemp REAL,
+    temperature REAL,
+    analysed REAL
+);
+CREATE INDEX IF NOT EXISTS runsByDate ON runs (date, run);
+CREATE INDEX IF NOT EXISTS runsByTemperature ON runs (temperature);
+CREATE TABLE IF NOT EXISTS days (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL
+);
+"""
+
+def _mtime(path) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+class RunCatalog:
+    """
+    Index of every run in dataDir, stored in dataDir/.catalog.sqlite.
+
+    Rows are dicts with the columns of the runs table, the TOF list and
+    frame file names decoded, and 'runDir' the absolute directory of the
+    frames. Safe to use from several threads.
+    """
+    def __init__(self, dataDir):
+        self.dataDir = os.path.abspath(dataDir)
+        os.makedirs(self.dataDir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.dataDir, CATALOG_FILE), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def dayDir(self, date:datetime.date) -> str:
+        return os.path.join(self.dataDir, date.strftime("%Y"), date.strftime("%m"), date.strftime("%d"))
+
+    def refresh(self) -> int:
+        """Bring the catalog up to date with the Data tree; returns the number of run directories read."""
+        start = time.perf_counter()
+        with self._lock:
+            known = {r['path']: r['mtime'] for r in self._db.execute("SELECT path, mtime FROM days")}
+        seen = set()
+        count = 0
+        for dayPath in self._dayPaths():
+            seen.add(dayPath)
+            mtime = _mtime(os.path.join(self.dataDir, dayPath))
+            if known.get(dayPath) == mtime:
+                # Nothing was added to or removed from the day; only runs
+                # that were empty or still being written last time can have changed
+                with self._lock:
+                    open_ = [r['path'] for r in self._db.execute("SELECT path FROM runs WHERE path LIKE ? AND (written < numImages OR numImages = 0)", (dayPath + '/%',))]
+                for path in {p.split('/')[3] for p in open_}:
+                    count += self._indexRun(f"{dayPath}/{path}")
+                continue
+            for name in os.listdir(os.path.join(self.dataDir, dayPath)):
+                if name.startswith("Run") and name[3:].isdigit():
+                    count += self._indexRun(f"{dayPath}/{name}")
+            with self._lock, self._db:
+                # Runs deleted from the day
+                for row in self._db.execute("SELECT path FROM runs WHERE path LIKE ?", (dayPath + '/%',)).fetchall():
+                    if not os.path.isdir(os.path.join(self.dataDir, row['path'])):
+                        self._db.execute("DELETE FROM runs WHERE path = ?", (row['path'],))
+                self._db.execute("INSERT OR REPLACE INTO days (path, mtime) VALUES (?, ?)", (dayPath, mtime))
+        with self._lock, self._db:
+            for dayPath in set(known) - seen:
+                self._db.execute("DELETE FROM runs WHERE path LIKE ?", (dayPath + '/%',))
+                self._db.execute("DELETE FROM days WHERE path = ?", (dayPath,))
+        log.info('Run catalog refreshed in %.2f s, %d run directories read', time.perf_counter() - start, count)
+        return count
+
+    def _dayPaths(self):
+        """YYYY/MM/DD paths of the day directories, relative to dataDir."""
+        def numbered(path, digits):
+            try:
+                return sorted(n for n in os.listdir(path) if len(n) == digits and n.isdigit())
+            except OSError:
+                return []
+        for year in numbered(self.dataDir, 4):
+            for month in numbered(os.path.join(self.dataDir, year), 2):
+                for day in numbered(os.path.join(self.dataDir, year, month), 2):
+                    yield f"{year}/{month}/{day}"
+
+    def update(self, runDir) -> int:
+        """Read one run directory (all of its cameras) into the catalog now; directories outside YYYY/MM/DD/RunN are ignored."""
+        parts = os.path.relpath(os.path.abspath(runDir), self.dataDir).replace(os.sep, '/').split('/')
+        if len(parts) < 4 or not all(p.isdigit() for p in parts[:3]) or not (parts[3].startswith("Run") and parts[3][3:].isdigit()):
+            return 0
+        return self._indexRun('/'.join(parts[:4]))
+
+    def _indexRun(self, runPath) -> int:
+        """(Re)read the camera directories of Data/runPath whose mtimes changed; returns how many were read."""
+        runDir = os.path.join(self.dataDir, runPath)
+        year, month, day, name = runPath.split('/')
+        date = f"{year}-{month}-{day}"
+        cameras = {'': runPath}
+        if os.path.isdir(runDir):
+            subdirs = sorted(d for d in os.listdir(runDir) if d.startswith('Cam') and os.path.isdir(os.path.join(runDir, d)))
+            if subdirs:
+                cameras = {d[3:]: f"{runPath}/{d}" for d in subdirs}
+        with self._lock:
+            stored = {r['path']: r['mtime'] for r in self._db.execute("SELECT path, mtime FROM runs WHERE path = ? OR path LIKE ?", (runPath, runPath + '/%'))}
+        count = 0
+        rows = []
+        for camera, path in cameras.items():
+            cameraDir = os.path.join(self.dataDir, path)
+            mtime = max(_mtime(cameraDir), _mtime(os.path.join(cameraDir, RunStack.INDEX_FILE)))
+            if stored.get(path) == mtime:
+                continue
+            row = self._describe(cameraDir)
+            if row is None:
+                continue
+            row.update(path=path, date=date, run=int(name[3:]), camera=row['camera'] or camera, mtime=mtime)
+            rows.append(row)
+            count += 1
+        with self._lock, self._db:
+            for path in set(stored) - set(cameras.values()):
+                self._db.execute("DELETE FROM runs WHERE path = ?", (path,))
+            for row in rows:
+                # Analysis results survive re-reading the run's frames
+                self._db.execute("""
+                    INSERT INTO runs (path, date, run, camera, mtime, exposure, timeSplit, numImages, written, frames)
+                    VALUES (:path, :date, :run, :camera, :mtime, :exposure, :timeSplit, :numImages, :written, :frames)
+                    ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, camera = excluded.camera,
+                        exposure = excluded.exposure, timeSplit = excluded.timeSplit, numImages = excluded.numImages,
+                        written = excluded.written, frames = excluded.frames
+                    """, row)
+        return count
+
+    @staticmethod
+    def _describe(cameraDir) -> dict:
+        """Catalog fields of one directory of frames, or None if it holds none."""
+        try:
+            names = os.listdir(cameraDir)
+        except OSError:
+            return None
+        frames = sorted(n for n in names if n == RunStack.FRAMES_FILE or (n.startswith("CloudDetection_TOF-") and n.endswith("ms.tiff")))
+        camera, exposure = '', None
+        if RunStack.RunStack.exists(cameraDir):
+            try:
+                with open(os.path.join(cameraDir, RunStack.INDEX_FILE)) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                return None
+            timeSplit = index['timeSplit']
+            written = sum(index['written'])
+            exposure = index.get('exposureTime')
+            camera = index.get('camera', '')
+        else:
+            timeSplit = RunStack.runTimeSplit(cameraDir)
+            written = len(timeSplit)
+        return {
+            'camera': camera,
+            'exposure': exposure,
+            'timeSplit': json.dumps([float(t) for t in timeSplit]),
+            'numImages': len(timeSplit),
+            'written': written,
+            'frames': json.dumps(frames),
+        }
+
+    def recordAnalysis(self, cameraDir, sigmaFactor, fit:dict):
+        """Store the fitRun result of a run (of one camera of a multi-camera run)."""
+        path = os.path.relpath(os.path.abspath(cameraDir), self.dataDir).replace(os.sep, '/')
+        self.update(cameraDir)
+        with self._lock, self._db:
+            self._db.execute("""
+                UPDATE runs SET sigmaFactor = ?, g = ?, v_y = ?, xTemp = ?, yTemp = ?, temperature = ?, analysed = ?
+                WHERE path = ?
+                """, (sigmaFactor, fit['gravity'], fit['v_y'], fit['xTemp'], fit['yTemp'], (fit['xTemp'] + fit['yTemp']) / 2, time.time(), path))
+
+    def find(self, date:datetime.date, run:int) -> list:
+        """Rows of a run, one per camera (empty if the catalog does not know it)."""
+        return self._select("date = ? AND run = ?", (date.isoformat(), run))
+
+    def runs(self, start:datetime.date=None, end:datetime.date=None, maxTemp=None, camera=None) -> list:
+        """Rows of the runs between start and end inclusive, optionally only those analysed colder than maxTemp (K)."""
+        clauses, args = [], []
+        if start is not None:
+            clauses.append("date >= ?")
+            args.append(start.isoformat())
+        if end is not None:
+            clauses.append("date <= ?")
+            args.append(end.isoformat())
+        if maxTemp is not None:
+            clauses.append("temperature < ?")
+            args.append(maxTemp)
+        if camera is not None:
+            clauses.append("camera = ?")
+            args.append(camera)
+        return self._select(" AND ".join(clauses) or "1", args)
+
+    def _select(self, where, args) -> list:
+        with self._lock:
+            rows = self._db.execute(f"SELECT * FROM runs WHERE {where} ORDER BY date, run, camera", args).fetchall()
+        result = []
+        for r in rows:
+            row = dict(r)
+            row['timeSplit'] = json.loads(row['timeSplit'])
+            row['frames'] = json.loads(row['frames'])
+            row['runDir'] = os.path.join(self.dataDir, row['path']) + "/"
+            result.append(row)
+        return result
+
+    def nextRun(self, date:datetime.date) -> int:
+        """First free run number of a day."""
+        with self._lock:
+            last = self._db.execute("SELECT MAX(run) FROM runs WHERE date = ?", (date.isoformat(),)).fetchone()[0]
+        run = (last or 0) + 1
+        # Runs made since the catalog was last refreshed
+        while os.path.exists(os.path.join(self.dayDir(date), f"Run{run}")):
+            run += 1
+        return run
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update the run catalog and list runs from it.")
+    parser.add_argument('--data', default=os.path.join(os.getcwd(), "Data"), help="root of the Data/YYYY/MM/DD/RunN tree")
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help="last date, YYYY-MM-DD")
+    parser.add_argument('--max-temp', type=float, help="only runs analysed colder than this, in K")
+    parser.add_argument('--camera', help="only this camera serial")
+    args = parser.parse_args(argv)
+
+    catalog = RunCatalog(args.data)
+    catalog.refresh()
+    rows = catalog.runs(args.start, args.end, args.max_temp, args.camera)
+    for row in rows:
+        result = f"g = {row['g']:.3f} m/s^2, T = {row['temperature']*1e6:.1f} uK" if row['analysed'] is not None else "not analysed"
+        camera = f" camera {row['camera']}" if row['camera'] else ""
+        print(f"{row['date']} Run{row['run']}{camera}: {row['written']}/{row['numImages']} TOFs, {result}")
+    print(f"{len(rows)} runs.")
+    catalog.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
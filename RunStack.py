@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import cv2
+import numpy as np
+
+FRAMES_FILE = "frames.npy"
+INDEX_FILE = "index.json"
+
+def tiffName(tof) -> str:
+    return f"CloudDetection_TOF-{tof}ms.tiff"
+
+class RunStack:
+    """
+    Memory-mapped uint16 frame stack for one RunN directory.
+
+    All frames of a run live in a single preallocated (numImages, height, width)
+    .npy file next to a small JSON index holding the TOF times, exposure and
+    which slots have been written. Frames are read back as views into the
+    mapping, so analysis and recall never decode or copy a whole file.
+    """
+    def __init__(self, runDir, mode='r'):
+        self.runDir = runDir
+        with open(os.path.join(runDir, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.frames = np.load(os.path.join(runDir, FRAMES_FILE), mmap_mode=mode)
+        self._file = None
+
+    @staticmethod
+    def exists(runDir) -> bool:
+        return os.path.exists(os.path.join(runDir, INDEX_FILE)) and os.path.exists(os.path.join(runDir, FRAMES_FILE))
+
+    @classmethod
+    def create(cls, runDir, timeSplit, shape, exposureTime):
+        """Preallocate the stack for len(timeSplit) frames of the given (height, width)."""
+        os.makedirs(runDir, exist_ok=True)
+        frames = np.lib.format.open_memmap(os.path.join(runDir, FRAMES_FILE), mode='w+', dtype=np.uint16, shape=(len(timeSplit), shape[0], shape[1]))
+        del frames
+        index = {
+            'timeSplit': [float(t) for t in timeSplit],
+            'exposureTime': exposureTime,
+            'shape': [len(timeSplit), int(shape[0]), int(shape[1])],
+            'dtype': 'uint16',
+            'written': [False]*len(timeSplit),
+        }
+        with open(os.path.join(runDir, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        return cls(runDir, mode='r+')
+
+    @property
+    def timeSplit(self) -> list:
+        return self.index['timeSplit']
+
+    @property
+    def exposureTime(self):
+        return self.index['exposureTime']
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def frame(self, slot:int) -> np.ndarray:
+        return self.frames[slot]
+
+    def write(self, slot:int, image:np.ndarray) -> np.ndarray:
+        """Copy a frame into its slot and return the view onto it."""
+        self.frames[slot] = image
+        return self.frames[slot]
+
+    def store(self, slot:int, image:np.ndarray):
+        """
+        Write a frame into its slot through the file instead of the mapping.
+
+        Frames written this way never become resident pages of the mapping,
+        so the process does not grow with the length of the run. Only one
+        thread should store frames at a time.
+        """
+        if self._file is None:
+            self._file = open(os.path.join(self.runDir, FRAMES_FILE), 'r+b')
+        self._file.seek(self.frames.offset + slot * self.frames[0].nbytes)
+        self._file.write(np.ascontiguousarray(image, dtype=np.uint16).data)
+
+    def markWritten(self, slot:int):
+        self.index['written'][slot] = True
+
+    def slotFor(self, tof) -> int:
+        """Slot holding the frame for a TOF value, or -1 if the run has none."""
+        matches = np.flatnonzero(np.isclose(self.timeSplit, float(tof)))
+        return int(matches[0]) if len(matches) else -1
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        self.frames.flush()
+        with open(os.path.join(self.runDir, INDEX_FILE), 'w') as f:
+            json.dump(self.index, f)
+
+    def close(self):
+        """Flush and close the file used by store(); the mapping stays readable."""
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def exportTiff(self, slot:int=None, image:np.ndarray=None):
+        """Write one slot (from image if given), or every written slot, as the classic per-TOF TIFF files."""
+        if image is not None:
+            cv2.imwrite(os.path.join(self.runDir, tiffName(self.timeSplit[slot])), image)
+            return
+        slots = range(len(self)) if slot is None else [slot]
+        for i in slots:
+            if self.index['written'][i] or slot is not None:
+                cv2.imwrite(os.path.join(self.runDir, tiffName(self.timeSplit[i])), self.frames[i])
+
+def runTimeSplit(runDir) -> list:
+    """TOF values of a run, from its stack index or else from its TIFF file names."""
+    if RunStack.exists(runDir):
+        return list(openStack(runDir).timeSplit)
+    times = []
+    for name in os.listdir(runDir):
+        if name.startswith("CloudDetection_TOF-") and name.endswith("ms.tiff"):
+            try:
+                times.append(float(name[len("CloudDetection_TOF-"):-len("ms.tiff")]))
+            except ValueError:
+                pass
+    return sorted(times)
+
+# Read-only stacks opened by this process, most recently used last
+_opened = {}
+_openLock = threading.Lock()
+# Runs kept open at a time; recall and batch work through one run at a time
+MAX_OPEN_STACKS = 4
+
+def openStack(runDir) -> RunStack:
+    """Read-only stack of a run, opened once per process (and again only if its index changes)."""
+    mtime = os.stat(os.path.join(runDir, INDEX_FILE)).st_mtime_ns
+    with _openLock:
+        cached = _opened.pop(runDir, None)
+        if cached is not None and cached[0] == mtime:
+            _opened[runDir] = cached
+            return cached[1]
+    stack = RunStack(runDir)
+    with _openLock:
+        _opened[runDir] = (mtime, stack)
+        while len(_opened) > MAX_OPEN_STACKS:
+            del _opened[next(iter(_opened))]
+    return stack
+
+def readFrame(source) -> np.ndarray:
+    """Frame for a source: a TIFF path or a (runDir, slot) pair inside a RunStack."""
+    if isinstance(source, tuple):
+        runDir, slot = source
+        return openStack(runDir).frame(slot)
+    return cv2.imread(source, flags=cv2.IMREAD_ANYDEPTH)
+
+def frameSources(baseDir, timeSplit) -> list:
+    """Sources for each TOF of a run, preferring the frame stack over TIFF files."""
+    if RunStack.exists(baseDir):
+        stack = openStack(baseDir)
+        slots = [stack.slotFor(t) for t in timeSplit]
+        if all(s >= 0 and stack.index['written'][s] for s in slots):
+            return [(baseDir, s) for s in slots]
+    return [f"{baseDir}{tiffName(t)}" for t in timeSplit]
@@ -0,0 +1,466 @@
+# Simulated PySpin backend.
+#
+# Implements the part of the PySpin API that Trigger.py and
+# AcquireAndDisplay.py use, backed by a fake Mono16 camera that images a
+# MOT cloud falling under gravity and expanding ballistically with TOF.
+# It lets acquisition be run, measured and debugged without a FLIR camera:
+#
+#   MOTTEMP_CAMERA=sim python app.py
+#
+# The simulation is set up through CONFIG, either by editing it before the
+# cameras are created or through SIMSPIN_<KEY> environment variables, e.g.
+#
+#   SIMSPIN_WIDTH=2048 SIMSPIN_HEIGHT=2048 SIMSPIN_TRIGGERRATE=50 SIMSPIN_DROPRATE=0.02
+#
+# Frame n of an acquisition is taken at tofs[n % len(tofs)] ms, where tofs
+# is the TOF sequence of the run being acquired (Trigger sets Camera.tofs,
+# so the simulated clouds match the TOFs the run is saved and fitted under)
+# or CONFIG['tofs'] outside a run, e.g. in the live view.
+# Dropped frames skip a frame ID (and with it a TOF) and are counted in the
+# stream's StreamLostFrameCount, like frames lost on their way from the
+# camera; incomplete frames are delivered with IsIncomplete() set.
+
+import os
+import threading
+import time
+import numpy as np
+
+CONFIG = {
+    'cameras': 1,
+    'width': 720,
+    'height': 540,
+    'triggerRate': 20.,         # hardware triggers (or free-run frames) per second
+    'tofs': [float(t) for t in np.linspace(1, 10, 10)],   # ms, cycled per frame outside a run
+    'background': 100.,         # counts
+    'noise': 10.,               # read noise, counts rms
+    'hotPixels': 0,             # pixels stuck far above the background
+    'peak': 4000.,              # cloud peak at TOF 0, counts
+    'sigma0': 0.5e-3,           # initial cloud radius, m
+    'temperature': 30e-6,       # K
+    'gravity': 9.81,            # m/s^2
+    'pixelsPerMm': 17.62,       # same scale as MotTemp.PIXELS_PER_MM
+    'dropRate': 0.,             # probability a trigger is lost
+    'incompleteRate': 0.,       # probability a frame arrives incomplete
+    'seed': None,
+}
+
+def _loadEnv():
+    for key, default in CONFIG.items():
+        value = os.environ.get(f"SIMSPIN_{key.upper()}")
+        if value is None:
+            continue
+        if key == 'tofs':
+            CONFIG[key] = [float(t) for t in value.split(',')]
+        elif key == 'seed' or isinstance(default, int):
+            CONFIG[key] = int(value)
+        else:
+            CONFIG[key] = float(value)
+
+_loadEnv()
+
+# Rubidium-87 mass, as in MotTemp's temperature formula, and Boltzmann's constant
+ATOM_MASS = 1.44e-25
+BOLTZMANN = 1.38e-23
+
+# Access modes and enumeration values
+NI, NA, WO, RO, RW = range(5)
+PixelFormat_Mono8, PixelFormat_Mono16 = range(2)
+ExposureAuto_Off, ExposureAuto_Once, ExposureAuto_Continuous = range(3)
+SPINNAKER_COLOR_PROCESSING_ALGORITHM_HQ_LINEAR = 0
+IMAGE_STATUS_NO_ERROR = 0
+IMAGE_STATUS_MISSING_PACKETS = 3
+
+class SpinnakerException(Exception):
+    pass
+
+class _Version:
+    major, minor, type, build = (0, 0, 0, 0)
+
+# ---------------------------------------------------------------- nodes
+
+class _Node:
+    def __init__(self, name, value=None, access=RW):
+        self.name = name
+        self.value = value
+        self.access = access
+
+    def GetName(self):
+        return self.name
+
+    def GetAccessMode(self):
+        return self.access
+
+    def GetValue(self):
+        return self.value
+
+    def SetValue(self, value):
+        if self.access not in (RW, WO):
+            raise SpinnakerException(f"Node {self.name} is not writable")
+        self.value = value
+
+    def ToString(self):
+        return str(self.value)
+
+class _EnumEntry(_Node):
+    def __init__(self, symbolic, value):
+        super().__init__(symbolic, value, RO)
+
+    def GetSymbolic(self):
+        return self.name
+
+class _EnumNode(_Node):
+    def __init__(self, name, symbols, current, access=RW):
+        self.entries = {s: _EnumEntry(s, i) for i, s in enumerate(symbols)}
+        super().__init__(name, self.entries[current].value, access)
+
+    def GetEntryByName(self, symbolic):
+        return self.entries.get(symbolic)
+
+    def GetCurrentEntry(self):
+        return next(e for e in self.entries.values() if e.value == self.value)
+
+    def GetIntValue(self):
+        return self.value
+
+    def SetIntValue(self, value):
+        if not any(e.value == value for e in self.entries.values()):
+            raise SpinnakerException(f"{value} is not a valid entry of {self.name}")
+        self.SetValue(value)
+
+    def ToString(self):
+        return self.GetCurrentEntry().GetSymbolic()
+
+    def symbol(self):
+        return self.GetCurrentEntry().GetSymbolic()
+
+class _IntNode(_Node):
+    def __init__(self, name, value, minimum, maximum, access=RW):
+        super().__init__(name, value, access)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def GetMin(self):
+        return self.minimum
+
+    def GetMax(self):
+        return self.maximum
+
+    def SetValue(self, value):
+        if not self.minimum <= value <= self.maximum:
+            raise SpinnakerException(f"{value} is out of range for {self.name}")
+        super().SetValue(int(value))
+
+class _CategoryNode(_Node):
+    def __init__(self, name, features):
+        super().__init__(name, None, RO)
+        self.features = features
+
+    def GetFeatures(self):
+        return list(self.features)
+
+class _CommandNode(_Node):
+    def __init__(self, name, action):
+        super().__init__(name, None, WO)
+        self.action = action
+
+    def Execute(self):
+        self.action()
+
+class _NodeMap:
+    def __init__(self, nodes):
+        self.nodes = {n.name: n for n in nodes}
+
+    def GetNode(self, name):
+        return self.nodes.get(name)
+
+def _cast(node):
+    return node
+
+# PySpin's node pointer casts; in the simulation every node already has the full interface
+CValuePtr = CStringPtr = CIntegerPtr = CFloatPtr = CBooleanPtr = _cast
+CEnumerationPtr = CEnumEntryPtr = CCategoryPtr = CCommandPtr = _cast
+
+def IsAvailable(node) -> bool:
+    return node is not None and node.access not in (NI, NA)
+
+def IsReadable(node) -> bool:
+    return node is not None and node.access in (RO, RW)
+
+def IsWritable(node) -> bool:
+    return node is not None and node.access in (WO, RW)
+
+# ---------------------------------------------------------------- images
+
+class Image:
+    def __init__(self, data, frameId, status=IMAGE_STATUS_NO_ERROR):
+        self._data = data
+        self._frameId = frameId
+        self._status = status
+
+    def GetNDArray(self) -> np.ndarray:
+        return self._data
+
+    def GetWidth(self):
+        return self._data.shape[1]
+
+    def GetHeight(self):
+        return self._data.shape[0]
+
+    def GetFrameID(self):
+        return self._frameId
+
+    def IsIncomplete(self) -> bool:
+        return self._status != IMAGE_STATUS_NO_ERROR
+
+    def GetImageStatus(self):
+        return self._status
+
+    def Save(self, filename, *args):
+        import cv2
+        cv2.imwrite(filename, self._data)
+
+    def Release(self):
+        self._data = None
+
+class ImageProcessor:
+    def SetColorProcessing(self, algorithm):
+        pass
+
+# ---------------------------------------------------------------- camera
+
+class _CloudModel:
+    """Renders the expanding, falling cloud on top of a small bank of noise frames."""
+    def __init__(self, width, height, rng):
+        self.width, self.height = width, height
+        self.rng = rng
+        # Fresh Gaussian noise for every frame of a 2048^2 sensor would cost
+        # more than the analysis under test, so frames draw from a bank
+        noise = rng.normal(CONFIG['background'], CONFIG['noise'], (4, height, width))
+        self.noise = noise.astype(np.float32)
+        if CONFIG['hotPixels']:
+            # Hot pixels sit at the same places on every frame of a sensor
+            hot = np.random.default_rng(0)
+            where = hot.choice(width * height, int(CONFIG['hotPixels']), replace=False)
+            self.noise.reshape(len(self.noise), -1)[:, where] += hot.uniform(1000, 20000, len(where)).astype(np.float32)
+        self.xs = np.arange(width, dtype=np.float32)
+        self.ys = np.arange(height, dtype=np.float32)
+
+    def render(self, tofMs) -> np.ndarray:
+        t = tofMs / 1000
+        scale = CONFIG['pixelsPerMm'] * 1000
+        sigmaV = np.sqrt(BOLTZMANN * CONFIG['temperature'] / ATOM_MASS)
+        sigma = np.sqrt(CONFIG['sigma0']**2 + (sigmaV * t)**2) * scale
+        cx = self.width / 2
+        cy = self.height / 4 + 0.5 * CONFIG['gravity'] * t**2 * scale
+        amp = CONFIG['peak'] * (CONFIG['sigma0'] * scale / sigma)**2
+        gx = np.exp(-0.5 * ((self.xs - cx) / sigma)**2)
+        gy = np.exp(-0.5 * ((self.ys - cy) / sigma)**2)
+        image = np.outer(amp * gy, gx)
+        image += self.noise[self.rng.integers(len(self.noise))]
+        np.clip(image, 0, 65535, out=image)
+        return image.astype(np.uint16)
+
+def renderFrames(timeSplit, width=None, height=None, seed=None):
+    """Yield the uint16 frame the simulated camera would take at each TOF (ms)."""
+    width = int(CONFIG['width'] if width is None else width)
+    height = int(CONFIG['height'] if height is None else height)
+    cloud = _CloudModel(width, height, np.random.default_rng(seed))
+    for tof in timeSplit:
+        yield cloud.render(tof)
+
+class Camera:
+    def __init__(self, index):
+        self.index = index
+        # TOF sequence (ms) of the run being acquired; None uses CONFIG['tofs']
+        self.tofs = None
+        self._initialised = False
+        self._streaming = False
+        self._lock = threading.Condition()
+        self._softwareTriggers = 0
+        self._tlDevice = _NodeMap([
+            _CategoryNode('DeviceInformation', [
+                _Node('DeviceVendorName', 'Simulated', RO),
+                _Node('DeviceModelName', 'SimSpin Mono16', RO),
+                _Node('DeviceSerialNumber', f"SIM{index:05d}", RO),
+            ]),
+            _Node('DeviceSerialNumber', f"SIM{index:05d}", RO),
+        ])
+        self.PixelFormat = _EnumNode('PixelFormat', ['Mono8', 'Mono16'], 'Mono16')
+        self.ExposureAuto = _EnumNode('ExposureAuto', ['Off', 'Once', 'Continuous'], 'Continuous')
+        self.ExposureTime = _Node('ExposureTime', 10000.)
+        self.Width = _IntNode('Width', int(CONFIG['width']), 1, int(CONFIG['width']), RO)
+        self.Height = _IntNode('Height', int(CONFIG['height']), 1, int(CONFIG['height']), RO)
+        self.AcquisitionFrameCount = _IntNode('AcquisitionFrameCount', 2, 1, 65535)
+        self._nodemap = _NodeMap([
+            self.PixelFormat, self.ExposureAuto, self.ExposureTime, self.Width, self.Height, self.AcquisitionFrameCount,
+            _EnumNode('AcquisitionMode', ['Continuous', 'SingleFrame', 'MultiFrame'], 'Continuous'),
+            _EnumNode('TriggerMode', ['Off', 'On'], 'Off'),
+            _EnumNode('TriggerSelector', ['FrameStart', 'AcquisitionStart'], 'FrameStart'),
+            _EnumNode('TriggerSource', ['Software', 'Line0', 'Line1', 'Line2', 'Line3'], 'Line0'),
+            _CommandNode('TriggerSoftware', self._softwareTrigger),
+        ])
+        self._stream = _NodeMap([
+            _EnumNode('StreamBufferHandlingMode', ['OldestFirst', 'OldestFirstOverwrite', 'NewestFirst', 'NewestOnly'], 'OldestFirst'),
+            _EnumNode('StreamBufferCountMode', ['Manual', 'Auto'], 'Auto'),
+            _IntNode('StreamBufferCountManual', 10, 1, 1000),
+            _IntNode('StreamLostFrameCount', 0, 0, 2**63 - 1, RO),
+        ])
+
+    def GetTLDeviceNodeMap(self):
+        return self._tlDevice
+
+    def GetNodeMap(self):
+        return self._nodemap
+
+    def GetTLStreamNodeMap(self):
+        return self._stream
+
+    def Init(self):
+        self._initialised = True
+
+    def DeInit(self):
+        if self._streaming:
+            self.EndAcquisition()
+        self._initialised = False
+
+    def IsInitialized(self) -> bool:
+        return self._initialised
+
+    def IsStreaming(self) -> bool:
+        return self._streaming
+
+    def BeginAcquisition(self):
+        if not self._initialised:
+            raise SpinnakerException("Camera is not initialized")
+        if self._streaming:
+            raise SpinnakerException("Camera is already streaming")
+        seed = CONFIG['seed'] if CONFIG['seed'] is None else CONFIG['seed'] + self.index
+        self._rng = np.random.default_rng(seed)
+        self._cloud = _CloudModel(int(CONFIG['width']), int(CONFIG['height']), self._rng)
+        self._period = 1 / CONFIG['triggerRate']
+        self._start = time.perf_counter()
+        self._nextId = 0
+        self._softwareTriggers = 0
+        self._streaming = True
+
+    def EndAcquisition(self):
+        if not self._streaming:
+            raise SpinnakerException("Camera is not streaming")
+        self._streaming = False
+
+    def _softwareTrigger(self):
+        with self._lock:
+            self._softwareTriggers += 1
+            self._lock.notify_all()
+
+    def _softwareTriggered(self) -> bool:
+        nodemap = self._nodemap
+        return nodemap.GetNode('TriggerMode').symbol() == 'On' and nodemap.GetNode('TriggerSource').symbol() == 'Software'
+
+    def _bufferCount(self) -> int:
+        if self._stream.GetNode('StreamBufferCountMode').symbol() == 'Manual':
+            return max(1, int(self._stream.GetNode('StreamBufferCountManual').GetValue()))
+        return 10
+
+    def GetNextImage(self, timeout=None) -> Image:
+        """Block until the next frame is due, like a camera waiting on its trigger."""
+        if not self._streaming:
+            raise SpinnakerException("Camera is not streaming")
+        limit = None if timeout is None else timeout / 1000
+        if self._softwareTriggered():
+            with self._lock:
+                if not self._lock.wait_for(lambda: self._softwareTriggers > 0, limit):
+                    raise SpinnakerException("Timeout waiting for a software trigger")
+                self._softwareTriggers -= 1
+            return self._frame()
+
+        # Triggers keep arriving while the caller is busy; frames the stream
+        # buffers could not hold are lost, like on the real camera
+        newest = int((time.perf_counter() - self._start) / self._period)
+        multiFrame = self._nodemap.GetNode('AcquisitionMode').symbol() == 'MultiFrame'
+        if multiFrame:
+            # Triggers after the end of a burst capture nothing
+            newest = min(newest, self.AcquisitionFrameCount.GetValue() - 1)
+        if self._stream.GetNode('StreamBufferHandlingMode').symbol() in ('NewestOnly', 'NewestFirst'):
+            self._nextId = max(self._nextId, newest)
+        else:
+            self._nextId = max(self._nextId, newest - self._bufferCount() + 1)
+        while self._rng.random() < CONFIG['dropRate']:
+            self._nextId += 1
+            self._stream.GetNode('StreamLostFrameCount').value += 1
+
+        wait = self._start + self._nextId * self._period - time.perf_counter()
+        if multiFrame and self._nextId >= self.AcquisitionFrameCount.GetValue():
+            # The burst is over; the camera sends nothing more until re-armed
+            if limit is None:
+                raise SpinnakerException("Burst complete, no more images")
+            wait = float('inf')
+        if limit is not None and wait > limit:
+            time.sleep(limit)
+            raise SpinnakerException("Timeout waiting for an image")
+        if wait > 0:
+            time.sleep(wait)
+        return self._frame()
+
+    def _frame(self) -> Image:
+        frameId = self._nextId
+        self._nextId += 1
+        tofs = self.tofs or CONFIG['tofs']
+        image = self._cloud.render(tofs[frameId % len(tofs)])
+        if self.PixelFormat.symbol() == 'Mono8':
+            image = (image >> 8).astype(np.uint8)
+        status = IMAGE_STATUS_MISSING_PACKETS if self._rng.random() < CONFIG['incompleteRate'] else IMAGE_STATUS_NO_ERROR
+        return Image(image, frameId, status)
+
+CameraPtr = Camera
+ImagePtr = Image
+INodeMap = _NodeMap
+
+class CameraList:
+    def __init__(self, cameras):
+        self._cameras = list(cameras)
+
+    def GetSize(self):
+        return len(self._cameras)
+
+    def GetByIndex(self, index):
+        return self._cameras[index]
+
+    def __len__(self):
+        return len(self._cameras)
+
+    def __iter__(self):
+        return iter(self._cameras)
+
+    def __getitem__(self, index):
+        return self._cameras[index]
+
+    def Clear(self):
+        self._cameras = []
+
+class System:
+    _instance = None
+    _refs = 0
+
+    @classmethod
+    def GetInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        cls._refs += 1
+        return cls._instance
+
+    def __init__(self):
+        self._cameras = [Camera(i) for i in range(int(CONFIG['cameras']))]
+
+    def GetLibraryVersion(self):
+        return _Version()
+
+    def GetCameras(self):
+        return CameraList(self._cameras)
+
+    def ReleaseInstance(self):
+        System._refs = max(0, System._refs - 1)
+        if System._refs == 0:
+            System._instance = None
+
+SystemPtr = System
@@ -0,0 +1,117 @@
+# Lightweight span tracing for the acquisition and analysis stages.
+#
+# Code wraps the work it wants timed in `with Trace.span('name'):`. Spans
+# go into one bounded ring buffer per process, so tracing a long session
+# never grows memory. The buffer can be summarised as p50/p95 per span
+# name or exported as Chrome trace JSON, which chrome://tracing and
+# https://ui.perfetto.dev open directly.
+
+import collections
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+ENABLED = True
+CAPACITY = 65536
+
+class Span:
+    __slots__ = ('name', 'category', 'thread', 'start', 'end', 'args')
+    def __init__(self, name, category, thread, start, end, args):
+        self.name = name
+        self.category = category
+        self.thread = thread
+        self.start = start
+        self.end = end
+        self.args = args
+
+    @property
+    def duration(self) -> float:
+        return (self.end - self.start) / 1e9
+
+_spans = collections.deque(maxlen=CAPACITY)
+_threadNames = {}
+
+def now() -> int:
+    return time.perf_counter_ns()
+
+def record(name, start:int, end:int=None, category='app', **args):
+    """Add a span that ran from start to end (perf_counter_ns values; end defaults to now)."""
+    if not ENABLED:
+        return
+    thread = threading.get_ident()
+    if thread not in _threadNames:
+        _threadNames[thread] = threading.current_thread().name
+    _spans.append(Span(name, category, thread, start, now() if end is None else end, args or None))
+
+@contextmanager
+def span(name, category='app', **args):
+    if not ENABLED:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        record(name, start, category=category, **args)
+
+def spans(since:int=None) -> list:
+    """Snapshot of the buffered spans, optionally only those starting at or after since."""
+    snapshot = list(_spans)
+    if since is not None:
+        snapshot = [s for s in snapshot if s.start >= since]
+    return snapshot
+
+def clear():
+    _spans.clear()
+
+def summary(since:int=None) -> dict:
+    """{name: {'count', 'p50', 'p95', 'total'}} with times in milliseconds."""
+    durations = collections.defaultdict(list)
+    for s in spans(since):
+        durations[s.name].append(s.duration * 1000)
+    stats = {}
+    for name, values in durations.items():
+        values = np.asarray(values)
+        stats[name] = {
+            'count': len(values),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'total': float(values.sum()),
+        }
+    return stats
+
+def summaryText(since:int=None) -> str:
+    stats = summary(since)
+    if not stats:
+        return "No timing recorded."
+    width = max(len(name) for name in stats)
+    lines = [f"{'stage':<{width}}  {'n':>5}  {'p50 ms':>8}  {'p95 ms':>8}"]
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]['total']):
+        lines.append(f"{name:<{width}}  {s['count']:>5}  {s['p50']:>8.2f}  {s['p95']:>8.2f}")
+    return "\n".join(lines)
+
+def exportChrome(path, since:int=None):
+    """Write the buffered spans as Chrome trace event JSON."""
+    pid = os.getpid()
+    selected = spans(since)
+    origin = min((s.start for s in selected), default=0)
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+              for tid, name in list(_threadNames.items())]
+    for s in selected:
+        event = {
+            'name': s.name,
+            'cat': s.category,
+            'ph': 'X',
+            'pid': pid,
+            'tid': s.thread,
+            'ts': (s.start - origin) / 1000,
+            'dur': (s.end - s.start) / 1000,
+        }
+        if s.args:
+            event['args'] = {k: v if isinstance(v, (int, float, str, bool)) else str(v) for k, v in s.args.items()}
+        events.append(event)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -31,14 +31,24 @@
 # Need help? Check out our forum at: https://teledynevisionsolutions.zendesk.com/hc/en-us/community/topics
 
 import os
-import PySpin
+# MOTTEMP_CAMERA=sim runs against the simulated camera in SimSpin.py
+if os.environ.get('MOTTEMP_CAMERA') == 'sim':
+    import SimSpin as PySpin
+else:
+    import PySpin
 import sys
 import threading
 import time
+import logging
 import MotTemp
-import math
 import numpy as np
-import lmfit as lm
+from matplotlib.patches import Rectangle
+import RunStack
+import IncrementalFit
+import Trace
+from Pipeline import Frame, FramePool, PipelineStage, StageCounters
+
+log = logging.getLogger(__name__)
 
 def Gaussian(x, amp, cen, wid, off):
     """1-d Gaussian: gaussian(x, amp, cen, wid, off)"""
@@ -51,8 +61,22 @@ class TriggerType:
 
 CHOSEN_TRIGGER = TriggerType.HARDWARE
 
+# Also write every frame as a CloudDetection_TOF-<t>ms.tiff file next to the
+# run's frame stack, for tools that still expect the per-TOF TIFFs.
+EXPORT_TIFF = True
+
+# Arm the camera once per run for the whole TOF sequence (MultiFrame with one
+# stream buffer per frame) instead of acquiring continuously frame by frame.
+USE_BURST = True
+
+# Bytes of frame buffers one camera's run may hold in flight. Frames are
+# copied out of the camera into a pool of this size and written to disk from
+# there, so memory use does not grow with the number of TOFs; when the pool
+# is used up, acquisition waits for the save and analysis stages.
+MEMORY_BUDGET = 256 * 2**20
+
 class CamTrigger(threading.Thread):
-    def __init__(self, numImages, trigPath, exposureTime, timeSplit, sigmaFactor, window):
+    def __init__(self, numImages, trigPath, exposureTime, timeSplit, sigmaFactor, window, numWorkers=1, session=None, memoryBudget=None):
         threading.Thread.__init__(self, daemon=True)
         self.numImages = numImages
         self.trigPath = trigPath
@@ -60,82 +84,289 @@ class CamTrigger(threading.Thread):
         self.timeSplit = timeSplit
         self.sigmaFactor = sigmaFactor
         self.window = window
+        self.numWorkers = numWorkers
+        # Long-lived CameraSession from the main window; None opens and
+        # releases the camera for this run only
+        self.session = session
+        self.memoryBudget = memoryBudget if memoryBudget is not None else MEMORY_BUDGET
+        self.stack = None
+        # Buffers for raw frames and, with a calibration, for corrected ones
+        self.framePool = None
+        self.calibratedPool = None
+        self.estimate = IncrementalFit.TemperatureEstimate()
+        # Per-frame profile and fit results from the analysis stage, by TOF slot
+        self.results = [None]*numImages
+        # Camera view artists, created on the first drawFrame
+        self.overlay = None
+        # With several cameras only one draws its frames and running estimate,
+        # and the MultiCamTrigger shows the combined fit instead of each camera's
+        self.showFrames = True
+        self.showResults = True
+        self.fit = None
+        # Master dark and hot-pixel mask for this camera and exposure, if one
+        # has been taken (see Calibration)
+        self.master = None
+        # Hand the camera back as soon as the last frame is in and leave
+        # draining the pipeline and fitting to whoever calls analyse(), as
+        # RepeatTrigger does while the next repetition acquires
+        self.deferAnalysis = False
+        self.saveStage = None
+        # Set when a stop cut the acquisition short; a stop that arrives once
+        # every frame is in leaves the run to be fitted as usual
+        self.interrupted = False
+        self._stop_event = threading.Event()
+    def stop(self):
+        """Stop acquiring after the current frame; the frames already taken stay saved but are not fitted."""
+        self._stop_event.set()
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
     def run(self):
-        self.main()
+        if self.session is not None:
+            self.runSession()
+        else:
+            self.main()
+    def runSession(self) -> bool:
+        """Acquire through the shared CameraSession, which stays initialised and configured between runs."""
+        session = self.session
+        with session.lock:
+            if not session.open():
+                self.window.renderScheduler.showMessage("Error: Cannot find the camera!")
+                return False
+            source = 'Software' if CHOSEN_TRIGGER == TriggerType.SOFTWARE else 'Line3'
+            # Software triggers are typed in one by one, so only hardware runs burst
+            burst = self.numImages if USE_BURST and CHOSEN_TRIGGER == TriggerType.HARDWARE else 0
+            buffers = session.configureTrigger(self.exposureTime, source, burst)
+            if buffers < 0:
+                return False
+            if self.window.calibration is not None:
+                self.master = self.window.calibration.find(session.serialNumber, self.exposureTime, (session.cam.Height.GetValue(), session.cam.Width.GetValue()))
+            self.simulateTofs(session.cam)
+            try:
+                session.cam.BeginAcquisition()
+                try:
+                    if buffers > 0:
+                        result = self.acquireBurst(session.cam, buffers, session.lostFrames)
+                    else:
+                        result = self.acquireFrames(session.cam, session.nodemap)
+                finally:
+                    session.cam.EndAcquisition()
+                    self.simulateTofs(session.cam, False)
+            except PySpin.SpinnakerException as ex:
+                log.error('Error: %s', ex)
+                return False
+        if not self.deferAnalysis:
+            self.analyse()
+        return result
+    def simulateTofs(self, cam, run=True):
+        """Have a simulated camera (see SimSpin) render the cloud at this run's TOFs, or again at its own ones."""
+        if PySpin.__name__ == 'SimSpin':
+            cam.tofs = [float(t) for t in self.timeSplit[:self.numImages]] if run else None
+    def analyse(self):
+        """Post-run analysis once every frame is in."""
+        # A deferred run's stages may still be working through its last frames
+        self.stopPipeline()
+        if self.interrupted:
+            log.info('Run stopped, %d of %d frames analysed', sum(r is not None for r in self.results), self.numImages)
+            self.window.renderScheduler.showMessage("Run stopped; the frames taken so far are saved.")
+            self.finishTrace()
+            return
+        # Frames the analysis stage could not handle are analysed from the
+        # run stack now; every other frame was already profiled and fitted,
+        # so only the physics fits remain
+        written = self.stack.index['written'] if self.stack is not None else [False]*self.numImages
+        for i in range(self.numImages):
+            if written[i] and self.results[i] is None:
+                frame = self.calibrateFrame(Frame(i, self.timeSplit[i], self.stack.frame(i)))
+                self.results[i] = MotTemp.analyseFrame(frame.image, self.sigmaFactor)[1]
+                frame.release()
+        keep = [i for i in range(self.numImages) if self.results[i] is not None]
+        if len(keep) < 3:
+            log.error('Only %d of %d frames were captured, not enough to fit', len(keep), self.numImages)
+            self.window.renderScheduler.showMessage(f"Error: only {len(keep)} of {self.numImages} frames were captured.")
+            self.finishTrace()
+            return
+        if len(keep) < self.numImages:
+            missing = [self.timeSplit[i] for i in range(self.numImages) if i not in keep]
+            log.warning('%d of %d frames are missing (TOF %s ms), fitting the remaining ones', len(missing), self.numImages, missing)
+        calibration = self.master.path if self.master is not None else None
+        self.fit = MotTemp.mainFromFrames(self.trigPath, self.window, [self.timeSplit[i] for i in keep], self.sigmaFactor, [self.results[i] for i in keep], self.window.analysisCache, self.showResults, calibration)
+        if self.window.runCatalog is not None:
+            self.window.runCatalog.recordAnalysis(self.trigPath, self.sigmaFactor, self.fit)
+        self.finishTrace()
+    def createStack(self, shape):
+        """
+        Preallocate the run's frame stack, recording the camera and the
+        calibration applied to it, and the frame pools sized to the memory
+        budget.
+        """
+        shape = tuple(shape)
+        self.stack = RunStack.RunStack.create(self.trigPath, self.timeSplit[:self.numImages], shape, self.exposureTime)
+        if self.session is not None:
+            self.stack.index['camera'] = self.session.serialNumber
+        if self.master is not None and self.master.shape != shape:
+            log.warning('Calibration is %s, frames are %s; not applying it', self.master.shape, shape)
+            self.master = None
+        if self.master is not None:
+            self.stack.index['calibration'] = os.path.basename(self.master.path)
+        pixels = shape[0] * shape[1]
+        # A frame in flight takes a uint16 buffer and, calibrated, a float32 one
+        count = FramePool.countFor(self.memoryBudget, pixels * (6 if self.master is not None else 2), self.numImages)
+        self.framePool = FramePool(shape, np.uint16, count)
+        self.calibratedPool = FramePool(shape, np.float32, count) if self.master is not None else None
+    def pooledFrame(self, index, image) -> Frame:
+        """Copy a camera image into a pool buffer, to be released by the save and analysis stages."""
+        with Trace.span('framePool', 'acquire', index=index):
+            buffer = self.framePool.acquire(users=2)
+        np.copyto(buffer, image)
+        return Frame(index, self.timeSplit[index], buffer, self.framePool)
+    def calibrateFrame(self, frame:Frame) -> Frame:
+        """Calibration stage: dark-subtract the frame in float32 and patch its hot pixels before analysis."""
+        if self.master is None:
+            return frame
+        out = self.calibratedPool.acquire()
+        try:
+            self.master.apply(frame.image, out)
+        except Exception:
+            self.calibratedPool.release(out)
+            raise
+        finally:
+            frame.release()
+        return Frame(frame.index, frame.tof, out, self.calibratedPool)
     def drawStdDev(self, image_in):
-        image = np.copy(image_in)
-        binx, biny = MotTemp.getIntegratedBins(image)
-        peakX = binx.index(max(binx))
-        peakY = biny.index(max(biny))
-        x1d, y1d = MotTemp.get1DArray(image, peakX, peakY)
-        stdx, stdy = MotTemp.getStdDev(image)
-
-        stdx = math.floor(stdx)
-        stdy = math.floor(stdy)
-
-        print(stdx)
-        print(stdy)
-
-        roi_x, roi_y = MotTemp.getROI(image, stdx, stdy, peakX, peakY, self.sigmaFactor)
-
-        for j in range(max(0, math.floor(peakX - (stdx*self.sigmaFactor))), min(len(image[peakY]), math.floor(peakX + (stdx*self.sigmaFactor)))):
-            image[max(0, peakY-(stdy))][j] = 65535
-            image[min(len(image)-1, peakY+(stdy*self.sigmaFactor))][j] = 65535
-        for i in range(max(0, math.floor(peakY - (stdy*self.sigmaFactor))), min(len(image), math.floor(peakY + (stdy*self.sigmaFactor))+1)):
-            image[i][max(0, peakX-(stdx*self.sigmaFactor))] = 65535
-            image[i][min(len(image[i])-1, peakX+(stdx*self.sigmaFactor))] = 65535
-
-        for i in range(len(image)):
-            image[i][peakX] = 65535
-        for j in range(len(image[0])):
-            image[peakY][j] = 65535
-
-        np_roi_x = np.asarray(roi_x)
-        min_roi_x = list(np_roi_x - min(roi_x))
-
-        np_roi_y = np.asarray(roi_y)
-        min_roi_y = list(np_roi_y - min(roi_y))
-
-        std_roi_x, std_roi_y = MotTemp.getROIStdDev(min_roi_x, min_roi_y)
-
-        x_pos = list(range(max(0, math.floor(peakX - (stdx*self.sigmaFactor))), min(len(image[0]), math.floor(peakX + (stdx*self.sigmaFactor)))))
-        y_pos = list(range(max(0, math.floor(peakY - (stdy*self.sigmaFactor))), min(len(image), math.floor(peakY + (stdy*self.sigmaFactor))+1)))
-
-        mod = lm.Model(Gaussian)
-        peak = roi_x.index(max(roi_x))
-        p_wid = lm.Parameter(name='wid', value=std_roi_x)
-        p_off = lm.Parameter(name='off', value=min(roi_x))
-        p_amp = lm.Parameter(name='amp', value=roi_x[peak] - min(roi_x))
-        p_cen = lm.Parameter(name='cen', value=(x_pos[peak]))
-        params = lm.Parameters()
-        params.add_many(p_amp, p_cen, p_wid, p_off)
-        out = mod.fit(np.array(roi_x), params, x=np.array(x_pos))
-        self.window.camWidget.axes[1].plot(x_pos, out.best_fit)
-        mod = lm.Model(Gaussian)
-        peak = roi_y.index(max(roi_y))
-        p_wid = lm.Parameter(name='wid', value=std_roi_y)
-        p_off = lm.Parameter(name='off', value=min(roi_y))
-        p_amp = lm.Parameter(name='amp', value=roi_y[peak] - min(roi_y))
-        p_cen = lm.Parameter(name='cen', value=(y_pos[peak]))
-        params = lm.Parameters()
-        params.add_many(p_amp, p_cen, p_wid, p_off)
-        out = mod.fit(np.array(roi_y), params, x=np.array(y_pos))
-        best_fit = list(out.best_fit)
-        best_fit.reverse()
-        self.window.camWidget.axes[2].plot(best_fit, y_pos)
-
-        y1d.reverse()
-        self.window.camWidget.axes[1].scatter(range(len(x1d)), x1d, c='tab:orange')
-        self.window.camWidget.axes[2].scatter(y1d, range(len(y1d)), c='tab:orange')
-
-        self.window.camWidget.axes[0].imshow(image, cmap="gray")
-        self.window.camWidget.axes[0].title.set_text("Camera View")
-        self.window.camWidget.axes[1].title.set_text("X-Axis Profile")
-        self.window.camWidget.axes[2].title.set_text("Y-Axis Profile")
-        self.window.camWidget.draw()
-        self.window.camWidget.axes[0].cla()
-        self.window.camWidget.axes[1].cla()
-        self.window.camWidget.axes[2].cla()
+        self.displayFrame(self.analyseFrame(Frame(-1, 0., image_in)))
+    def analyseFrame(self, frame:Frame):
+        """Analysis stage: profile the frame and fit both ROI profiles, keeping the result for the post-run fits."""
+        try:
+            profile, result = MotTemp.analyseFrame(frame.image, self.sigmaFactor)
+
+            log.debug('Frame %d: stdx %d, stdy %d', frame.index, profile.stdx, profile.stdy)
+
+            if frame.index >= 0:
+                self.results[frame.index] = result
+                self.updateEstimate(frame, result.xvals, result.yvals)
+            x_fit = Gaussian(MotTemp.toMetres(profile.x_pos), **result.xvals)
+            y_fit = Gaussian(MotTemp.toMetres(profile.y_pos), **result.yvals)
+            if frame.pool is None:
+                return (frame, profile, x_fit, y_fit)
+            # A pooled buffer is reused as soon as it is released, so the
+            # display gets its own copy, and only when it is idle and would
+            # take the frame
+            if not (self.showFrames and self.displayStage.queue.empty()):
+                return None
+            profile = profile._replace(x1d=profile.x1d.copy(), y1d=profile.y1d.copy(), roi_x=result.roi_x, roi_y=result.roi_y)
+            return (Frame(frame.index, frame.tof, frame.image.copy()), profile, x_fit, y_fit)
+        finally:
+            frame.release()
+    def updateEstimate(self, frame:Frame, xvals:dict, yvals:dict):
+        """Fold one frame's fit (in metres) into the running temperature estimate and show it."""
+        self.estimate.add(frame.tof/1000, xvals['cen'], xvals['wid'], yvals['cen'], yvals['wid'])
+        if self.showFrames:
+            self.window.renderScheduler.setText(self.window.tempLabel, self.estimate.text())
+    def displayFrame(self, analysed):
+        """Display stage: hand the raw frame and its profile to the render scheduler."""
+        frame, profile, x_fit, y_fit = analysed
+        self.window.renderScheduler.post(self.window.camWidget, lambda: self.drawFrame(frame.image, profile, x_fit, y_fit), key='frame')
+    def createOverlay(self, image):
+        """Create the persistent camera view, ROI overlay and profile artists that drawFrame moves."""
+        axes = self.window.camWidget.axes
+        for ax in axes:
+            ax.cla()
+        overlay = {
+            'image': axes[0].imshow(image, cmap="gray"),
+            'roi': Rectangle((0, 0), 0, 0, fill=False, edgecolor='white', linewidth=1),
+            'sigma': Rectangle((0, 0), 0, 0, fill=False, edgecolor='white', linewidth=0.8, linestyle='--'),
+            'hline': axes[0].axhline(0, color='white', linewidth=0.8),
+            'vline': axes[0].axvline(0, color='white', linewidth=0.8),
+            'xFit': axes[1].plot([], [])[0],
+            'yFit': axes[2].plot([], [])[0],
+            'xData': axes[1].plot([], [], 'o', color='tab:orange')[0],
+            'yData': axes[2].plot([], [], 'o', color='tab:orange')[0],
+            'shape': image.shape,
+        }
+        axes[0].add_patch(overlay['roi'])
+        axes[0].add_patch(overlay['sigma'])
+        axes[0].title.set_text("Camera View")
+        axes[1].title.set_text("X-Axis Profile")
+        axes[2].title.set_text("Y-Axis Profile")
+        return overlay
+    def drawFrame(self, image, profile, x_fit, y_fit):
+        """Runs on the GUI thread through the render scheduler; only moves existing artists."""
+        axes = self.window.camWidget.axes
+        if self.overlay is None or self.overlay['shape'] != image.shape or self.overlay['image'] not in axes[0].get_images():
+            self.overlay = self.createOverlay(image)
+        overlay = self.overlay
+        peakX, peakY = profile.peakX, profile.peakY
+        stdx, stdy = profile.stdx, profile.stdy
+
+        overlay['image'].set_data(image)
+        overlay['image'].set_clim(image.min(), image.max())
+        x0, x1, y0, y1 = MotTemp.getROIBounds(image.shape, stdx, stdy, peakX, peakY, self.sigmaFactor)
+        overlay['roi'].set_bounds(x0 - 0.5, y0 - 0.5, x1 - x0, y1 - y0)
+        overlay['sigma'].set_bounds(peakX - stdx, peakY - stdy, 2*stdx, 2*stdy)
+        overlay['hline'].set_ydata([peakY, peakY])
+        overlay['vline'].set_xdata([peakX, peakX])
+
+        y1d = profile.y1d[::-1]
+        overlay['xFit'].set_data(profile.x_pos, x_fit)
+        overlay['yFit'].set_data(y_fit[::-1], profile.y_pos)
+        overlay['xData'].set_data(np.arange(len(profile.x1d)), profile.x1d)
+        overlay['yData'].set_data(y1d, np.arange(len(y1d)))
+        for ax in axes[1:]:
+            ax.relim()
+            ax.autoscale_view()
+    def saveFrame(self, frame:Frame):
+        """Save stage: commit the frame's stack slot and optionally export it as a TIFF."""
+        try:
+            with Trace.span('Save', 'save', index=frame.index):
+                self.stack.store(frame.index, frame.image)
+                self.stack.markWritten(frame.index)
+                if EXPORT_TIFF:
+                    self.stack.exportTiff(frame.index, frame.image)
+                    log.debug('Image saved at %s', RunStack.tiffName(frame.tof))
+        finally:
+            frame.release()
+        self.window.renderScheduler.showMessage(f"Captured image {frame.index+1} of {self.numImages}...")
+    def startPipeline(self):
+        """Start the save, analysis and display consumer stages."""
+        self.traceStart = Trace.now()
+        self.displayStage = PipelineStage('display', self.displayFrame, maxDepth=1, dropWhenFull=True)
+        # Every frame feeds the running temperature estimate, so analysis keeps
+        # up with the whole run instead of dropping; only the display skips frames
+        self.analysisStage = PipelineStage('analysis', self.analyseFrame, maxDepth=max(1, self.numImages), downstream=[self.displayStage] if self.showFrames else [])
+        # Frames are calibrated on their way to analysis; the stack keeps the raw frames
+        self.calibrateStage = PipelineStage('calibrate', self.calibrateFrame, maxDepth=max(1, self.numImages), downstream=[self.analysisStage]) if self.master is not None else None
+        self.analysisInput = self.calibrateStage or self.analysisStage
+        # Every frame has to reach the disk, so the save queue holds a whole run
+        self.saveStage = PipelineStage('save', self.saveFrame, maxDepth=max(1, self.numImages))
+        self.acquireCounters = StageCounters('acquire')
+        for stage in (self.displayStage, self.analysisStage, self.calibrateStage, self.saveStage):
+            if stage is not None:
+                stage.start()
+    def stopPipeline(self):
+        """Drain every stage, flush the frame stack and log the stage counters; does nothing once they are stopped."""
+        if self.saveStage is None:
+            return
+        self.saveStage.close()
+        self.analysisInput.close()
+        if self.stack is not None:
+            self.stack.close()
+        log.info('%s', self.acquireCounters)
+        if self.framePool is not None:
+            log.info('%s', self.framePool)
+        for stage in (self.saveStage, self.calibrateStage, self.analysisStage, self.displayStage):
+            if stage is not None:
+                log.info('%s', stage.counters)
+        log.info('Running estimate: %s', self.estimate.text())
+        self.saveStage = None
+    def finishTrace(self):
+        """Write the run's spans next to its frames and show the per-stage timing."""
+        since = getattr(self, 'traceStart', None)
+        if since is None:
+            return
+        if os.path.isdir(self.trigPath):
+            Trace.exportChrome(f"{self.trigPath}trace.json", since)
+        if self.showResults:
+            self.window.renderScheduler.setText(self.window.timingText, Trace.summaryText(since))
     def configure_trigger(self, cam):
         """
         This function configures the camera to use a trigger. First, trigger mode is
@@ -295,7 +526,7 @@ class CamTrigger(threading.Thread):
                 # TODO: Blackfly and Flea3 GEV cameras need 2 second delay after software trigger
 
             elif CHOSEN_TRIGGER == TriggerType.HARDWARE:
-                print('Use the hardware to trigger image acquisition.')
+                log.debug('Use the hardware to trigger image acquisition.')
 
         except PySpin.SpinnakerException as ex:
             print('Error: %s' % ex)
@@ -345,6 +576,7 @@ class CamTrigger(threading.Thread):
             print('Acquisition mode set to continuous...')
 
             #  Begin acquiring images
+            self.simulateTofs(cam)
             cam.BeginAcquisition()
 
             print('Acquiring images...')
@@ -373,85 +605,156 @@ class CamTrigger(threading.Thread):
             # processor will default to NEAREST_NEIGHBOR method.
             #processor.SetColorProcessing(PySpin.SPINNAKER_COLOR_PROCESSING_ALGORITHM_HQ_LINEAR)
 
+            result &= self.acquireFrames(cam, nodemap)
+
+            # End acquisition
+            #
+            #  *** NOTES ***
+            #  Ending acquisition appropriately helps ensure that devices clean up
+            #  properly and do not need to be power-cycled to maintain integrity.
+            cam.EndAcquisition()
+
+        except PySpin.SpinnakerException as ex:
+            print('Error: %s' % ex)
+            return False
+
+        return result
+
+
+    def acquireFrames(self, cam, nodemap) -> bool:
+        """Grab numImages triggered frames from a camera that is already acquiring."""
+        result = True
+        # Saving, analysis and display run in their own consumer stages so
+        # this loop only grabs, copies and releases frames and is always
+        # back in GetNextImage before the next hardware trigger arrives.
+        self.startPipeline()
+        try:
             for i in range(self.numImages):
-                self.window.statusbar.showMessage(f"Waiting on trigger (image {i+1} of {self.numImages})...")
+                if self.stopped():
+                    self.interrupted = True
+                    break
+                self.window.renderScheduler.showMessage(f"Waiting on trigger (image {i+1} of {self.numImages})...")
                 try:
 
                     #  Retrieve the next image from the trigger
-                    result &= self.grab_next_image_by_trigger(nodemap, cam)
+                    with Trace.span('triggerWait', 'acquire', index=i):
+                        result &= self.grab_next_image_by_trigger(nodemap, cam)
 
                     #  Retrieve next received image
-                    image_result:PySpin.ImagePtr = cam.GetNextImage(10000)
+                    with Trace.span('GetNextImage', 'acquire', index=i):
+                        image_result:PySpin.ImagePtr = cam.GetNextImage(10000)
+                    start = time.perf_counter()
 
                     #  Ensure image completion
                     if image_result.IsIncomplete():
-                        print('Image incomplete with image status %d ...' % image_result.GetImageStatus())
+                        log.warning('Image incomplete with image status %d ...', image_result.GetImageStatus())
+                        self.acquireCounters.drop()
 
                     else:
 
                         #  Print image information; height and width recorded in pixels
-                        #
-                        #  *** NOTES ***
-                        #  Images have quite a bit of available metadata including
-                        #  things such as CRC, image status, and offset values, to
-                        #  name a few.
                         width = image_result.GetWidth()
                         height = image_result.GetHeight()
-                        print('Grabbed Image %d, width = %d, height = %d' % (i, width, height))
-
-                        #  Convert image to mono 8
-                        #
-                        #  *** NOTES ***
-                        #  Images can be converted between pixel formats by using
-                        #  the appropriate enumeration value. Unlike the original
-                        #  image, the converted one does not need to be released as
-                        #  it does not affect the camera buffer.
-                        #
-                        #  When converting images, color processing algorithm is an
-                        #  optional parameter.
-                        #image_converted = processor.Convert(image_result, PySpin.PixelFormat_Mono8)
-
-                        # Create a unique filename
-                        filename = f'CloudDetection_TOF-{self.timeSplit[i]}ms.tiff'
-
-                        # Save image
-                        #
-                        #  *** NOTES ***
-                        #  The standard practice of the examples is to use device
-                        #  serial numbers to keep images of one device from
-                        #  overwriting those of another.
-                        image_result.Save(f"{self.trigPath}{filename}", PySpin.TIFFOption())
-                        print('Image saved at %s\n' % filename)
-                        self.window.statusbar.showMessage(f"Captured image {i+1} of {self.numImages}...")
-
-                        image_np = image_result.GetNDArray()
-
-                        self.drawStdDev(image_np)
-
-                        #  Release image
-                        #
-                        #  *** NOTES ***
-                        #  Images retrieved directly from the camera (i.e. non-converted
-                        #  images) need to be released in order to keep from filling the
-                        #  buffer.
-                        image_result.Release()
+                        log.debug('Grabbed Image %d, width = %d, height = %d', i, width, height)
+
+                        #  Copy the frame out of the camera buffer into a pool
+                        #  buffer; the camera buffer is handed back to the
+                        #  driver right below.
+                        with Trace.span('GetNDArray', 'acquire', index=i):
+                            image_np = image_result.GetNDArray()
+                            if self.stack is None:
+                                self.createStack(image_np.shape)
+                            frame = self.pooledFrame(i, image_np)
+                        self.saveStage.put(frame)
+                        self.analysisInput.put(frame)
+
+                    #  Release image
+                    #
+                    #  *** NOTES ***
+                    #  Images retrieved directly from the camera (i.e. non-converted
+                    #  images) need to be released in order to keep from filling the
+                    #  buffer.
+                    image_result.Release()
+                    self.acquireCounters.record(time.perf_counter() - start)
 
                 except PySpin.SpinnakerException as ex:
                     print('Error: %s' % ex)
                     return False
+        finally:
+            if not self.deferAnalysis:
+                self.stopPipeline()
+        return result
 
-            # End acquisition
-            #
-            #  *** NOTES ***
-            #  Ending acquisition appropriately helps ensure that devices clean up
-            #  properly and do not need to be power-cycled to maintain integrity.
-            cam.EndAcquisition()
-
-        except PySpin.SpinnakerException as ex:
-            print('Error: %s' % ex)
-            return False
 
-        return result
+    def acquireBurst(self, cam, buffers, lostFrames=None) -> bool:
+        """
+        Drain an armed numImages-frame burst into the preallocated run stack.
+
+        The stack and frame pools are created from the sensor size before
+        the first trigger, and each frame is copied into a pool buffer and
+        released, so the stream buffers never fill up. Slots follow the camera's frame IDs
+        counted from the start of the burst: a gap in the IDs leaves
+        the lost TOFs unwritten instead of shifting every later frame onto
+        the wrong TOF. Frames lost before the first one that arrives leave
+        no gap, so the start is found from the stream's lost-frame counter
+        (lostFrames(), see CameraSession.lostFrames) when the first frame
+        arrives, and the counter is checked again once the burst is over.
+        """
+        self.createStack((cam.Height.GetValue(), cam.Width.GetValue()))
+        self.window.renderScheduler.showMessage(f"Armed for a {self.numImages}-frame burst ({buffers} stream buffers)...")
+        firstId = None
+        expected = 0
+        lost = 0
+        baseline = lostFrames() if lostFrames is not None else None
+        self.startPipeline()
+        try:
+            while expected < self.numImages and not self.stopped():
+                try:
+                    with Trace.span('GetNextImage', 'acquire', index=expected):
+                        image_result = cam.GetNextImage(10000)
+                except PySpin.SpinnakerException as ex:
+                    log.warning('Burst ended after %d of %d frames: %s', expected - lost, self.numImages, ex)
+                    lost += self.numImages - expected
+                    break
+                start = time.perf_counter()
+                try:
+                    frameId = image_result.GetFrameID()
+                    if firstId is None:
+                        # Every frame the stream lost so far came before this one
+                        firstId = frameId - (lostFrames() - baseline if baseline is not None else 0)
+                    slot = frameId - firstId
+                    if slot < expected or slot >= self.numImages:
+                        log.warning('Frame ID %d is outside the burst, discarded', frameId)
+                        continue
+                    if slot > expected:
+                        log.warning('Frame IDs %d to %d missing, TOF slots %d to %d lost', firstId + expected, frameId - 1, expected, slot - 1)
+                        lost += slot - expected
+                        for _ in range(slot - expected):
+                            self.acquireCounters.drop()
+                    expected = slot + 1
+                    if image_result.IsIncomplete():
+                        log.warning('Image incomplete with image status %d ...', image_result.GetImageStatus())
+                        self.acquireCounters.drop()
+                        lost += 1
+                        continue
+                    with Trace.span('GetNDArray', 'acquire', index=slot):
+                        frame = self.pooledFrame(slot, image_result.GetNDArray())
+                    self.saveStage.put(frame)
+                    self.analysisInput.put(frame)
+                finally:
+                    image_result.Release()
+                self.acquireCounters.record(time.perf_counter() - start)
+        finally:
+            if not self.deferAnalysis:
+                self.stopPipeline()
+        self.interrupted = self.stopped() and expected < self.numImages
+        if baseline is not None:
+            counted = lostFrames() - baseline
+            if counted > lost:
+                log.warning('The stream lost %d frames but only %d TOF slots were found missing; TOFs may be mislabelled', counted, lost)
+        if lost:
+            log.warning('%d of %d burst frames lost', lost, self.numImages)
+        return lost == 0
 
 
     def reset_trigger(self, nodemap):
@@ -612,7 +915,7 @@ class CamTrigger(threading.Thread):
             system.ReleaseInstance()
 
             print('Not enough cameras!')
-            self.window.statusbar.showMessage("Error: Cannot find the camera!")
+            self.window.renderScheduler.showMessage("Error: Cannot find the camera!")
             return False
 
         # Run example on each camera
@@ -636,10 +939,190 @@ class CamTrigger(threading.Thread):
         # Release system instance
         system.ReleaseInstance()
 
-        MotTemp.main(self.trigPath, self.numImages, self.window, self.timeSplit, self.sigmaFactor)
+        self.analyse()
 
         return result
 
 
+class MultiCamTrigger(threading.Thread):
+    """
+    One TOF run on every camera of a CameraRig at once.
+
+    All cameras wait on the same hardware trigger. Each one gets its own
+    CamTrigger worker with its own acquisition loop and save, analysis and
+    display stages, writing to a Cam<serial>/ subdirectory of the run, so a
+    slow or failing camera never holds up the others. Once every worker is
+    done their physics fits are combined (see MotTemp.combineRuns). With a
+    single camera this is a plain CamTrigger run in the run directory itself.
+    """
+    def __init__(self, numImages, trigPath, exposureTime, timeSplit, sigmaFactor, window, numWorkers=1, rig=None, memoryBudget=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.numImages = numImages
+        self.trigPath = trigPath
+        self.exposureTime = exposureTime
+        self.timeSplit = timeSplit
+        self.sigmaFactor = sigmaFactor
+        self.window = window
+        self.numWorkers = numWorkers
+        self.rig = rig
+        self.memoryBudget = memoryBudget if memoryBudget is not None else MEMORY_BUDGET
+        self.workers = []
+        # As CamTrigger.deferAnalysis: acquire() returns once every camera is
+        # done and the caller runs analyse() itself
+        self.deferAnalysis = False
+        # The combined fit, or the only camera's fit, once analysed
+        self.result = None
+        # False leaves showing the result to the caller
+        self.showResults = True
+        self._stop_event = threading.Event()
+    def stop(self):
+        """Stop every camera's acquisition after its current frame."""
+        self._stop_event.set()
+        for worker in list(self.workers):
+            worker.stop()
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+    def run(self):
+        if self.acquire() and not self.deferAnalysis:
+            self.analyse()
+    def acquire(self) -> bool:
+        """Run every camera's acquisition (and, unless deferred, its analysis); False if there is no camera."""
+        sessions = self.rig.open()
+        if not sessions:
+            self.window.renderScheduler.showMessage("Error: Cannot find the camera!")
+            return False
+        self.start = Trace.now()
+        for i, session in enumerate(sessions):
+            path = self.trigPath if len(sessions) == 1 else f"{self.trigPath}Cam{session.serialNumber or session.index}/"
+            os.makedirs(path, exist_ok=True)
+            # The memory budget is shared between the cameras
+            worker = CamTrigger(self.numImages, path, self.exposureTime, self.timeSplit, self.sigmaFactor, self.window, self.numWorkers, session, self.memoryBudget // len(sessions))
+            worker.name = f"CamTrigger-{session.serialNumber or session.index}"
+            worker.showFrames = i == 0
+            worker.showResults = self.showResults and len(sessions) == 1
+            worker.deferAnalysis = self.deferAnalysis
+            if self.stopped():
+                worker.stop()
+            self.workers.append(worker)
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            worker.join()
+        return True
+    def analyse(self):
+        """Fit each camera's frames, if acquire() left that to us, and combine the cameras' fits."""
+        if self.deferAnalysis:
+            threads = [threading.Thread(target=worker.analyse, name=f"{worker.name}-analyse", daemon=True) for worker in self.workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if len(self.workers) == 1 or any(w.interrupted for w in self.workers):
+            self.result = self.workers[0].fit if self.workers else None
+            return
+        fits = {w.session.serialNumber or str(w.session.index): w.fit for w in self.workers if w.fit is not None}
+        for worker in self.workers:
+            if worker.fit is None:
+                log.warning('Camera %s has no fit, leaving it out of the combined result', worker.session.serialNumber)
+        if not fits:
+            self.window.renderScheduler.showMessage("Error: no camera captured enough frames to fit.")
+            return
+        combined = MotTemp.combineRuns(fits)
+        log.info('%s', combined['text'])
+        self.result = combined
+        if not self.showResults:
+            return
+        self.window.renderScheduler.post(self.window.analysisWidget, lambda: MotTemp.showCombined(self.window, combined), key='run')
+        self.window.renderScheduler.setText(self.window.timingText, Trace.summaryText(self.start))
+        self.window.renderScheduler.showMessage(f"Processing finished for {len(fits)} of {len(self.workers)} cameras.")
+
+class RepeatTrigger(threading.Thread):
+    """
+    The same TOF run repeated back to back, for statistics over repetitions.
+
+    Each repetition is a MultiCamTrigger run in its own run directory. Its
+    cameras are handed back as soon as the last frame is in, and draining
+    its stages, the physics fits and combining the cameras happen on an
+    analysis thread while the next repetition acquires. Only one repetition
+    is analysed at a time: if a fit takes longer than a whole acquisition,
+    the next repetition waits for it rather than letting runs pile up in
+    memory. Each result is shown as it comes in, with the mean and spread
+    of g and the temperatures over the repetitions so far.
+
+    The whole sequence is one acquisition job, and its analysis threads
+    belong to it, so JobScheduler never holds them back for acquisition.
+    """
+    def __init__(self, runPaths, numImages, exposureTime, timeSplit, sigmaFactor, window, numWorkers=1, rig=None, memoryBudget=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.runPaths = runPaths
+        self.numImages = numImages
+        self.exposureTime = exposureTime
+        self.timeSplit = timeSplit
+        self.sigmaFactor = sigmaFactor
+        self.window = window
+        self.numWorkers = numWorkers
+        self.rig = rig
+        # One repetition acquires while the one before it is analysed
+        self.memoryBudget = (memoryBudget if memoryBudget is not None else MEMORY_BUDGET) // 2
+        # (run directory, fit or combined fit) of every repetition analysed
+        self.results = []
+        # The repetition being acquired; only it is stopped by stop()
+        self.current = None
+        self._currentLock = threading.Lock()
+        self._stop_event = threading.Event()
+    def stop(self):
+        """Stop the repetition being acquired and start no more; the ones already taken are still analysed."""
+        with self._currentLock:
+            self._stop_event.set()
+            if self.current is not None:
+                self.current.stop()
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+    def run(self):
+        start = time.perf_counter()
+        acquiring = 0.
+        analysis = None
+        for k, path in enumerate(self.runPaths):
+            if self.stopped():
+                break
+            self.window.renderScheduler.showMessage(f"Repetition {k+1} of {len(self.runPaths)}: initializing camera...")
+            run = MultiCamTrigger(self.numImages, path, self.exposureTime, self.timeSplit, self.sigmaFactor, self.window, self.numWorkers, self.rig, self.memoryBudget)
+            run.deferAnalysis = True
+            run.showResults = False
+            with self._currentLock:
+                self.current = run
+                if self.stopped():
+                    run.stop()
+            acquireStart = time.perf_counter()
+            acquired = run.acquire()
+            with self._currentLock:
+                self.current = None
+            if not acquired:
+                break
+            acquiring += time.perf_counter() - acquireStart
+            log.info('Repetition %d of %d acquired in %.2f s', k+1, len(self.runPaths), time.perf_counter() - acquireStart)
+            if analysis is not None:
+                with Trace.span('waitForAnalysis', 'acquire', index=k):
+                    analysis.join()
+            analysis = threading.Thread(target=self.analyseRepetition, args=(run,), name=f"Repetition-{k+1}-analyse", daemon=True)
+            analysis.start()
+        if analysis is not None:
+            analysis.join()
+        elapsed = time.perf_counter() - start
+        log.info('%d of %d repetitions analysed in %.1f s, %.1f s of it acquiring', len(self.results), len(self.runPaths), elapsed, acquiring)
+        if self.results:
+            self.window.renderScheduler.showMessage(f"{len(self.results)} of {len(self.runPaths)} repetitions finished in {elapsed:.1f} s ({acquiring:.1f} s acquiring).")
+    def analyseRepetition(self, run:MultiCamTrigger):
+        with Trace.span('repetition', 'analysis'):
+            run.analyse()
+        if run.result is None:
+            return
+        self.results.append((run.trigPath, run.result))
+        summary = MotTemp.summariseRepeats(self.results)
+        log.info('%s', summary['text'])
+        result = run.result
+        self.window.renderScheduler.post(self.window.analysisWidget, lambda: MotTemp.showRepeats(self.window, result, summary), key='run')
+        self.window.renderScheduler.showMessage(f"Repetition {len(self.results)} of {len(self.runPaths)} analysed.")
+
 if __name__ == '__main__':
     sys.exit(0)
@@ -1,17 +1,24 @@
-from PyQt6 import QtCore, QtWidgets, uic
+from PyQt6 import QtCore, QtGui, QtWidgets, uic
 import sys
+import logging
 import matplotlib as plt
 plt.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from matplotlib.figure import Figure
 import AcquireAndDisplay
 import Trigger
-import PySpin
 import threading
 import os
 import datetime
 import subprocess
 import MotTemp
+import AnalysisCache
+import RenderScheduler
+import CameraSession
+import Calibration
+import RunCatalog
+import JobScheduler
+import LiveMetrics
 import numpy as np
 
 class MplCanvasCam(FigureCanvasQTAgg):
@@ -44,6 +51,19 @@ class MplCanvasAnalysis(FigureCanvasQTAgg):
         self.axes[2][0].set_ylabel("Position (m)")
         super(MplCanvasAnalysis, self).__init__(fig)
 
+class MplCanvasMetrics(FigureCanvasQTAgg):
+    def __init__(self, parent=None, width=100, height=100, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi, constrained_layout=True)
+        self.axes = fig.subplots(nrows=3, ncols=1, sharex=True)
+        self.axes[0].title.set_text("Centre")
+        self.axes[1].title.set_text("Width")
+        self.axes[2].title.set_text("Peak Amplitude")
+        self.axes[0].set_ylabel("Pixel")
+        self.axes[1].set_ylabel("Pixel")
+        self.axes[2].set_ylabel("Pixel Intensity")
+        self.axes[2].set_xlabel("Time (s)")
+        super(MplCanvasMetrics, self).__init__(fig)
+
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, *args, **kargs):
         super(MainWindow, self).__init__(*args, **kargs)
@@ -51,14 +71,28 @@ class MainWindow(QtWidgets.QMainWindow):
         curDate = datetime.datetime.now(datetime.timezone.utc)
         datePath = curDate.strftime("%Y/%m/%d/")
         self.trigPath = f"{os.getcwd()}/Data/{datePath}"
-        if os.path.exists(self.trigPath):
-            self.runCount = 1
-            while os.path.exists(f"{self.trigPath}Run{self.runCount}"):
-                self.runCount += 1
-        else:
-            self.runCount = 1
+        self.analysisCache = AnalysisCache.AnalysisCache(f"{os.getcwd()}/Data/.cache/")
+        self.calibration = Calibration.CalibrationStore(f"{os.getcwd()}/Data/.calibration/")
+        self.runCatalog = RunCatalog.RunCatalog(f"{os.getcwd()}/Data/")
+        self.renderScheduler = RenderScheduler.RenderScheduler(self.statusbar, self.tabWidget, self)
+        # Acquisition, live view and analysis all run as jobs of this scheduler
+        self.jobScheduler = JobScheduler.JobScheduler(self.renderScheduler.showMessage)
+        # The cameras stay initialised and configured from the first run until the window closes
+        self.cameraRig = CameraSession.CameraRig()
+        self.tempLabel = QtWidgets.QLabel()
+        self.statusbar.addPermanentWidget(self.tempLabel)
+        self.timingText.setFont(QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.SystemFont.FixedFont))
+        self.runCount = self.runCatalog.nextRun(curDate.date())
+        # Runs added or changed since the last session are picked up in the background
+        threading.Thread(target=self.runCatalog.refresh, daemon=True).start()
         self.camRunButton.pressed.connect(self.runCameraTrigger)
         self.camModeCombo.currentIndexChanged.connect(self.camModeChanged)
+        self.camStopButton.pressed.connect(self.stopAll)
+        self.liveView = AcquireAndDisplay.LiveView(self.camWidget, self.camWidget.axes[0], self.statusbar.showMessage, parent=self)
+        # Cloud centre, width and peak of every live frame, kept for the strip chart
+        self.liveMetrics = LiveMetrics.MetricsRing()
+        self.stripChart = AcquireAndDisplay.StripChart(self.metricsWidget, self.liveMetrics, parent=self)
+        self.metricsSaveButton.pressed.connect(self.saveMetrics)
         toolbar = NavigationToolbar2QT(self.analysisWidget, self)
         self.analysisLayout.addWidget(toolbar)
         curDay = curDate.day
@@ -67,42 +101,94 @@ class MainWindow(QtWidgets.QMainWindow):
         dateObj = QtCore.QDate(curYear, curMonth, curDay)
         self.recallDateBox.setDate(dateObj)
         self.loadTofCheck.stateChanged.connect(self.loadTofChanged)
+        self.workersBox.setMaximum(os.cpu_count() or 1)
+        self.workersBox.setValue(max(1, (os.cpu_count() or 1) - 1))
     def camModeChanged(self, index):
-        change = True if index == 0 else False
+        if index != 2 and self.liveView.isRunning():
+            self.stopCamera()
+        change = True if index in (0, 3) else False
+        recall = True if index == 1 else False
         self.exposureBox.setEnabled(change)
-        self.recallDateBox.setEnabled(not change)
-        self.recallRunBox.setEnabled(not change)
-        self.loadTofCheck.setEnabled(not change)
-        self.loadTofBox.setEnabled(not change and self.loadTofCheck.isChecked())
+        self.repeatBox.setEnabled(index == 0)
+        self.recallDateBox.setEnabled(recall)
+        self.recallRunBox.setEnabled(recall)
+        self.loadTofCheck.setEnabled(recall)
+        self.loadTofBox.setEnabled(recall and self.loadTofCheck.isChecked())
+    def closeEvent(self, event):
+        self.stopCamera()
+        self.jobScheduler.shutdown()
+        self.cameraRig.close()
+        self.runCatalog.close()
+        self.analysisCache.flush()
+        super(MainWindow, self).closeEvent(event)
     def loadTofChanged(self):
         self.loadTofBox.setEnabled(self.loadTofCheck.isChecked())
+    def stopCamera(self):
+        if self.liveView.isRunning():
+            self.liveView.stop()
+            self.stripChart.stop()
+            self.statusbar.showMessage("Live view stopped.")
+    def stopAll(self):
+        """Stop the live view and cancel every queued and running job."""
+        self.stopCamera()
+        self.jobScheduler.cancelAll()
+    def runLiveView(self):
+        if self.liveView.isRunning():
+            return
+        # The live view shows the first camera
+        camThread = AcquireAndDisplay.CamThread(self.camWidget, self.cameraRig.session(0), metrics=self.liveMetrics)
+        if self.jobScheduler.submit("Live view", lambda job: camThread.run(), JobScheduler.LIVE_VIEW, camThread.stop, reject=True) is None:
+            return
+        self.statusbar.showMessage("Starting live view...")
+        self.liveView.start(camThread)
+        self.stripChart.start()
+    def saveMetrics(self):
+        os.makedirs(self.trigPath, exist_ok=True)
+        path = f"{self.trigPath}metrics_{datetime.datetime.now(datetime.timezone.utc).strftime('%H%M%S')}.csv"
+        count = self.liveMetrics.dump(path)
+        self.statusbar.showMessage(f"Saved {count} frames of live metrics to {path}.")
     def runCameraTrigger(self):
-        if self.tofStartBox.value() == 0.0 or self.tofEndBox.value() == 0.0 or self.tofSplitBox.value() == 0:
-            QtWidgets.QMessageBox.warning(
-                self,
-                "TOF Warning",
-                "One of the TOF fields is empty. Please verify and run again.",
-                buttons=QtWidgets.QMessageBox.StandardButton.Ok,
-                defaultButton=QtWidgets.QMessageBox.StandardButton.Ok
-            )
+        if self.camModeCombo.currentIndex() == 2:
+            self.runLiveView()
+            return
+        if self.camModeCombo.currentIndex() == 3:
+            self.stopCamera()
+            thread = Calibration.DarkCapture(self.cameraRig, self.calibration, self.exposureBox.value(), self)
+            self.jobScheduler.submit("Dark frames", lambda job: thread.run(), JobScheduler.ACQUISITION, reject=True)
             return
-        timeSplit = list(np.linspace(self.tofStartBox.value(), self.tofEndBox.value(), self.tofSplitBox.value()))
         if self.camModeCombo.currentIndex() == 0:
+            timeSplit = self.tofTimeSplit()
+            if timeSplit is None:
+                return
+            # A run already in progress turns this one away; a live view
+            # is stopped and the run starts as soon as it has let go of the camera
+            repeats = self.repeatBox.value()
+            if repeats > 1:
+                # Every repetition gets its own run number
+                runPaths = [f"{self.trigPath}Run{self.runCount + k}/" for k in range(repeats)]
+                thread = Trigger.RepeatTrigger(runPaths, self.tofSplitBox.value(), self.exposureBox.value(), timeSplit, self.sigmaBox.value(), self, self.workersBox.value(), self.cameraRig)
+                name = f"Run{self.runCount}-{self.runCount + repeats - 1}"
+            else:
+                thread = Trigger.MultiCamTrigger(self.tofSplitBox.value(), f"{self.trigPath}Run{self.runCount}/", self.exposureBox.value(), timeSplit, self.sigmaBox.value(), self, self.workersBox.value(), self.cameraRig)
+                name = f"Run{self.runCount}"
+            self.stopCamera()
+            if self.jobScheduler.submit(name, lambda job: thread.run(), JobScheduler.ACQUISITION, thread.stop, reject=True) is None:
+                return
             for i in range(3):
                 for j in range(2):
                     self.analysisWidget.axes[i][j].clear()
-            os.makedirs(f"{self.trigPath}Run{self.runCount}")
             self.statusbar.showMessage("Initializing camera...")
-            self.camThread = Trigger.CamTrigger(self.tofSplitBox.value(), f"{self.trigPath}Run{self.runCount}/", self.exposureBox.value(), timeSplit, self.sigmaBox.value(), self)
-            self.runCount += 1
-            self.camThread.start()
-            
+            self.runCount += repeats
+
         else:
             date = self.recallDateBox.date().toPyDate()
             run = self.recallRunBox.value()
-            dayString = str(date.day) if date.day > 9 else f"0{date.day}"
-            monthString = str(date.month) if date.month > 9 else f"0{date.month}"
-            baseDir = f"{os.getcwd()}/Data/{date.year}/{monthString}/{dayString}/Run{run}/"
+            baseDir = f"{self.runCatalog.dayDir(date)}/Run{run}/"
+            rows = self.runCatalog.find(date, run)
+            if not rows and os.path.exists(baseDir):
+                # Made since the catalog was last refreshed
+                self.runCatalog.update(baseDir)
+                rows = self.runCatalog.find(date, run)
             if not os.path.exists(baseDir):
                 QtWidgets.QMessageBox.warning(
                     self,
@@ -112,10 +198,34 @@ class MainWindow(QtWidgets.QMainWindow):
                     defaultButton=QtWidgets.QMessageBox.StandardButton.Ok
                 )
                 return
-            self.camThread = threading.Thread(None, MotTemp.main, None, [baseDir, self.tofSplitBox.value(), self, timeSplit, self.sigmaBox.value()])
-            self.camThread.start()
+            if rows and rows[0]['numImages'] > 0:
+                # The run's own TOF list, shown in the TOF fields for reference
+                timeSplit = rows[0]['timeSplit']
+                self.tofStartBox.setValue(min(timeSplit))
+                self.tofEndBox.setValue(max(timeSplit))
+                self.tofSplitBox.setValue(len(timeSplit))
+            else:
+                timeSplit = self.tofTimeSplit()
+                if timeSplit is None:
+                    return
+            args = [baseDir, len(timeSplit), self, timeSplit, self.sigmaBox.value(), self.workersBox.value(), self.analysisCache, self.calibration, self.runCatalog]
+            self.jobScheduler.submit(f"Recall of {date} Run{run}", lambda job: MotTemp.main(*args, job=job), JobScheduler.ANALYSIS)
+    def tofTimeSplit(self):
+        """TOF list from the start, end and split fields, or None (after a warning) if one is empty."""
+        if self.tofStartBox.value() == 0.0 or self.tofEndBox.value() == 0.0 or self.tofSplitBox.value() == 0:
+            QtWidgets.QMessageBox.warning(
+                self,
+                "TOF Warning",
+                "One of the TOF fields is empty. Please verify and run again.",
+                buttons=QtWidgets.QMessageBox.StandardButton.Ok,
+                defaultButton=QtWidgets.QMessageBox.StandardButton.Ok
+            )
+            return None
+        return list(np.linspace(self.tofStartBox.value(), self.tofEndBox.value(), self.tofSplitBox.value()))
 
 def main():
+    # Per-frame messages are logged at DEBUG; MOTTEMP_LOG=DEBUG shows them
+    logging.basicConfig(level=os.environ.get('MOTTEMP_LOG', 'INFO').upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
     app = QtWidgets.QApplication(sys.argv)
     main = MainWindow()
     main.show()